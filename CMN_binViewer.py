@@ -29,6 +29,7 @@ import sys
 import errno
 import argparse
 import gc
+import copy
 import glob
 import time
 import datetime
@@ -61,15 +62,24 @@ from shutil import copy2
 import numpy as np
 from PIL import Image as img
 from PIL import ImageTk
-from PIL import ImageChops
 
-from FF_bin_suite import readFF, buildFF, colorize_maxframe, max_nomean, load_dark, load_flat, process_array, \
+from FF_bin_suite import readFF, buildFF, colorize_maxframe, colorize_timecode, max_nomean, load_dark, \
+    load_dark_cached, load_flat_cached, process_array, \
     saveImage, make_flat_frame, makeGIF, get_detection_only, get_processed_frames, adjust_levels, \
-    get_FTPdetect_coordinates, markDetections, deinterlace_array_odd, deinterlace_array_even, rescaleIntensity
+    get_FTPdetect_coordinates, deinterlace_array_odd, deinterlace_array_even, \
+    getActivityProfile, getBusyFrames, estimateFrameRange, tone_map, getCalibrationFrame, deinterlace_blend, \
+    getHistogram, getAutoLevels, significance_map, replace_background, getPreview
 from module_confirmationClass import Confirmation
 # import module_exportLogsort as exportLogsort
-from module_highlightMeteorPath import highlightMeteorPath
+from module_overlay import getOverlay, compositeOverlay, rasterizeDetections, rasterizeMeteorPath, mergeOverlays, \
+    rasterizeSkyGrid
 from module_CAMS2CMN import convert_rmsftp_to_cams
+from module_renderPipeline import RenderPipeline
+from module_renderWorker import RenderWorker
+from module_calibrationLibrary import CalibrationLibrary, parseFFName
+from module_backgroundModel import RollingBackground
+from module_centroiding import refineFTPdetectLines, writeResidualsCSV
+from module_skyMaps import findPlatepar, getSkyMap, skyCoordinates, getRaMap, datetimeToJD
 from makeMP4 import makeMP4
 
 version = "3.37.2"
@@ -252,8 +262,11 @@ class ExternalVideo(Frame):
 
         if external_guidelines:
             # Draw meteor guidelines
-            self.external_video_FFbinRead.avepixel = highlightMeteorPath(self.external_video_FFbinRead.avepixel, 
-                                                                            HT_rho, HT_phi)
+            avepixel = self.external_video_FFbinRead.avepixel
+            guidelines = getOverlay((img_path, HT_rho, HT_phi, avepixel.shape), rasterizeMeteorPath, avepixel.shape, 
+                HT_rho, HT_phi)
+
+            self.external_video_FFbinRead.avepixel = compositeOverlay(avepixel, guidelines)
 
         self.external_video_ncols = self.external_video_FFbinRead.ncols - 1
         self.external_video_nrows = self.external_video_FFbinRead.nrows - 1
@@ -692,6 +705,27 @@ class BinViewer(Frame):
         self.flat_status = BooleanVar()
         self.flat_status.set(False)
 
+        self.bad_pixel_status = BooleanVar()
+        self.bad_pixel_status.set(False)
+
+        # Rolling background (median avepixel of the neighbouring files) instead of avepixel in Detection only
+        # and exports, the model is made for the current directory when needed
+        self.rolling_background_status = BooleanVar()
+        self.rolling_background_status.set(False)
+        self.background_half_window = 5
+        self.background_model = None
+
+        # Sky map of the current directory (from its platepar) as (dir_path, sky map), used for the cursor sky
+        # coordinates and the celestial grid
+        self.sky_grid_status = BooleanVar()
+        self.sky_grid_status.set(False)
+        self.sky_map_decimation = 2
+        self.sky_map = None
+
+        # Minimum signal to noise ratio shown by the Significance filter (0 shows all pixels)
+        self.significance_threshold = IntVar()
+        self.significance_threshold.set(0)
+
         self.dark_name = StringVar()
         self.dark_name.set("dark.bmp")
 
@@ -743,6 +777,15 @@ class BinViewer(Frame):
         self.userejected = IntVar()
         self.userejected.set(userejected)
 
+        # Refine meteor positions in the exported FTPdetectinfo with centroids measured on the FF files
+        self.refine_centroids = IntVar()
+        self.refine_centroids.set(0)
+
+        # Recompute the sky coordinates of the refined positions from the platepar sky map (approximate, see 
+        # module_skyMaps), otherwise the RA, Dec, azimuth and altitude of the FTPdetectinfo are kept
+        self.refine_sky_coordinates = IntVar()
+        self.refine_sky_coordinates.set(0)
+
         self.external_guidelines = IntVar()
         self.external_guidelines.set(external_guidelines)
 
@@ -783,6 +826,34 @@ class BinViewer(Frame):
         # Fast image change flag
         self.fast_img_change = False
 
+        # While a navigation key is held, maxpixel previews with every preview_stride-th pixel are shown
+        self.preview_stride = 4
+
+        # Memoized render products of the last viewed images and the filter registry
+        self.setup_render_pipeline()
+
+        # Activity profiles and image sizes of visited files, by image path
+        self.activity_cache = {}
+        self.image_shapes = {}
+
+        # Images are read and rendered on the render worker, the newest result is shown by poll_render
+        self.render_worker = RenderWorker()
+        self.render_handlers = {}
+        self.render_polling = False
+
+        # Histogram of the currently shown image, before levels
+        self.img_histogram = None
+
+        # (image, histogram, overlay) of the current view before the tone mapping, so levels sliders only apply the
+        # tone again, see preview_levels. None if the levels are part of the rendered image (colorized filters)
+        self.tone_base = None
+
+        # A levels preview is scheduled for the next idle time
+        self.levels_preview_pending = False
+
+        # Master darks and flats of all nights
+        self.calibration_library = CalibrationLibrary()
+
         # shower info, when available
         self.meteor_info = []
         self.current_img_timestamp = None
@@ -814,12 +885,15 @@ class BinViewer(Frame):
         parent.bind("<F5>", self.odd_set)
         parent.bind("<F6>", self.even_set_toggle)
         parent.bind("<F7>", self.frame_filter_set)
+        parent.bind("<F8>", self.timecode_set)
+        parent.bind("S", self.significance_set)
 
         if not disable_UI_video:
             parent.bind("<F9>", self.video_set)
 
         parent.bind("<Delete>", self.deinterlace_toggle)
         parent.bind("<Insert>", self.hold_levels_toggle)
+        parent.bind("A", self.auto_levels)
 
         parent.bind("<Return>", self.copy_bin_to_sorted)
 
@@ -1484,6 +1558,26 @@ class BinViewer(Frame):
         self.filter.set(7)
         self.update_image(0)
 
+    def timecode_set(self, event):
+        """ Set Time-coded filter by pressing F8.
+        """
+        self.filter.set(8)
+        self.update_image(0)
+
+    def significance_set(self, event):
+        """ Set Significance filter by pressing S.
+        """
+        self.filter.set(9)
+        self.update_image(0)
+
+    def get_significance_threshold(self):
+        """ Returns the minimum signal to noise ratio shown by the Significance filter, 0 if not given.
+        """
+        try:
+            return self.significance_threshold.get()
+        except (tk.TclError, ValueError):
+            return 0
+
     def video_set(self, event):
         """ Sets VIDEO filter by pressing F9.
         """
@@ -1538,6 +1632,28 @@ class BinViewer(Frame):
         else:
             self.hold_levels.set(True)
 
+    def auto_levels(self, event):
+        """ Sets the levels and gamma from the histogram of the current image.
+        """
+        if (self.img_histogram is None) or (self.filter.get() in (2, 8, 10)):
+            return 0
+
+        minv, gamma, maxv = getAutoLevels(self.img_histogram)
+
+        # Levels scales have the resolution of 2, keep them apart
+        if maxv - minv < 4:
+            return 0
+
+        # Widen the scale ranges, they are fitted to the new values in update_scales
+        self.min_lvl_scale.config(to = 255)
+        self.max_lvl_scale.config(from_ = 0)
+
+        self.min_lvl_scale.set(minv)
+        self.max_lvl_scale.set(maxv)
+        self.gamma_scale.set(-np.log10(gamma))
+
+        self.update_scales(0)
+
     def dark_toggle(self, event):
         """Toggles the dark frame on/off.
         """
@@ -1548,6 +1664,165 @@ class BinViewer(Frame):
 
         self.update_image(0)
 
+    def get_calibration_path(self, frame_type, img_path, img_shape=None):
+        """ Returns the path of the dark or flat frame for the given image. The frame named in the Calibration panel
+            is used if it exists (relative names are in the current directory), otherwise the master from the
+            calibration library made on the nearest night.
+        """
+
+        calibration_name = self.dark_name.get() if frame_type == 'dark' else self.flat_name.get()
+
+        pth, calibration_fname = os.path.split(calibration_name)
+        calibration_path = calibration_name if pth != '' else os.path.join(self.dir_path, calibration_fname)
+
+        if not os.path.isfile(calibration_path):
+            master_path = self.calibration_library.findMasterForFile(frame_type, img_path, img_shape, 
+                self.data_type.get())
+
+            if master_path is not None:
+                return master_path
+
+        return calibration_path
+
+    def get_bad_pixels(self, img_path, img_shape=None):
+        """ Returns the calibration structure with the bad pixel mask for the given image from the calibration
+            library (made on the nearest night), or None if there is no such mask.
+        """
+
+        if img_shape is None:
+            img_shape = readFF(img_path).avepixel.shape
+
+        mask_path = self.calibration_library.findMasterForFile('badpixels', img_path, img_shape, self.data_type.get())
+
+        if mask_path is None:
+            return None
+
+        try:
+            return getCalibrationFrame(mask_path, 'badpixels')
+        except (IOError, OSError, KeyError, ValueError):
+            return None
+
+    def get_background_model(self, img_path):
+        """ Returns the rolling background model of the current directory, made again if the given image is not
+            in it. Only the file list is read here, the files are read by the model when needed.
+        """
+
+        model = self.background_model
+
+        if (model is None) or (model.data_type != self.data_type.get()) or \
+                (os.path.basename(img_path) not in model.file_index):
+
+            file_list = [os.path.join(self.dir_path, file_name) for file_name in sorted(self.get_bin_list())]
+            model = RollingBackground(file_list, self.background_half_window, data_type = self.data_type.get())
+
+            self.background_model = model
+
+        return model
+
+    def get_rolling_background(self, img_path):
+        """ Returns the rolling background of the given image, the median avepixel of the files around it in the 
+            current directory. Moving to the next file reads only one new file.
+        """
+
+        return self.get_background_model(img_path).getBackground(img_path)
+
+    def get_export_background(self, img_path):
+        """ Returns the rolling background for exports of the given image, or None if it is not used or there
+            are no other files to make it from.
+        """
+
+        if self.rolling_background_status.get() is not True:
+            return None
+
+        try:
+            return self.get_rolling_background(img_path)
+        except (KeyError, ValueError):
+            return None
+
+    def get_sky_map(self):
+        """ Returns the sky map made from the platepar in the current directory, or None if there is no platepar.
+        """
+
+        if (self.sky_map is None) or (self.sky_map[0] != self.dir_path):
+
+            sky_map = None
+
+            try:
+                platepar_path = findPlatepar(self.dir_path)
+
+                if platepar_path is not None:
+                    sky_map = getSkyMap(platepar_path, self.sky_map_decimation)
+
+            except (IOError, OSError, KeyError, ValueError) as error:
+                log.info('unable to read the platepar: {}'.format(error))
+
+            self.sky_map = (self.dir_path, sky_map)
+
+        return self.sky_map[1]
+
+    def get_image_jd(self, img_path):
+        """ Returns the Julian date of the given FF file from its name, or None.
+        """
+
+        ff_time = parseFFName(img_path)[1]
+
+        return datetimeToJD(ff_time) if ff_time is not None else None
+
+    def show_sky_coordinates(self, event):
+        """ Shows the sky coordinates of the pixel under the cursor in the status bar, if there is a platepar.
+        """
+
+        sky_map = self.get_sky_map()
+
+        if (sky_map is None) or (self.current_image == ''):
+            return 0
+
+        resize_fact = max(self.image_resize_factor.get(), 1)
+        x, y = event.x*resize_fact, event.y*resize_fact
+
+        if (x >= sky_map.ncols) or (y >= sky_map.nrows):
+            return 0
+
+        ra, dec, azim, elev = skyCoordinates(sky_map, x, y, self.get_image_jd(self.current_image))
+
+        self.status_bar.config(text = "X {:d} Y {:d}  RA {:.2f} Dec {:+.2f}  Az {:.2f} Alt {:+.2f}".format(x, y, 
+            float(ra), float(dec), float(azim), float(elev)))
+
+    def add_library_master(self, frame_type):
+        """ Builds a master dark or flat, or a bad pixel mask, from a chosen directory into the calibration library,
+            in the background. Bad pixel masks are built from the FF files in the directory and in its
+            subdirectories, so several nights can be used.
+        """
+
+        ff_dir = self.wxDirchoose(initialdir = self.dir_path, title = "Open the directory with {:s} frames, then click OK".format(frame_type))
+        if ff_dir == '':
+            return 0
+
+        if frame_type == 'badpixels':
+            ff_dir = [ff_dir] + [os.path.join(ff_dir, dir_name) for dir_name in sorted(os.listdir(ff_dir)) 
+                if os.path.isdir(os.path.join(ff_dir, dir_name))]
+
+        job = self.calibration_library.buildInBackground(frame_type, ff_dir, data_type = self.data_type.get())
+
+        self.status_bar.config(text = "Adding master {:s} frame to the calibration library...".format(frame_type))
+        self.after(500, self.check_library_job, job, frame_type)
+
+    def check_library_job(self, job, frame_type):
+        """ Reports the end of a calibration library build.
+        """
+
+        if job.isRunning():
+            self.after(500, self.check_library_job, job, frame_type)
+            return 0
+
+        if job.error is not None:
+            self.status_bar.config(text = "Master {:s} frame failed!".format(frame_type))
+            tkMessageBox.showerror("Calibration library", "Master {:s} frame failed: {}".format(frame_type, job.error))
+
+        else:
+            self.status_bar.config(text = "Master {:s} frame for station {:s}, night {:s} added to the library".format(frame_type, 
+                job.master.station, job.master.night))
+
     def open_dark_path(self):
         """ Opens dark frame via file dialog.
         """
@@ -1633,8 +1908,9 @@ class BinViewer(Frame):
         """ Updates the current image on the screen.
         """
 
-        # Skip updating image when key is being held down
+        # Show only a quick preview when key is being held down, the full image is rendered when it is released
         if self.fast_img_change:
+            self.show_preview()
             return 0
 
         # Skip updating image on multiple consecutive updates
@@ -1651,18 +1927,13 @@ class BinViewer(Frame):
             self.bgtask.stop() # stop video updates
             time.sleep(0.001) # yield briefly to the thread scheduler
 
-        updateImageLock = threading.RLock()
-
         self.status_bar.config(text = "View image")  # Update status bar
-        updateImageLock.acquire()
         try:
             # Check if the list is empty. If it is, do nothing.
             self.current_image = self.listbox.get(self.listbox.curselection()[0])
         except:
             return 0
 
-        updateImageLock.release()
-
         # determine the station ID - we need this when doing confirmations
         bn = os.path.basename(self.dir_path)
         spl = bn.split('_')
@@ -1835,41 +2106,67 @@ class BinViewer(Frame):
                 tkMessageBox.showerror("File error", "File not found:\n" + img_path)
                 return 0
 
-        dark_frame = None
-        flat_frame = None
-        flat_frame_scalar = None
+        # A new image is read on the render worker first, the update continues when it is read
+        if img_path not in self.image_shapes:
+            self.status_bar.config(text = "Reading image...")
+            self.submit_render(lambda image_info: self.image_info_done(image_info, event, update_levels), 
+                self.read_image_info, img_path, self.data_type.get())
+
+            return 0
+
+        # On image change, mark the busy frames and in Captured mode pre-fill the frame range of the event
+        if (self.current_image != self.old_image) or (event == 1):
+            activity_profile = self.get_activity_profile(img_path)
+
+            if self.mode.get() == 1:
+                start_frame, end_frame = estimateFrameRange(activity_profile, max_frame=int(float(self.frame_scale.cget('to'))))
+                self.start_frame.set(start_frame)
+                self.end_frame.set(end_frame)
+
+            self.draw_activity_strip(activity_profile)
+
+        dark_calibration = None
+        flat_calibration = None
+        bad_pixel_calibration = None
+
+        # Image size, for choosing calibration frames from the library
+        if self.dark_status.get() or self.flat_status.get() or self.bad_pixel_status.get():
+            img_shape = self.image_shapes[img_path]
 
         # Do if the dark frame is on
         if self.dark_status.get() is True:
-            dark_path = self.dark_name.get()
-            pth, dark_fname = os.path.split(dark_path)
-            if pth == '':
-                dark_path = os.path.join(self.dir_path, dark_fname)
+            dark_path = self.get_calibration_path('dark', img_path, img_shape)
 
             try:
-                dark_frame = load_dark(dark_path)
+                dark_calibration = getCalibrationFrame(dark_path, 'dark')
             except:
                 tkMessageBox.showerror("Dark frame file error", "Cannot find dark frame file: " + self.dark_name.get())
                 self.dark_status.set(False)
 
         # Do if the flat frame is on
         if self.flat_status.get() is True:
-            flat_path = self.flat_name.get()
-            pth, flat_fname = os.path.split(flat_path)
-            if pth == '':
-                flat_path = os.path.join(self.dir_path, flat_fname)
+            flat_path = self.get_calibration_path('flat', img_path, img_shape)
             try:
                 print(flat_path)
-                flat_frame, flat_frame_scalar = load_flat(flat_path)
+                flat_calibration = getCalibrationFrame(flat_path, 'flat')
             except:
                 tkMessageBox.showerror("Flat frame file error", "Cannot find flat frame file: " + self.flat_name.get())
                 self.flat_status.set(False)
 
+        # Do if the bad pixel mask is on
+        if self.bad_pixel_status.get() is True:
+            bad_pixel_calibration = self.get_bad_pixels(img_path, img_shape)
+
+            if bad_pixel_calibration is None:
+                tkMessageBox.showerror("Bad pixel mask error", "No bad pixel mask in the calibration library for this station and image size!")
+                self.bad_pixel_status.set(False)
+
         # Make changes if the filter has changed
         if self.old_filter.get() != self.filter.get():
             # Set all butons to be active
             self.dark_chk.config(state = NORMAL)
             self.flat_chk.config(state = NORMAL)
+            self.bad_pixel_chk.config(state = NORMAL)
             self.deinterlace_chk.config(state = NORMAL)
             self.hold_levels_chk.config(state = NORMAL)
             self.arcsinh_chk.config(state = NORMAL)
@@ -1891,115 +2188,82 @@ class BinViewer(Frame):
             else:
                 self.frame_scale.config(state = DISABLED)
 
-        if self.mode.get() == 4:
-            img_array = process_array(readFF(img_path).maxpixel, flat_frame, flat_frame_scalar, dark_frame, self.deinterlace.get())
+        if (update_levels is True) or (self.hold_levels.get() is True):
+            color_levels = (self.min_lvl_scale.get(), self.gamma.get(), self.max_lvl_scale.get())
+        else:
+            color_levels = (None, None, None)
 
-        # Apply individual filters
-        if self.filter.get() == 1:  # Maxpixel
-            img_array = process_array(readFF(img_path).maxpixel, flat_frame, flat_frame_scalar, dark_frame, self.deinterlace.get())
-            self.img_name_type = 'maxpixel'
-            self.old_filter.set(1)
+        # Render parameters, only the nodes depending on the changed ones are computed again
+        render_params = {'img_path': img_path, 'data_type': self.data_type.get(), 'dark': dark_calibration,
+            'flat': flat_calibration, 'bad_pixels': bad_pixel_calibration, 'deinterlace': self.deinterlace.get(), 'color_levels': color_levels,
+            'start_frame': self.start_frame.get(), 'end_frame': self.end_frame.get(), 
+            'frame': self.frame_scale.get(), 'significance_threshold': self.get_significance_threshold(),
+            'background': img_path if self.rolling_background_status.get() else None}
 
-            # In Confirmation mode plot detection points
-            if self.mode.get() == 3:
+        if self.rolling_background_status.get() is True:
+            self.get_background_model(img_path)
 
-                # Mark detection points on the image
-                img_array = markDetections(img_array, detectionCoordinates, self.edge_marker.get())
+        overlays = []
 
-        elif self.filter.get() == 2:  # Colorized
+        if self.filter.get() in self.filter_registry:
 
-            if (update_levels is True) or (self.hold_levels.get() is True):  # Adjust levels
-                minv_temp = self.min_lvl_scale.get()
-                gamma_temp = self.gamma.get()
-                maxv_temp = self.max_lvl_scale.get()
+            if self.filter.get() == 3:
+                # Detection only, without the background in Captured mode
+                render_node, img_name_type, button_states = self.filter_registry[3][self.mode.get() == 1]
             else:
-                maxv_temp = None
-                gamma_temp = None
-                minv_temp = None
-
-            # Disable check buttons, as these parameters are not used
-            self.dark_chk.config(state = DISABLED)
-            self.flat_chk.config(state = DISABLED)
-            self.deinterlace_chk.config(state = DISABLED)
-
-            img_array = colorize_maxframe(readFF(img_path), minv_temp, gamma_temp, maxv_temp)
-
-            self.img_name_type = 'colorized'
-            self.old_filter.set(2)
-
-        elif self.filter.get() == 3:  # Detection only
-
-            if self.mode.get() == 1:  # Captured mode
-                self.dark_chk.config(state = DISABLED)
-                self.deinterlace_chk.config(state = DISABLED)
-                img_array = max_nomean(readFF(img_path), flat_frame, flat_frame_scalar)
-                self.img_name_type = 'max_nomean'
-
-            elif self.mode.get() == 2:  # Deteced mode
-                self.dark_chk.config(state = NORMAL)
-                self.deinterlace_chk.config(state = NORMAL)
-
-                img_array = get_detection_only(readFF(img_path), self.start_frame.get(), self.end_frame.get(), flat_frame, flat_frame_scalar, dark_frame, self.deinterlace.get())
-                self.img_name_type = 'detected_only'
-
-            elif self.mode.get() == 3:  # Confirmation
-                self.dark_chk.config(state = NORMAL)
-                self.deinterlace_chk.config(state = NORMAL)
-
-                # Get detections only image
-                img_array = get_detection_only(readFF(img_path), self.start_frame.get(), self.end_frame.get(), flat_frame, flat_frame_scalar, dark_frame, self.deinterlace.get())
-                self.img_name_type = 'detected_only'
+                render_node, img_name_type, button_states = self.filter_registry[self.filter.get()]
 
-            self.old_filter.set(3)
+            for button_name, state in button_states.items():
+                getattr(self, button_name).config(state = state)
 
-        elif self.filter.get() == 4:  # Average pixel
-            img_array = process_array(readFF(img_path).avepixel, flat_frame, flat_frame_scalar, dark_frame, self.deinterlace.get())
+            if self.filter.get() == 7:
+                # Show individual frames
 
-            self.img_name_type = 'avepixel'
-            self.old_filter.set(4)
+                stop_confirmation_video = True
+                stop_external_video = True
 
-        elif self.filter.get() == 5:  # Show only odd frame
-            self.deinterlace_chk.config(state = DISABLED)
-            img_array = process_array(readFF(img_path).maxpixel, flat_frame, flat_frame_scalar, dark_frame, deinterlace = False, field = 1)
+                # If filter wasn't changed
+                if self.old_filter.get() != self.filter.get():
+                    self.windowMenu.entryconfig("Save animation", state = "disabled")
+                    self.save_animation_frame.set(False)
+                    self.frame_scale_frame.set(True)
 
-            self.img_name_type = 'odd'
-            self.old_filter.set(5)
+                    self.update_layout()
 
-        elif self.filter.get() == 6:  # Show only even frame
-            self.deinterlace_chk.config(state = DISABLED)
-            img_array = process_array(readFF(img_path).maxpixel, flat_frame, flat_frame_scalar, dark_frame, deinterlace = False, field = 2)
+                # If the image or the filter has changed, set the scale to the start frame
+                if (self.old_image != self.current_image) or (self.filter.get() != self.old_filter.get()):
+                    self.frame_scale.set(self.start_frame.get())
+                    render_params['frame'] = self.frame_scale.get()
 
-            self.img_name_type = 'even'
-            self.old_filter.set(6)
+                self.set_timestamp(self.frame_scale.get())
 
-        elif self.filter.get() == 7:
-            # Show individual frames
+                img_name_type = 'frame_' + str(self.frame_scale.get())
 
-            stop_confirmation_video = True
-            stop_external_video = True
-
-            # If filter wasn't changed
-            if self.old_filter.get() != self.filter.get():
-                self.windowMenu.entryconfig("Save animation", state = "disabled")
-                self.save_animation_frame.set(False)
-                self.frame_scale_frame.set(True)
+            img_shape = self.image_shapes[img_path]
 
-                self.update_layout()
+            # Overlays as (cache key, rasterize function, arguments), they are rasterized on the render worker
 
-            # If the image or the filter has changed, set the scale to the start frame
-            if (self.old_image != self.current_image) or (self.filter.get() != self.old_filter.get()):
-                self.frame_scale.set(self.start_frame.get())
+            # Celestial grid from the sky map of the night, under the detections
+            if self.sky_grid_status.get() is True:
+                sky_map = self.get_sky_map()
 
-            img_array = process_array(buildFF(readFF(img_path), self.frame_scale.get()), flat_frame, flat_frame_scalar, dark_frame, self.deinterlace.get())
+                if (sky_map is not None) and (img_shape == (sky_map.nrows, sky_map.ncols)):
+                    overlays.append(((img_path, 'sky_grid', img_shape), rasterizeSkyGrid, (img_shape, 
+                        getRaMap(sky_map, self.get_image_jd(img_path)), sky_map.dec, sky_map.decimation)))
 
-            self.set_timestamp(self.frame_scale.get())
+            # In Confirmation mode plot detection points on maxpixel, they are drawn over the image after the levels
+            if (self.filter.get() == 1) and (self.mode.get() == 3):
+                overlays.append(((img_path, self.meteor_no, img_shape, self.edge_marker.get()), rasterizeDetections, 
+                    (img_shape, detectionCoordinates, self.edge_marker.get())))
 
-            self.img_name_type = 'frame_' + str(self.frame_scale.get())
-            self.old_filter.set(7)
+            self.img_name_type = img_name_type
+            self.old_filter.set(self.filter.get())
 
         elif self.filter.get() == 10:
             # Show video
 
+            self.tone_base = None
+
             if disable_UI_video:
                 return 0
 
@@ -2025,25 +2289,11 @@ class BinViewer(Frame):
 
             return 0
 
-        # Apply Enhance stars if on, or if the image is inverted
-        if self.arcsinh_status.get() or self.invert.get():
-            # Apply arcshin on an image
-            limg = np.arcsinh(img_array)
-
-            # Normalize values to 1
-            limg = limg / limg.max()
-
-            # Find low and high intensity percentiles
-            low = np.percentile(limg, 0.1)
-            high = np.percentile(limg, 99.8)
-
-            # Rescale image levels with the given range
-            img_array = (rescaleIntensity(limg, in_range=(low, high)) * 255).astype(np.uint8)
-
         # Adjust levels
+        levels = (None, None, None)
         if (update_levels is True) or (self.hold_levels.get() is True):
-            if self.filter.get() != 2:
-                img_array = adjust_levels(img_array, self.min_lvl_scale.get(), self.gamma.get(), self.max_lvl_scale.get())
+            if self.filter.get() not in (2, 8):
+                levels = (self.min_lvl_scale.get(), self.gamma.get(), self.max_lvl_scale.get())
 
         elif self.hold_levels.get() is True:
             pass  # Don't reset values if hold levels button is on
@@ -2053,39 +2303,388 @@ class BinViewer(Frame):
             self.gamma_scale.set(0)
             self.gamma.set(1)
 
-        updateImageLock.acquire()
+        # Render on the worker, colorized images already have the levels in them so they are not kept for previews
+        self.submit_render(lambda rendered: self.show_render(rendered, levels, self.filter.get() not in (2, 8)), 
+            self.render_view, render_node, render_params, overlays, levels, self.get_tone_options())
 
-        self.current_image_cols = len(img_array[0])
+        # Generate timestamp
+        if self.filter.get() != 7:
+            self.set_timestamp()
 
-        self.img_data = img_array
-        # temp_image = ImageTk.PhotoImage(img.fromarray(img_array.astype(np.uint8)).convert("RGB")) #Prepare for showing
+        self.old_image = self.current_image
+
+        return 0
+
+    def get_tone_options(self):
+        """ Returns the (stretch, invert, resize factor) options of the tone mapping, read from the UI.
+        """
 
-        # Prepare for showing
         resize_fact = self.image_resize_factor.get()
         if resize_fact <= 0:
             resize_fact = 1
+
+        return (self.arcsinh_status.get() or self.invert.get()), self.invert.get(), resize_fact
+
+    def tone_view(self, img_array, levels, histogram, overlay, stretch, invert, resize_fact):
+        """ Applies Enhance stars, levels and inversion to the rendered image and draws the overlay over it. Returns
+            the shown array and the resized RGB image. Does not use Tk, so it can run on the render worker.
+        """
+
+        # Apply Enhance stars (also on inverted images), levels and inversion with a single lookup table
+        img_array = tone_map(img_array.astype(np.uint8, copy=False), *levels, stretch=stretch, invert=invert, 
+            histogram=histogram)
+
+        if overlay is not None:
+            img_array = compositeOverlay(img_array, overlay)
+
         # Image.BILINEAR is deprecated in Pillow 9.x
         if hasattr(img, 'Resampling'):
             bilflag = img.Resampling.BILINEAR
         else:
             bilflag = img.BILINEAR
-        imgdata = img.fromarray(img_array.astype(np.uint8)).resize((img_array.shape[1] // resize_fact, img_array.shape[0] // resize_fact), bilflag).convert("RGB")
+        imgdata = img.fromarray(img_array.astype(np.uint8, copy=False))
+        if resize_fact > 1:
+            imgdata = imgdata.resize((img_array.shape[1] // resize_fact, img_array.shape[0] // resize_fact), bilflag)
+        imgdata = imgdata.convert("RGB")
+
+        return img_array, imgdata
+
+    def show_view(self, img_array, imgdata, levels):
+        """ Shows the tone mapped image from tone_view and its histogram strip.
+        """
+
+        self.draw_histogram_strip(levels)
+
+        self.current_image_cols = len(img_array[0])
+
+        self.img_data = img_array
 
-        if self.invert.get():
-            imgdata = ImageChops.invert(imgdata)
         temp_image = ImageTk.PhotoImage(imgdata)
 
         self.imagelabel.configure(image = temp_image)
         self.imagelabel.image = temp_image  # For reference, otherwise it doesn't work
-        updateImageLock.release()
 
-        # Generate timestamp
-        if self.filter.get() != 7:
-            self.set_timestamp()
+    def apply_tone(self, img_array, levels, overlay = None):
+        """ Applies Enhance stars, levels and inversion to the rendered image, draws the overlay over it and shows it.
+        """
 
-        self.old_image = self.current_image
+        self.show_view(*(self.tone_view(img_array, levels, self.img_histogram, overlay, *self.get_tone_options()) + 
+            (levels, )))
 
-        return 0
+    def submit_render(self, handler, function, *args):
+        """ Runs function(*args) on the render worker and calls handler(result) on the main thread when it is done.
+            All older requests are superseded, only the newest result is handled.
+        """
+
+        generation = self.render_worker.submit(function, *args)
+        self.render_handlers = {generation: handler}
+
+        if not self.render_polling:
+            self.render_polling = True
+            self.after(5, self.poll_render)
+
+    def poll_render(self):
+        """ Handles the result of the newest render request, polls again while the worker is busy.
+        """
+
+        # Checked before taking the result, so a result finished in between is not missed
+        busy = self.render_worker.isBusy()
+
+        result = self.render_worker.takeResult()
+
+        if result is not None:
+            handler = self.render_handlers.pop(result.generation, None)
+
+            if result.error is not None:
+                self.status_bar.config(text = "Rendering failed: {}".format(result.error))
+
+            elif handler is not None:
+                handler(result.value)
+
+        if busy:
+            self.after(10, self.poll_render)
+        else:
+            self.render_polling = False
+
+    def show_preview(self):
+        """ Requests a quick maxpixel preview of the selected image, used while a navigation key is held down.
+        """
+
+        try:
+            list_entry = self.listbox.get(self.listbox.curselection()[0])
+        except:
+            return 0
+
+        # Detection mode entries are mapped to the image names
+        if (self.mode.get() == 2) and (list_entry in self.detection_dict):
+            img_name = self.detection_dict[list_entry][0]
+        else:
+            img_name = list_entry.split()[0]
+
+        img_path = os.path.join(self.dir_path, img_name)
+
+        if not os.path.isfile(img_path):
+            return 0
+
+        self.submit_render(self.show_preview_image, self.render_preview, img_path, self.data_type.get(), 
+            max(self.image_resize_factor.get(), 1), self.preview_stride)
+
+    def render_preview(self, img_path, data_type, resize_fact, stride):
+        """ Returns the image name and the preview image scaled to the size of the shown images, runs on the
+            render worker.
+        """
+
+        preview = getPreview(img_path, data_type, stride)
+
+        # Nearest neighbour scaling is enough for a preview
+        if hasattr(img, 'Resampling'):
+            nearestflag = img.Resampling.NEAREST
+        else:
+            nearestflag = img.NEAREST
+
+        imgdata = img.fromarray(preview).resize((max(preview.shape[1]*stride//resize_fact, 1), 
+            max(preview.shape[0]*stride//resize_fact, 1)), nearestflag).convert("RGB")
+
+        return os.path.basename(img_path), imgdata
+
+    def show_preview_image(self, preview):
+        """ Shows the preview from render_preview, the rendered image and its levels are not changed.
+        """
+
+        img_name, imgdata = preview
+
+        temp_image = ImageTk.PhotoImage(imgdata)
+
+        self.imagelabel.configure(image = temp_image)
+        self.imagelabel.image = temp_image
+
+        self.status_bar.config(text = "Preview: " + img_name)
+
+    def read_image_info(self, img_path, data_type):
+        """ Reads the image size and the activity profile of the given file, runs on the render worker.
+        """
+
+        # The FF structure is memoized by the render pipeline, so render_view does not read the file again
+        ff = self.render_pipeline.get('ff', {'img_path': img_path, 'data_type': data_type})
+
+        return img_path, ff.avepixel.shape, getActivityProfile(ff)
+
+    def image_info_done(self, image_info, event, update_levels):
+        """ Stores the image size and the activity profile read by read_image_info and continues the update.
+        """
+
+        img_path, img_shape, activity_profile = image_info
+
+        self.image_shapes[img_path] = img_shape
+        self.activity_cache[img_path] = activity_profile
+
+        self.update_image(event, update_levels = update_levels)
+
+    def render_view(self, render_node, render_params, overlays, levels, tone_options):
+        """ Renders the view on the render worker, returns (image, histogram, overlay, shown array, RGB image), or 
+            None if the request was superseded meanwhile. Does not use Tk.
+        """
+
+        img_array = self.render_pipeline.get(render_node, render_params)
+        histogram = self.render_pipeline.get(render_node + '_histogram', render_params)
+
+        if self.render_worker.isStale():
+            return None
+
+        overlay = mergeOverlays([getOverlay(key, function, *args) for key, function, args in overlays])
+
+        return (img_array, histogram, overlay) + self.tone_view(img_array, levels, histogram, overlay, *tone_options)
+
+    def show_render(self, rendered, levels, keep_tone_base):
+        """ Shows the result of render_view on the main thread.
+        """
+
+        if rendered is None:
+            return 0
+
+        img_array, self.img_histogram, overlay, view_array, view_image = rendered
+
+        # Levels sliders apply only the tone again on this image, see preview_levels
+        self.tone_base = (img_array, self.img_histogram, overlay) if keep_tone_base else None
+
+        self.show_view(view_array, view_image, levels)
+
+    def preview_levels(self):
+        """ Shows the current view with the levels from the sliders, only the tone mapping is applied again.
+        """
+
+        self.levels_preview_pending = False
+
+        if self.tone_base is None:
+            self.update_image(0, update_levels = True)
+            return 0
+
+        img_array, self.img_histogram, overlay = self.tone_base
+
+        self.apply_tone(img_array, (self.min_lvl_scale.get(), self.gamma.get(), self.max_lvl_scale.get()), overlay)
+
+    def setup_render_pipeline(self):
+        """ Builds the render pipeline and the registry of filters which are rendered by it.
+        """
+
+        def calibrationArgs(dark, flat):
+            """ Returns the flat, flat scalar and dark arguments of process_array from calibration structures. """
+
+            if flat is None:
+                return None, None, (dark.dark_frame if dark is not None else None)
+
+            return flat.Flat_frame, flat.Flat_frame_scalar, (dark.dark_frame if dark is not None else None)
+
+        def copyFF(ff):
+            """ Returns a copy of the FF structure with its own avepixel, as buildFF stacks frames on it. """
+
+            ff_copy = copy.copy(ff)
+            ff_copy.avepixel = np.copy(ff.avepixel)
+
+            return ff_copy
+
+        def badPixels(bad):
+            """ Returns the bad_pixel_struct from the calibration structure. """
+
+            return bad.bad_pixels if bad is not None else None
+
+        def background(ff, background_path):
+            """ Returns the FF structure with the rolling background of the given image instead of avepixel. """
+
+            if background_path is None:
+                return ff
+
+            # Runs on the render worker, the model is made by update_image on the main thread
+            return replace_background(ff, self.background_model.getBackground(background_path))
+
+        def calibrated(img_array, dark, flat, bad):
+            return process_array(img_array, *calibrationArgs(dark, flat), bad_pixels=badPixels(bad))
+
+        def blended(img_array, deinterlace):
+            return deinterlace_blend(img_array) if deinterlace else img_array
+
+        pipeline = RenderPipeline()
+
+        pipeline.addNode('ff', lambda img_path, data_type: readFF(img_path, datatype=data_type), 
+            params=('img_path', 'data_type'))
+
+        pipeline.addNode('calibrated_maxpixel', lambda ff, dark, flat, bad: calibrated(ff.maxpixel, dark, flat, bad), 
+            inputs=('ff', ), params=('dark', 'flat', 'bad_pixels'))
+        pipeline.addNode('calibrated_avepixel', lambda ff, dark, flat, bad: calibrated(ff.avepixel, dark, flat, bad), 
+            inputs=('ff', ), params=('dark', 'flat', 'bad_pixels'))
+
+        pipeline.addNode('maxpixel', blended, inputs=('calibrated_maxpixel', ), params=('deinterlace', ))
+        pipeline.addNode('avepixel', blended, inputs=('calibrated_avepixel', ), params=('deinterlace', ))
+        pipeline.addNode('odd_field', deinterlace_array_odd, inputs=('calibrated_maxpixel', ))
+        pipeline.addNode('even_field', deinterlace_array_even, inputs=('calibrated_maxpixel', ))
+
+        pipeline.addNode('colorized', lambda ff, levels: colorize_maxframe(ff, *levels), inputs=('ff', ), 
+            params=('color_levels', ))
+        pipeline.addNode('timecoded', lambda ff, start_frame, end_frame, levels: colorize_timecode(ff, start_frame, 
+            end_frame, *levels), inputs=('ff', ), params=('start_frame', 'end_frame', 'color_levels'))
+
+        pipeline.addNode('snr', lambda ff, threshold: significance_map(ff, threshold=threshold), inputs=('ff', ), 
+            params=('significance_threshold', ))
+        pipeline.addNode('significance', blended, inputs=('snr', ), params=('deinterlace', ))
+
+        pipeline.addNode('max_nomean', lambda ff, flat, bg: max_nomean(background(ff, bg), 
+            *calibrationArgs(None, flat)[:2]), inputs=('ff', ), params=('flat', 'background'))
+        pipeline.addNode('detection_only', lambda ff, start_frame, end_frame, dark, flat, deinterlace, bad, bg: 
+            get_detection_only(copyFF(background(ff, bg)), start_frame, end_frame, *(calibrationArgs(dark, flat) + 
+            (deinterlace, )), bad_pixels=badPixels(bad)), inputs=('ff', ), 
+            params=('start_frame', 'end_frame', 'dark', 'flat', 'deinterlace', 'bad_pixels', 'background'))
+
+        pipeline.addNode('frame', lambda ff, frame, dark, flat, deinterlace, bad: process_array(buildFF(copyFF(ff), 
+            frame), *(calibrationArgs(dark, flat) + (deinterlace, )), bad_pixels=badPixels(bad)), inputs=('ff', ), 
+            params=('frame', 'dark', 'flat', 'deinterlace', 'bad_pixels'))
+
+        self.render_pipeline = pipeline
+
+        # Filter number: (render node, image name type, check button states)
+        # The detection only filter (3) has different entries for the Captured mode (True) and the other modes
+        no_calibration = {'dark_chk': DISABLED, 'flat_chk': DISABLED, 'bad_pixel_chk': DISABLED, 
+            'deinterlace_chk': DISABLED}
+
+        self.filter_registry = {
+            1: ('maxpixel', 'maxpixel', {}),
+            2: ('colorized', 'colorized', no_calibration),
+            3: {True: ('max_nomean', 'max_nomean', {'dark_chk': DISABLED, 'bad_pixel_chk': DISABLED, 
+                    'deinterlace_chk': DISABLED}),
+                False: ('detection_only', 'detected_only', {'dark_chk': NORMAL, 'bad_pixel_chk': NORMAL, 
+                    'deinterlace_chk': NORMAL})},
+            4: ('avepixel', 'avepixel', {}),
+            5: ('odd_field', 'odd', {'deinterlace_chk': DISABLED}),
+            6: ('even_field', 'even', {'deinterlace_chk': DISABLED}),
+            7: ('frame', 'frame', {}),
+            8: ('timecoded', 'timecoded', no_calibration),
+            9: ('significance', 'significance', {'dark_chk': DISABLED, 'flat_chk': DISABLED, 'bad_pixel_chk': DISABLED})
+            }
+
+        # Histogram of every rendered image, used for the arcsinh stretch, auto levels and the histogram strip
+        for render_node in ('maxpixel', 'colorized', 'max_nomean', 'detection_only', 'avepixel', 'odd_field', 
+                'even_field', 'frame', 'timecoded', 'significance'):
+            pipeline.addNode(render_node + '_histogram', getHistogram, inputs=(render_node, ))
+
+    def get_activity_profile(self, img_path):
+        """ Returns the activity profile of the given file, computed only once per file.
+        """
+
+        if img_path not in self.activity_cache:
+            # The FF structure is memoized by the render pipeline, so the file is not read again for rendering
+            ff = self.render_pipeline.get('ff', {'img_path': img_path, 'data_type': self.data_type.get()})
+            self.activity_cache[img_path] = getActivityProfile(ff)
+
+        return self.activity_cache[img_path]
+
+    def draw_histogram_strip(self, levels):
+        """ Draws the histogram of the current image (log scale) and the levels limits on the levels panel.
+        """
+
+        self.histogram_canvas.delete('all')
+
+        if self.img_histogram is None:
+            return 0
+
+        width = self.histogram_canvas.winfo_width()
+        height = int(self.histogram_canvas.cget('height'))
+
+        if width <= 1:
+            width = int(self.histogram_canvas.cget('width'))
+
+        log_histogram = np.log1p(self.img_histogram.astype(np.float64))
+        log_histogram = log_histogram/max(log_histogram.max(), 1)
+
+        x = np.arange(256)*(width - 1)/255.0
+        y = height - log_histogram*(height - 1)
+
+        points = [0, height] + np.column_stack((x, y)).ravel().tolist() + [width - 1, height]
+        self.histogram_canvas.create_polygon(*points, fill = 'gray60', outline = '')
+
+        minv, _, maxv = levels
+        if minv is not None:
+            for level in (minv, maxv):
+                self.histogram_canvas.create_line(level*(width - 1)/255.0, 0, level*(width - 1)/255.0, height, 
+                    fill = 'orange')
+
+    def draw_activity_strip(self, activity_profile):
+        """ Marks the busy frames of the current image above the frame scale.
+        """
+
+        self.activity_canvas.delete('all')
+
+        width = max(self.activity_canvas.winfo_width(), self.frame_scale.winfo_width())
+        height = int(self.activity_canvas.cget('height'))
+        last_frame = float(self.frame_scale.cget('to'))
+
+        # The scale values start and end half a slider from the edges
+        slider_half = int(self.frame_scale.cget('sliderlength'))/2.0
+
+        for frame in getBusyFrames(activity_profile):
+            if frame > last_frame:
+                break
+
+            x = slider_half + frame/last_frame*(width - 2*slider_half)
+            self.activity_canvas.create_line(x, 0, x, height, fill = 'orange')
 
     # GOHERE
     def showVideoMainWindow(self, isRunningFunc=None):
@@ -2310,6 +2909,13 @@ class BinViewer(Frame):
         # Update listbox
         self.update_listbox(self.get_bin_list())
 
+        # Forget activity profiles and the rolling background of the previous directory
+        self.activity_cache = {}
+        self.image_shapes = {}
+        self.background_model = None
+        self.sky_map = None
+        self.render_pipeline.clear()
+
         self.update_data_type()
 
         # Update dir label
@@ -2485,19 +3091,26 @@ class BinViewer(Frame):
         flat_frame_scalar = None
 
         if self.dark_status.get() is True:
-            dark_path = os.path.join(self.dir_path, self.dark_name.get())
+            dark_path = self.get_calibration_path('dark', os.path.join(self.dir_path, current_image))
             try:
-                dark_frame = load_dark(dark_path)
+                dark_frame = load_dark_cached(dark_path)
             except:
                 pass
 
         if self.flat_status.get() is True:
-            flat_path = os.path.join(self.dir_path, self.flat_name.get())
+            flat_path = self.get_calibration_path('flat', os.path.join(self.dir_path, current_image))
             try:
-                flat_frame, flat_frame_scalar = load_flat(flat_path)
+                flat_frame, flat_frame_scalar = load_flat_cached(flat_path)
             except:
                 pass
 
+        bad_pixels = None
+        if self.bad_pixel_status.get() is True:
+            bad_pixel_calibration = self.get_bad_pixels(os.path.join(self.dir_path, current_image.split()[0]))
+
+            if bad_pixel_calibration is not None:
+                bad_pixels = bad_pixel_calibration.bad_pixels
+
         self.status_bar.config(text ="Processing individual frames and fields...")
 
         save_path = self.wxDirchoose(initialdir = self.dir_path, title = "Open the directory where you want to save individual frames by field, then click OK")
@@ -2506,7 +3119,7 @@ class BinViewer(Frame):
         if save_path == '':
             return '', 0
 
-        image_list = get_processed_frames(os.path.join(self.dir_path, current_image), save_path, self.data_type.get(), flat_frame, flat_frame_scalar, dark_frame, self.start_frame.get(), self.end_frame.get(), logsort_export, no_background = no_background)
+        image_list = get_processed_frames(os.path.join(self.dir_path, current_image), save_path, self.data_type.get(), flat_frame, flat_frame_scalar, dark_frame, self.start_frame.get(), self.end_frame.get(), logsort_export, no_background = no_background, bad_pixels = bad_pixels, background = self.get_export_background(os.path.join(self.dir_path, current_image)))
 
         if not logsort_export:
             tkMessageBox.showinfo("Saving progress", "Saving done!")
@@ -2529,19 +3142,26 @@ class BinViewer(Frame):
         flat_frame_scalar = None
 
         if self.dark_status.get() is True:
-            dark_path = os.path.join(self.dir_path, self.dark_name.get())
+            dark_path = self.get_calibration_path('dark', os.path.join(self.dir_path, current_image))
             try:
-                dark_frame = load_dark(dark_path)
+                dark_frame = load_dark_cached(dark_path)
             except:
                 pass
 
         if self.flat_status.get() is True:
-            flat_path = os.path.join(self.dir_path, self.flat_name.get())
+            flat_path = self.get_calibration_path('flat', os.path.join(self.dir_path, current_image))
             try:
-                flat_frame, flat_frame_scalar = load_flat(flat_path)
+                flat_frame, flat_frame_scalar = load_flat_cached(flat_path)
             except:
                 pass
 
+        bad_pixels = None
+        if self.bad_pixel_status.get() is True:
+            bad_pixel_calibration = self.get_bad_pixels(os.path.join(self.dir_path, current_image.split()[0]))
+
+            if bad_pixel_calibration is not None:
+                bad_pixels = bad_pixel_calibration.bad_pixels
+
         imgtype='GIF'
         extn = '.gif'
         if not gif:
@@ -2598,7 +3218,8 @@ class BinViewer(Frame):
                     ff_dir=self.dir_path, deinterlace=self.deinterlace.get(), print_name=self.gif_embed.get(), 
                     Flat_frame=flat_frame, Flat_frame_scalar=flat_frame_scalar, dark_frame=dark_frame, gif_name_parse=gif_path, 
                     repeat=repeat_temp, fps=self.fps.get(), minv=minv_temp, gamma=gamma_temp, maxv=maxv_temp, 
-                    perfield = self.perfield_var.get(), data_type=self.data_type.get())
+                    perfield = self.perfield_var.get(), data_type=self.data_type.get(), bad_pixels=bad_pixels, 
+                    background_function=self.get_export_background if self.rolling_background_status.get() else None)
         else:
             annotation = ''
             if self.gif_embed.get():
@@ -2801,7 +3422,13 @@ class BinViewer(Frame):
         self.gamma.set(1 / 10**(self.gamma_scale.get()))
         self.gamma_scale.config(label = "Gamma:             " + "{0:.2f}".format(round(self.gamma.get(), 2)))
 
-        self.update_image(0, update_levels = True)
+        # Only the tone of the current view changes, slider events are coalesced into one preview per idle time
+        if self.tone_base is None:
+            self.update_image(0, update_levels = True)
+
+        elif not self.levels_preview_pending:
+            self.levels_preview_pending = True
+            self.after_idle(self.preview_levels)
 
     def change_mode(self):
         """ Changes the current mode.
@@ -2822,9 +3449,25 @@ class BinViewer(Frame):
             # Set filter to maxframe
             self.filter.set(1)
 
+            self.start_frame.set(0)
+
+            if (self.data_type.get() == 1) or (self.data_type.get() == 3):
+
+                # CAMS data type
+                self.end_frame.set(255)
+                self.frame_scale.config(to = 255)
+            else:
+
+                # Skypatrol data type
+                self.end_frame.set(1500)
+                self.frame_scale.config(to = 1500)
+
             # Preserve the image position
             old_image = self.current_image
 
+            # Treat the image as changed, so the frame range is estimated again
+            self.old_image = ''
+
             temp_bin_list = self.get_bin_list()
 
             # Update listbox
@@ -2839,19 +3482,6 @@ class BinViewer(Frame):
                 # Move listbox cursor to the top
                 self.move_top(0)
 
-            self.start_frame.set(0)
-
-            if (self.data_type.get() == 1) or (self.data_type.get() == 3):
-
-                # CAMS data type
-                self.end_frame.set(255)
-                self.frame_scale.config(to = 255)
-            else:
-
-                # Skypatrol data type
-                self.end_frame.set(1500)
-                self.frame_scale.config(to = 1500)
-
         elif self.mode.get() == 2 or self.mode.get() == 4:
 
             # Detected mode or Rejected mode
@@ -3337,6 +3967,20 @@ class BinViewer(Frame):
 
         FTPdetectinfoExport = self.ConfirmationInstance.exportFTPdetectinfo()
 
+        if len(confirmed_files) and (self.refine_centroids.get() == 1):
+            self.timestamp_label.configure(text = "Refining centroids...")
+
+            try:
+                sky_map = self.get_sky_map() if self.refine_sky_coordinates.get() == 1 else None
+
+                FTPdetectinfoExport, residual_rows = refineFTPdetectLines(FTPdetectinfoExport, self.dir_path, data_type = self.data_type.get(), sky_map = sky_map)
+
+                residuals_name = os.path.splitext(os.path.basename(self.ConfirmationInstance.FTP_detect_file))[0] + '_residuals.csv'
+                writeResidualsCSV(residual_rows, os.path.join(self.ConfirmationInstance.confirmationDirectory, residuals_name))
+
+            except Exception as error:
+                log.info('unable to refine centroids: {}'.format(error))
+
         # CAMS code, initially zero, set if there's a CAMS-format file in the folder
         cams_code = '000000'
 
@@ -3566,6 +4210,8 @@ class BinViewer(Frame):
                 - F5 - odd filter set
                 - F6 - even filter set and toggle with odd frame
                 - F7 - show individual frames (use slider)
+                - F8 - time-coded maxframe (color by frame)
+                - S - significance (signal to noise ratio of maxpixel)
 
                 - F9 - show video
 
@@ -3575,6 +4221,7 @@ class BinViewer(Frame):
             Other:
                 - Delete - toggle Deinterlace
                 - Insert - toggle Hold levels
+                - A - auto levels (stretch between 0.1 and 99.8 percentile)
                 """)
 
     def quitApplication(self):
@@ -3584,6 +4231,7 @@ class BinViewer(Frame):
         self.filter.set(1)
         self.update_image(0)
         time.sleep(0.25)
+        log.info('render timing:\n' + self.render_pipeline.timingReport())
         log.info('quitting')
         quitBinviewer()
     
@@ -3666,12 +4314,18 @@ class BinViewer(Frame):
         self.confirmationMenu.add_checkbutton(label = "External video - 1:4 size", onvalue = 4, variable = self.externalVideoOn, command = self.update_layout)
         self.confirmationMenu.add_separator()
         self.confirmationMenu.add_checkbutton(label = "Use RejectedFiles Folder", onvalue = 1, variable = self.userejected, command = self.update_layout)
+        self.confirmationMenu.add_checkbutton(label = "Refine centroids on export", onvalue = 1, offvalue = 0, variable = self.refine_centroids)
+        self.confirmationMenu.add_checkbutton(label = "Recompute sky coordinates on export (platepar)", onvalue = 1, offvalue = 0, variable = self.refine_sky_coordinates)
         self.menuBar.add_cascade(label = "Confirmation", underline = 0, menu = self.confirmationMenu)
 
         # Process Menu
         processMenu = Menu(self.menuBar, tearoff = 0)
         processMenu.add_command(label = "Make master dark frame", command = self.make_master_dark)
         processMenu.add_command(label = "Make master flat frame", command = self.make_master_flat)
+        processMenu.add_separator()
+        processMenu.add_command(label = "Add master dark to library", command = lambda: self.add_library_master('dark'))
+        processMenu.add_command(label = "Add master flat to library", command = lambda: self.add_library_master('flat'))
+        processMenu.add_command(label = "Add bad pixel mask to library", command = lambda: self.add_library_master('badpixels'))
         self.menuBar.add_cascade(label="Process", underline=0, menu=processMenu)
 
         # Layout menu
@@ -3692,6 +4346,8 @@ class BinViewer(Frame):
         self.windowMenu.add_checkbutton(label = "Save image", onvalue = True, offvalue = False, variable = self.save_image_frame, command = self.update_layout)
         self.windowMenu.add_checkbutton(label = "Image levels", onvalue = True, offvalue = False, variable = self.image_levels_frame, command = self.update_layout)
         self.windowMenu.add_checkbutton(label = "Save animation", onvalue = True, offvalue = False, variable = self.save_animation_frame, command = self.update_layout)
+        self.windowMenu.add_separator()
+        self.windowMenu.add_checkbutton(label = "Celestial grid (platepar)", onvalue = True, offvalue = False, variable = self.sky_grid_status, command = lambda: self.update_image(0))
         self.menuBar.add_cascade(label = "Window", menu = self.windowMenu)
 
         # Help Menu
@@ -3758,6 +4414,20 @@ class BinViewer(Frame):
         self.invert_chk = Checkbutton(calib_panel, text = "Invert", variable = self.invert, command = lambda: self.update_image(0))
         self.invert_chk.grid(row = 6, column = 3, sticky = "W")
 
+        self.bad_pixel_chk = Checkbutton(calib_panel, text = "Bad pixels", variable = self.bad_pixel_status, command = lambda: self.update_image(0))
+        self.bad_pixel_chk.grid(row = 7, column = 0, sticky = "W")
+
+        significance_label = Label(calib_panel, text = "Signif. min SNR:")
+        significance_label.grid(row = 7, column = 1, sticky = "E")
+
+        significance_entry = ConstrainedEntry(calib_panel, textvariable = self.significance_threshold, width = 5)
+        significance_entry.update_value(100)
+        significance_entry.grid(row = 7, column = 2, sticky = "W")
+        significance_entry.bind("<Return>", lambda event: self.update_image(0))
+
+        self.rolling_background_chk = Checkbutton(calib_panel, text = "Rolling bg.", variable = self.rolling_background_status, command = lambda: self.update_image(0))
+        self.rolling_background_chk.grid(row = 7, column = 3, sticky = "W")
+
         # Listbox
         self.scrollbar = Scrollbar(self)
         self.listbox = Listbox(self, width = 47, yscrollcommand=self.scrollbar.set, exportselection=0, activestyle = "none", bg = global_bg, fg = global_fg)
@@ -3788,10 +4458,18 @@ class BinViewer(Frame):
         self.frames_btn = Radiobutton(filter_panel, text = "Frames", variable = self.filter, value = 7, command = lambda: self.update_image(0))
         self.frames_btn.grid(row = 2, column = 9)
 
+        # Time-coded
+        self.timecode_btn = Radiobutton(filter_panel, text = "Time-coded", variable = self.filter, value = 8, command = lambda: self.update_image(0))
+        self.timecode_btn.grid(row = 2, column = 10)
+
+        # Significance
+        self.significance_btn = Radiobutton(filter_panel, text = "Significance", variable = self.filter, value = 9, command = lambda: self.update_image(0))
+        self.significance_btn.grid(row = 2, column = 11)
+
         # Video
         if not disable_UI_video:
             self.video_btn = Radiobutton(filter_panel, text = "Video", variable = self.filter, value = 10, command = lambda: self.update_image(0))
-            self.video_btn.grid(row = 2, column = 10)
+            self.video_btn.grid(row = 2, column = 12)
 
         # Sort panel
         self.sort_panel = LabelFrame(self, text=' Sort FF*.bins ')
@@ -3824,6 +4502,7 @@ class BinViewer(Frame):
         self.imagelabel = Label(self, image = noimage)
         self.imagelabel.image = noimage
         self.imagelabel.grid(row=3, column=3, rowspan = 4, columnspan = 3)
+        self.imagelabel.bind("<Motion>", self.show_sky_coordinates)
 
         # Timestamp label
         # self.timestamp_label = Label(self, text = "YYYY-MM-DD HH:MM.SS.mms  FFF", font=("Courier", 12))
@@ -3876,6 +4555,9 @@ class BinViewer(Frame):
 
         self.gamma_scale.config(command = self.update_scales)
 
+        self.histogram_canvas = tk.Canvas(self.levels_label, height = 24, width = 200, background = global_bg, highlightthickness = 0)
+        self.histogram_canvas.grid(row = 8, column = 4, columnspan = 2, sticky = "WE")
+
         self.hold_levels_chk_horizontal = Checkbutton(self.levels_label, text = 'Hold levels', variable = self.hold_levels)
         # Position set in update_layout function
 
@@ -3920,6 +4602,10 @@ class BinViewer(Frame):
         self.frame_scale.grid(row = 1, column = 1, columnspan = 5, sticky ="WE")
         self.frame_scale.config(command = self.update_image)
 
+        # Busy frames of the current image are marked above the frame scale
+        self.activity_canvas = tk.Canvas(self.frames_slider_panel, height = 6, background = global_bg, highlightthickness = 0)
+        self.activity_canvas.grid(row = 0, column = 1, columnspan = 5, sticky ="WE")
+
         frame_start_frame_label = Label(self.frames_slider_panel, text = "Start: ")
         frame_start_frame_label.grid(row = 2, column = 1, sticky = "W")
         self.frame_start_frame_entry = ConstrainedEntry(self.frames_slider_panel, textvariable = self.start_frame, width = 5)
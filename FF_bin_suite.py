@@ -23,8 +23,14 @@ Reading from FF*.bin files based on Matlab scripts by Peter S. Gural.
 
 
 import os
+import copy
+import tempfile
 import subprocess
 import platform
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from collections import OrderedDict
 import six
 
 import numpy as np
@@ -36,6 +42,9 @@ from PIL import ImageFont
 from PIL import ImageDraw
 import imageio
 
+import module_numbaKernels as numba_kernels
+import module_overlay as overlay
+
 
 gifsicle_name = "gifsicle.exe" #gifsicle.exe program name
 font_name = "COUR.TTF"
@@ -44,6 +53,45 @@ run_dir = os.path.abspath(".")
 
 log = logging.getLogger("CMN_binViewer")
 
+# Use the compiled kernels for the pixel-level hot loops if numba is installed
+use_numba = numba_kernels.numba_available
+
+# Images with at least tile_min_pixels pixels are processed in row bands on tile_workers threads (1 disables tiling)
+try:
+    tile_workers = multiprocessing.cpu_count()
+except NotImplementedError:
+    tile_workers = 1
+tile_min_pixels = 1000000
+
+# Thread pools used for tiled processing, one per number of workers
+tile_pools = {}
+
+# Tone mapping lookup tables, see getToneLUT
+tone_lut_cache = {}
+
+# Loaded dark and flat frames, keyed by the file path, see getCalibrationFrame. The cache is used by the viewer, 
+# the render worker and the calibration library builds, so it is only used with calibration_cache_lock held
+calibration_cache = {}
+calibration_cache_lock = threading.RLock()
+
+# Calibration arrays derived from the last dark and flat frames given to process_array, see getCalibrationArrays
+calibration_arrays = {}
+
+# Per-thread scratch arrays, see getScratchBuffer
+scratch_buffers = threading.local()
+
+# Downsampled maxpixel previews of the last viewed files, keyed by (file path, stride), see getPreview
+preview_cache = OrderedDict()
+preview_cache_size = 64
+
+# Memory in bytes used for stacking images in memory, bigger stacks are kept in a temporary file, see stack_frames
+stack_memory_limit = 512*1024**2
+
+# Data types: images (FF arrays, calibration frames, processed and exported images) are stored as uint8. Differences
+# of images are computed in int16, scaling (video brightening, flat field, levels) in float32, preferably in place or
+# into out= buffers. float64 is only used for statistics accumulated over many images (stacking, find_bad_pixels).
+# See the 'dtypes' benchmark in module_benchmark.
+
 
 class ff_struct:
     """ Default structure for a FF*.bin file.
@@ -83,6 +131,55 @@ class ff_struct:
         self.avepixel = 0
         self.stdpixel = 0
 
+        # Cached (noise floor, activity profile), see getActivityProfile
+        self.activity_profile = None
+
+
+class calibration_struct:
+    """ A dark or flat frame loaded from a BMP file, with the arrays derived from it for fast calibration.
+    """
+    def __init__(self):
+
+        # File path, modification time and size, used to detect changes of the file
+        self.path = ''
+        self.mtime = 0
+        self.size = 0
+
+        # 'dark' or 'flat'
+        self.frame_type = ''
+
+        # Dark frame as returned by load_dark, and as int16
+        self.dark_frame = None
+        self.dark_int16 = None
+
+        # Flat frame and its median as returned by load_flat
+        self.Flat_frame = None
+        self.Flat_frame_scalar = None
+
+        # Flat correction gain (Flat_frame_scalar/Flat_frame, zeroes in the flat replaced by 1)
+        self.flat_gain = None
+
+        # Hot and dead pixels (bad_pixel_struct), for the 'badpixels' type
+        self.bad_pixels = None
+
+
+class bad_pixel_struct:
+    """ Hot and dead pixels of a camera, see find_bad_pixels and fill_bad_pixels.
+    """
+    def __init__(self, shape=(0, 0), rows=(), cols=(), hot=()):
+
+        # Image shape (rows, columns)
+        self.shape = tuple(shape)
+
+        # Row and column of each bad pixel, and True for hot pixels (False for dead ones)
+        self.rows = np.asarray(rows, dtype=np.intp)
+        self.cols = np.asarray(cols, dtype=np.intp)
+        self.hot = np.asarray(hot, dtype=bool)
+
+        # Rows, columns and validity (inside the image and not bad) of the 8 neighbours of each bad pixel,
+        # computed on first use by getBadPixelNeighbours
+        self.neighbours = None
+
 
 def truth_generator():
     """ Generates True/False intermittently by calling:
@@ -182,6 +279,69 @@ def readFF(filename, datatype = 1):
 
 
 
+def readPreview(filename, datatype=1, stride=4):
+    """ Reads only every stride-th row and column of the maxpixel image, for quick previews. CAMS files are read
+        only up to the end of maxpixel and FITS files are memory mapped, so only the preview pixels are decoded.
+
+    filename: FF file name
+    datatype: 1 for CAMS, 2 for Skypatrol, 3 for RMS
+    stride: sampling step in pixels
+    """
+
+    if datatype == 2:
+        return np.ascontiguousarray(readSkypatrolBMP(filename).maxpixel[::stride, ::stride])
+
+    elif datatype == 3:
+        hdulist = pyfits.open(filename, memmap=True)
+
+        try:
+            return np.array(hdulist[1].data[::stride, ::stride], dtype=np.uint8)
+        finally:
+            hdulist.close()
+
+    with open(filename, 'rb') as fid:
+
+        # Old format header: nrows, ncols, nbits, first, camno; new: -1, nrows, ncols, nframes, first, camno, 
+        # decimation, interleave, fps
+        version_flag = int(np.fromfile(fid, dtype=np.int32, count = 1))
+
+        if version_flag > 0:
+            nrows = version_flag
+            ncols = int(np.fromfile(fid, dtype=np.uint32, count = 4)[0])
+
+        else:
+            nrows, ncols = [int(value) for value in np.fromfile(fid, dtype=np.uint32, count = 8)[:2]]
+
+        maxpixel = np.fromfile(fid, dtype=np.uint8, count = nrows*ncols)
+
+    # Incomplete file
+    if maxpixel.size < nrows*ncols:
+        maxpixel = np.concatenate((maxpixel, np.zeros(nrows*ncols - maxpixel.size, dtype=np.uint8)))
+
+    return np.ascontiguousarray(maxpixel.reshape(nrows, ncols)[::stride, ::stride])
+
+
+
+def getPreview(filename, datatype=1, stride=4):
+    """ Returns the downsampled maxpixel preview of the file (see readPreview), previews of the last viewed files
+        are cached.
+    """
+
+    key = (os.path.abspath(filename), datatype, stride)
+
+    if key in preview_cache:
+        preview_cache[key] = preview_cache.pop(key)
+
+    else:
+        preview_cache[key] = readPreview(filename, datatype, stride)
+
+        while len(preview_cache) > preview_cache_size:
+            preview_cache.popitem(last=False)
+
+    return preview_cache[key]
+
+
+
 def readSkypatrolBMP(img_name):
     """ Reads Skypatrol BMP and returns maxpixel and maxframe image array.
 
@@ -284,18 +444,188 @@ def buildFF(ff, kframe, videoFlag=False, no_background=False):
             # When videoFlag is False, every consecutive frame will be added to the average pixel, producing a stacking effect
             img = ff.avepixel
 
+    if use_numba:
+        bright = videoFlag and (ff.adjustment_scalar > 2)
+        out = np.empty(img.shape, dtype=np.float32) if bright else img
+
+        return numba_kernels.build_frame(ff.maxpixel, ff.maxframe, img, kframe, ff.adjustment_scalar, bright, out)
+
     k = np.where(ff.maxframe == kframe)
 
     img[k] = ff.maxpixel[k]
 
     if videoFlag and (ff.adjustment_scalar > 2):
-        img = img * ff.adjustment_scalar*1.2 + 10
-        img = np.clip(img, 0, 255)
+        img = brightenFrames(img, ff.adjustment_scalar)
+
+    return img
+
+
+
+def brightenFrames(img_array, scalar):
+    """ Returns the video brightening of buildFF (img_array*scalar*1.2 + 10, clipped to 0-255) as float32. Stacks
+        are brightened frame by frame, so the float64 intermediate is never larger than one frame.
+    """
+
+    bright_array = np.empty(img_array.shape, dtype=np.float32)
+
+    if img_array.ndim == 3:
+        for i in range(len(img_array)):
+            bright_array[i] = brightenFrames(img_array[i], scalar)
+
+        return bright_array
+
+    bright_array[:] = np.clip(img_array*scalar*1.2 + 10, 0, 255)
+
+    return bright_array
+
+
+
+def buildFFStack(ff, start_frame, end_frame, videoFlag=True, no_background=False):
+    """ Returns all frames from start_frame to end_frame (inclusive) as one array of shape (N, nrows, ncols).
+
+    Every frame is identical to the one returned by buildFF(ff, k, videoFlag=True), but the whole range is
+    reconstructed in one pass over the maxframe array instead of one np.where call per frame.
+
+    ff: FF structure
+    start_frame: first frame of the stack
+    end_frame: last frame of the stack
+    videoFlag: apply the video brightening, the same as in buildFF (default True)
+    no_background: if True, the frames are built on a black background instead of avepixel (default False)
+    """
+
+    frames = np.arange(start_frame, end_frame + 1)
+
+    if no_background:
+        background = np.zeros_like(ff.avepixel)
+    else:
+        background = ff.avepixel
+
+    if use_numba:
+        bright = videoFlag and (ff.adjustment_scalar > 2)
+        img_stack = np.empty((len(frames), ) + background.shape, dtype=np.float32 if bright else background.dtype)
+
+        for i, kframe in enumerate(frames):
+            numba_kernels.build_frame(ff.maxpixel, ff.maxframe, background, kframe, ff.adjustment_scalar, bright,
+                img_stack[i])
+
+        return img_stack
+
+    # Mark where each frame has its maximum
+    frame_mask = ff.maxframe[np.newaxis, :, :] == frames[:, np.newaxis, np.newaxis]
+
+    img_stack = np.where(frame_mask, ff.maxpixel, background).astype(background.dtype)
+
+    if videoFlag and (ff.adjustment_scalar > 2):
+        img_stack = brightenFrames(img_stack, ff.adjustment_scalar)
+
+    return img_stack
+
+
+
+def buildFFWindow(ff, kframe, y_left, y_right, x_left, x_right):
+    """ Returns the window [y_left:y_right, x_left:x_right] of the K frame, the same as cropping 
+        buildFF(ff, kframe, videoFlag=True), but only the pixels inside the window are reconstructed.
+    """
+
+    # Clip the window to the image, the same as slicing does
+    y_left, y_right, _ = slice(y_left, y_right).indices(ff.avepixel.shape[0])
+    x_left, x_right, _ = slice(x_left, x_right).indices(ff.avepixel.shape[1])
+    y_right = max(y_left, y_right)
+    x_right = max(x_left, x_right)
+
+    bright = ff.adjustment_scalar > 2
+
+    if use_numba:
+        out = np.empty((y_right - y_left, x_right - x_left), dtype=np.float32 if bright else ff.avepixel.dtype)
+
+        return numba_kernels.build_frame(ff.maxpixel, ff.maxframe, ff.avepixel, kframe, ff.adjustment_scalar, 
+            bright, out, y_left, x_left)
+
+    window = (slice(y_left, y_right), slice(x_left, x_right))
+
+    img = np.copy(ff.avepixel[window])
+
+    k = np.where(ff.maxframe[window] == kframe)
+
+    img[k] = ff.maxpixel[window][k]
+
+    if bright:
+        img = brightenFrames(img, ff.adjustment_scalar)
 
     return img
 
 
 
+def getActivityProfile(ff, noise_floor=20):
+    """ Returns the activity profile of the FF file, i.e. the sum of (maxpixel - avepixel) of all pixels which
+        peaked in each frame. Only differences above the noise floor are counted. The profile is computed with
+        one weighted np.bincount and cached in the FF structure.
+
+    ff: FF structure
+    noise_floor: minimum difference between maxpixel and avepixel to be counted (default 20)
+    """
+
+    cached = getattr(ff, 'activity_profile', None)
+    if (cached is not None) and (cached[0] == noise_floor):
+        return cached[1]
+
+    diff = ff.maxpixel.astype(np.int16) - ff.avepixel.astype(np.int16)
+    hits = diff > noise_floor
+
+    # Number of frames in the file (Skypatrol maxframe goes up to 1500)
+    nframes = max(int(ff.nframes), int(np.max(ff.maxframe)) + 1)
+
+    profile = np.bincount(ff.maxframe[hits].astype(np.intp), weights=diff[hits], minlength=nframes)
+
+    ff.activity_profile = (noise_floor, profile)
+
+    return profile
+
+
+
+def getBusyFrames(profile, threshold=0.2):
+    """ Returns the indices of frames in which the activity is above the given fraction of the peak activity
+        (measured above the median activity level).
+
+    profile: activity profile, see getActivityProfile
+    threshold: fraction of the peak activity (default 0.2)
+    """
+
+    peak = np.max(profile)
+    background = np.median(profile)
+
+    if peak <= background:
+        return np.array([], dtype=np.intp)
+
+    return np.flatnonzero(profile > background + threshold*(peak - background))
+
+
+
+def estimateFrameRange(profile, threshold=0.2, padding=5, max_frame=None):
+    """ Estimates the start and end frame of the event from the activity profile. Returns (start_frame, end_frame).
+        If there is no activity, the whole frame range is returned.
+
+    profile: activity profile, see getActivityProfile
+    threshold: fraction of the peak activity, see getBusyFrames (default 0.2)
+    padding: number of frames added to each side of the busy frames (default 5)
+    max_frame: the last frame in the file (default: last frame of the profile)
+    """
+
+    if max_frame is None:
+        max_frame = len(profile) - 1
+
+    busy_frames = getBusyFrames(profile, threshold)
+
+    if not len(busy_frames):
+        return 0, max_frame
+
+    start_frame = max(int(busy_frames[0]) - padding, 0)
+    end_frame = min(int(busy_frames[-1]) + padding, max_frame)
+
+    return start_frame, end_frame
+
+
+
 def add_text(ff_array, img_text):
     """ Adds text to numpy array image.
     """
@@ -355,78 +685,221 @@ def saveImage(ff_array, img_name, print_name=True, bmp_24bit=False, extra_text=N
 
 
 
-def deinterlace_array_odd(ff_image):
+def deinterlace_array_odd(ff_image, out=None):
     """ Deinterlaces the numpy array image by duplicating the odd frame. 
+
+    ff_image: 2D image array
+    out: optional output array of the same shape, may be ff_image itself
     """
-    truth_gen = truth_generator()
-    deinterlaced_image = np.copy(ff_image) #deepcopy ff_image to new array
-    old_row = ff_image[0]
-    for row_num in range(len(ff_image)):
-        if next(truth_gen) is True:
-            deinterlaced_image[row_num] = np.copy(ff_image[row_num])
-            old_row = ff_image[row_num]
-        else:
-            deinterlaced_image[row_num] = np.copy(old_row)
 
-    deinterlaced_image = move_array_1up(deinterlaced_image)
+    if out is None:
+        out = np.empty_like(ff_image)
+
+    if use_numba and (ff_image.ndim == 2):
+        return numba_kernels.deinterlace_odd(ff_image, out)
 
-    return deinterlaced_image
+    return field_odd_stack(ff_image, out=out)
 
 
 
-def deinterlace_array_even(ff_image):
+def deinterlace_array_even(ff_image, out=None):
     """ Deinterlaces the numpy array image by duplicating the even frame. 
+
+    ff_image: 2D image array
+    out: optional output array of the same shape, may be ff_image itself
     """
-    truth_gen = truth_generator()
-    deinterlaced_image = np.copy(ff_image) #deepcopy ff_image to new array
-    old_row = ff_image[-1]
-    for row_num in reversed(range(len(ff_image))):
-        if next(truth_gen) is True:
-            deinterlaced_image[row_num] = np.copy(ff_image[row_num])
-            old_row = ff_image[row_num]
-        else:
-            deinterlaced_image[row_num] = np.copy(old_row)
 
-    return deinterlaced_image
+    if out is None:
+        out = np.empty_like(ff_image)
+
+    if use_numba and (ff_image.ndim == 2):
+        return numba_kernels.deinterlace_even(ff_image, out)
+
+    return field_even_stack(ff_image, out=out)
 
 
 
 def blend_lighten(arr1, arr2):
     """ Blends two image array with lighen method (only takes the lighter pixel on each spot).
     """
-    arr1 = arr1.astype(np.int16)
-    temp = arr1 - arr2 #Subtract two arrays
-    temp[temp > 0] = 0 #Repace all >0 evements with 0
-    new_arr = arr1 - temp
-    new_arr = new_arr.astype(np.uint8)
-    return new_arr #Return "greater than" values
 
+    return np.maximum(arr1, arr2).astype(np.uint8) #Return "greater than" values
 
-def move_array_1up(array):
+
+def move_array_1up(array, out=None):
     """ Moves image array 1 pixel up, and fills the bottom with zeroes.
+
+    out: optional output array of the same shape, may be the input array itself
     """
-    array = np.delete(array, (0), axis=0)
-    array = np.vstack([array, np.zeros(len(array[0]), dtype = np.uint8)])
 
-    return array
+    if out is None:
+        out = np.empty_like(array)
+
+    out[:-1] = array[1:]
+    out[-1] = 0
+
+    return out
 
 
 
-def deinterlace_blend(image_array):
+def deinterlace_blend(image_array, out=None):
     """ Deinterlaces the image by making an odd and even frame, then blends them by lighten method.
+
+    out: optional uint8 output array of the same shape
     """
 
-    #image_odd_d = deinterlace_array_odd(image_array)
     image_odd_d = deinterlace_array_odd(image_array)
     image_even = deinterlace_array_even(image_array)
+
+    # Lighten blending of 8-bit images is just the maximum of each pixel
+    if (image_odd_d.dtype == np.uint8) and (image_even.dtype == np.uint8):
+        return np.maximum(image_odd_d, image_even, out=out)
+
     full_proc_image = blend_lighten(image_odd_d, image_even)
 
+    if out is not None:
+        out[...] = full_proc_image
+        return out
+
     return full_proc_image
 
 
+
+def field_odd_stack(img_stack, out=None):
+    """ Vectorized deinterlace_array_odd, which works on the last two axes, so it can process a whole stack of
+        frames at once. The output is identical to running deinterlace_array_odd on every frame.
+
+    out: optional output array of the same shape, may be img_stack itself
+    """
+
+    nrows = img_stack.shape[-2]
+
+    if out is None:
+        out = np.empty_like(img_stack)
+
+    # Every even row is kept, every odd row is replaced by the next even row, and the image is moved 1 row up
+    out[..., 0:nrows - 1:2, :] = img_stack[..., 0:nrows - 1:2, :]
+    out[..., 1:nrows - 1:2, :] = img_stack[..., 2:nrows:2, :]
+    out[..., nrows - 1, :] = 0
+
+    return out
+
+
+
+def field_even_stack(img_stack, out=None):
+    """ Vectorized deinterlace_array_even, which works on the last two axes, so it can process a whole stack of
+        frames at once. The output is identical to running deinterlace_array_even on every frame.
+
+    out: optional output array of the same shape, may be img_stack itself
+    """
+
+    nrows = img_stack.shape[-2]
+
+    # Rows are paired from the bottom of the image
+    parity = (nrows - 1)%2
+
+    if out is None:
+        out = np.empty_like(img_stack)
+
+    out[..., parity::2, :] = img_stack[..., parity::2, :]
+    out[..., 1 - parity::2, :] = img_stack[..., 2 - parity::2, :]
+
+    return out
+
+
+
+def getFieldSuffixes(data_type=1):
+    """ Returns the names of the first and the second field of each frame in the sequence returned by
+        buildFieldSequence. On Skypatrol data the odd rows hold the even field.
+
+    data_type: 1 CAMS, 2 Skypatrol, 3 RMS
+    """
+
+    if data_type == 2:
+        return "_Even", "_Odd"
+
+    return "_0dd", "_Even"
+
+
+
+def fieldRowMask(rows, frame_numbers, data_type=1, fields=None):
+    """ Returns a mask of the given image rows which are on the field of the detection with the given frame number,
+        for measuring detections made on half-frames (e.g. 105.0 and 105.5). As makeGIF labels them, the even field 
+        is at N.0 and the odd field at N.5, and getFieldSuffixes gives the rows of each field for the data type.
+
+    rows: (N detections, M pixels) array of row indices
+    frame_numbers: N frame numbers of the detections
+    data_type: 1 CAMS, 2 Skypatrol, 3 RMS
+    fields: True if the detections are on half-frames; if None, half-frames are assumed if any of the frame numbers 
+        is fractional, if False all rows are on the field
+    """
+
+    frame_numbers = np.asarray(frame_numbers, dtype=np.float64)
+    half_frames = (frame_numbers - np.floor(frame_numbers)) >= 0.25
+
+    if fields is None:
+        fields = np.any(frame_numbers != np.floor(frame_numbers))
+
+    if not fields:
+        return np.ones(np.shape(rows), dtype=bool)
+
+    # The first field of buildFieldSequence is on the rows 0, 2, 4...
+    odd_parity = 0 if getFieldSuffixes(data_type)[0].lower() in ("_0dd", "_odd") else 1
+
+    parity = np.where(half_frames, odd_parity, 1 - odd_parity)
+
+    return np.asarray(rows)%2 == parity[:, np.newaxis]
+
+
+
+def buildFieldSequence(ff, start_frame, end_frame, Flat_frame=None, Flat_frame_scalar=None, dark_frame=None,
+                       minv=None, gamma=None, maxv=None, no_background=False, chunk_pixels=2**24, bad_pixels=None):
+    """ Returns all fields (half-frames) from start_frame to end_frame as one uint8 array of shape (2*N, nrows, ncols).
+
+    Fields are ordered as [frame0 odd rows, frame0 even rows, frame1 odd rows, ...], the same order in which
+    makeGIF (perfield) and get_processed_frames save them. Use getFieldSuffixes to name them for a given data type.
+
+    ff: FF structure
+    start_frame: first frame
+    end_frame: last frame
+    Flat_frame: flat frame array (default None)
+    Flat_frame_scalar: flat frame median value (default None)
+    dark_frame: dark frame array (default None)
+    minv, gamma, maxv: levels adjustment applied to each frame (default None)
+    no_background: frames are built without avepixel as background if True (default False)
+    chunk_pixels: maximum number of pixels processed at once, keeps the memory bounded on large images
+    bad_pixels: bad_pixel_struct with the pixels to fill (default None)
+    """
+
+    nframes = end_frame - start_frame + 1
+
+    fields = np.empty(shape=(2*nframes, ff.nrows, ff.ncols), dtype=np.uint8)
+
+    chunk_size = max(1, int(chunk_pixels//(ff.nrows*ff.ncols)))
+
+    for chunk_start in range(start_frame, end_frame + 1, chunk_size):
+
+        chunk_end = min(chunk_start + chunk_size - 1, end_frame)
+
+        img_stack = buildFFStack(ff, chunk_start, chunk_end, videoFlag=True, no_background=no_background)
+
+        # Calibrate and adjust levels on all frames in the chunk at once
+        img_stack = process_array(img_stack, Flat_frame, Flat_frame_scalar, dark_frame, bad_pixels=bad_pixels)
+        img_stack = adjust_levels(img_stack, minv, gamma, maxv)
+
+        i = 2*(chunk_start - start_frame)
+        j = 2*(chunk_end - start_frame + 1)
+
+        field_odd_stack(img_stack, out=fields[i:j:2])
+        field_even_stack(img_stack, out=fields[i + 1:j:2])
+
+    return fields
+
+
 def makeGIF(FF_input, start_frame=0, end_frame =255, ff_dir = '.', deinterlace = True, print_name = True, 
             optimize = True, Flat_frame = None, Flat_frame_scalar = None, dark_frame = None, 
-            gif_name_parse = None, repeat = True, fps = 25, minv = None, gamma = None, maxv = None, perfield = False, data_type=1):
+            gif_name_parse = None, repeat = True, fps = 25, minv = None, gamma = None, maxv = None, perfield = False, data_type=1, 
+            bad_pixels = None, background_function = None):
     """ Makes a GIF animation for given FF_file, in given frame range (0-255).
 
     start_frame: Starting frame (default 0)
@@ -446,6 +919,9 @@ def makeGIF(FF_input, start_frame=0, end_frame =255, ff_dir = '.', deinterlace =
     maxv: levels adjustment maximum level (default None)
     perfield: if True, every frame will be split into an odd and even field (x2 more frames) (default False)
     data_type: 1 CAMS, 2 skypatrol,, 3 RMS
+    bad_pixels: bad_pixel_struct with the pixels to fill in every frame (default None)
+    background_function: function which returns the background image of the given FF file, used instead of 
+        avepixel, e.g. RollingBackground.getBackground (default None)
     """
 
     os.chdir(ff_dir)
@@ -473,22 +949,21 @@ def makeGIF(FF_input, start_frame=0, end_frame =255, ff_dir = '.', deinterlace =
 
         # Read FF bin
         ffBinRead = readFF(FF_file, datatype=data_type)
-        
-        for k in range(start_frame, end_frame+1):
-            img_array = buildFF(ffBinRead, k, videoFlag = True)
 
-            if perfield is True: #Disable deinterlace when "perfield" is on
-                deinterlace = False
+        if background_function is not None:
+            ffBinRead = replace_background(ffBinRead, background_function(os.path.abspath(FF_file)))
 
-            img_array = process_array(img_array, Flat_frame, Flat_frame_scalar, dark_frame, deinterlace) #Calibrate individual frames
+        # Every frame will be split into an odd and even field (x2 more frames)
+        if perfield is True:
 
-            img_array = adjust_levels(img_array, minv, gamma, maxv) #Adjust levels on individual frames
+            # Build all fields at once
+            fields = buildFieldSequence(ffBinRead, start_frame, end_frame, Flat_frame, Flat_frame_scalar,
+                dark_frame, minv, gamma, maxv, bad_pixels=bad_pixels)
 
-            # Every frame will be split into an odd and even field (x2 more frames)
             FF_file = FF_file.split(os.sep)[-1]
-            if perfield is True: 
-                odd_array = deinterlace_array_odd(img_array)
-                even_array = deinterlace_array_even(img_array)
+            for i, k in enumerate(range(start_frame, end_frame+1)):
+                odd_array = fields[2*i]
+                even_array = fields[2*i + 1]
 
                 # Add name
                 if print_name is True:
@@ -500,7 +975,17 @@ def makeGIF(FF_input, start_frame=0, end_frame =255, ff_dir = '.', deinterlace =
                 images.append(np.uint8(odd_array))
                 images.append(np.uint8(even_array))
 
-                continue
+            continue
+
+        for k in range(start_frame, end_frame+1):
+            img_array = buildFF(ffBinRead, k, videoFlag = True)
+
+            img_array = process_array(img_array, Flat_frame, Flat_frame_scalar, dark_frame, deinterlace, 
+                bad_pixels=bad_pixels) #Calibrate individual frames
+
+            img_array = adjust_levels(img_array, minv, gamma, maxv) #Adjust levels on individual frames
+
+            FF_file = FF_file.split(os.sep)[-1]
 
             # Add name
             if print_name is True:
@@ -639,20 +1124,13 @@ def make_night_GIF(night_dir, minimum_frames = 10):
 def fixFlat_frame(Flat_frame, Flat_frame_scalar):
     """ Makes a Flat_frame image by calculating Flat_frame value of every column, to prevent spots on the image.
     """
-    
-    nrows = len(Flat_frame)
-    ncols = len(Flat_frame[0])
 
-    col_Flat_frame = []
-    for j in range(ncols):
-        col_sum=[]
-        for i in range(nrows):
-            temp_lvl = Flat_frame[i][j]
-            if temp_lvl < Flat_frame_scalar*10:
-                col_sum.append(temp_lvl)
-        col_Flat_frame.append(np.median(col_sum))
+    Flat_frame = np.asarray(Flat_frame, dtype=np.float64)
+
+    # Median of each column, without the hot pixels
+    col_Flat_frame = np.nanmedian(np.where(Flat_frame < Flat_frame_scalar*10, Flat_frame, np.nan), axis=0)
 
-    return np.reshape(len(Flat_frame)*col_Flat_frame, (len(Flat_frame), len(Flat_frame[0])))
+    return np.tile(col_Flat_frame, (len(Flat_frame), 1))
 
 
 
@@ -665,6 +1143,27 @@ def add_scalar(array, scalar, min_clip = 0, max_clip = 255):
     
 
 
+def replace_background(ff, background):
+    """ Returns a copy of the FF structure with the given background image instead of its avepixel, e.g. a rolling
+        background of the night (see module_backgroundModel). The structure itself is not changed.
+    """
+
+    if background is None:
+        return ff
+
+    if background.shape != ff.avepixel.shape:
+        raise ValueError("Background size {} does not match the image size {}".format(background.shape, 
+            ff.avepixel.shape))
+
+    ff_copy = copy.copy(ff)
+
+    # Own copy, as buildFF stacks frames on avepixel
+    ff_copy.avepixel = np.array(background, dtype=ff.avepixel.dtype)
+
+    return ff_copy
+
+
+
 def max_nomean(ff_bin, Flat_frame = None, Flat_frame_scalar = None):
     """ Returns an array which represents maxpixel image with removed flat field and mean background, so just detections are visible.
     """
@@ -677,78 +1176,333 @@ def max_nomean(ff_bin, Flat_frame = None, Flat_frame_scalar = None):
     if Flat_frame is not None:
         img_max = np.subtract(img_max, Flat_frame) #Flat field correction of maxpixel image
 
-    img_max_noavg = deinterlace_blend(np.subtract(img_max, img_average))
+    # A background from other files can be brighter than maxpixel, so negative differences are clipped
+    img_max_noavg = deinterlace_blend(np.clip(img_max.astype(np.int16) - img_average, 0, 255).astype(np.uint8))
 
     return img_max_noavg
 
 
 
-def process_array(img_array, Flat_frame = None, Flat_frame_scalar = None, dark_frame = None, deinterlace = False, field = 0):
-    """ Processes given array with given frames. Used in CMN_binViewer.
+def significance_map(ff_bin, std_floor=2, threshold=0, sigma_scale=16):
+    """ Returns the signal to noise ratio of every pixel, (maxpixel - avepixel)/max(stdpixel, std_floor), as an 8-bit
+        image with sigma_scale levels per standard deviation. Sky gradients and twinkling stars, which are bright in
+        maxpixel but also in avepixel or stdpixel, are suppressed, so faint meteors stand out.
+
+    ff_bin: FF structure
+    std_floor: smallest standard deviation, keeps the ratio bounded on flat or saturated pixels
+    threshold: pixels with a smaller ratio (in standard deviations) are black (0 shows all pixels)
+    sigma_scale: image levels per standard deviation
     """
 
-    if dark_frame is not None:
-        img_array = np.subtract(img_array, dark_frame)
+    # maxpixel is never below avepixel, the ratio is computed in place in float32
+    snr = np.subtract(ff_bin.maxpixel, ff_bin.avepixel, dtype=np.float32)
+    snr /= np.maximum(ff_bin.stdpixel, std_floor, dtype=np.float32)
 
-    if Flat_frame is not None:
-        img_array = img_array.astype(float)
+    if threshold > 0:
+        snr[snr < threshold] = 0
 
-        Flat_frame[Flat_frame == 0] = 1
-        img_array = img_array / Flat_frame.astype(float)
-        img_array = np.multiply(img_array, Flat_frame_scalar)
+    snr *= sigma_scale
+    np.clip(snr, 0, 255, out=snr)
 
-    if (dark_frame is not None) or (Flat_frame is not None):
-        img_array = np.clip(img_array, 0, 255)
+    return snr.astype(np.uint8)
 
-    img_array = img_array.astype(np.uint8)
 
-    if field == 1:  #Odd field
-        img_array = deinterlace_array_odd(img_array)
-    elif field == 2:  #Even field
-        img_array = deinterlace_array_even(img_array)
 
-    if deinterlace is True:
-        img_array = deinterlace_blend(img_array)
+def getRowBands(nrows, bands):
+    """ Splits image rows into the given number of bands, returns a list of (start, end) tuples. Every band starts 
+        on an even row and has at least 2 rows, so the deinterlacing of a band with one extra row below it gives 
+        the same rows as the deinterlacing of the whole image.
+    """
 
+    step = max(2, 2*int(np.ceil(nrows/(2.0*bands))))
 
-    return img_array
+    row_bands = [(start, min(start + step, nrows)) for start in range(0, nrows, step)]
 
+    # Merge a single row leftover into the previous band
+    if (len(row_bands) > 1) and (row_bands[-1][1] - row_bands[-1][0] < 2):
+        row_bands[-2:] = [(row_bands[-2][0], nrows)]
 
-def get_processed_frames(ff_bin, save_path = '.', data_type=1, Flat_frame=None, Flat_frame_scalar=None, dark_frame=None, start_frame=0, end_frame=255, logsort_export=False, no_background=False):
-    """ Makes calibrated BMPs of a particular detection. Used for fireball processing.
+    return row_bands
 
-    ff_bin: *.bin file (or Skypatrol BMP) name and path
-    save_path: path where to save processed frames
-    data_type: 1 for CAMS (default), 2 for Skypatrol, 3 RMS
-    Flat_frame: flat frame array (load flat frame or make it)
-    Flat_frame_scalar: flat frame median value (load flat frame or make it)
-    dark_frame: dark frame array
-    start_frame: first frame to be taken
-    end_frame: last frame to be taken
-    logsort_export: images will be exported as 24 bit BMPs instead of 8 bit if True
-    no_background: images will be exported without background if True
+
+
+def useTiles(img_array):
+    """ Returns True if the image is large enough to be processed in row bands on multiple threads.
     """
 
-    # Make stack of frames on Skypatrol data
-    if data_type == 2:
-        array = readFF(ff_bin, data_type).maxpixel
-        nrows = len(array)
-        ncols = len(array[0])
-        skypatrol_stacked_image = np.zeros(shape=(nrows, ncols), dtype=np.uint)
+    return (tile_workers > 1) and (img_array.ndim >= 2) and (img_array.size >= tile_min_pixels)
 
-    # Read FF bin
-    ffBinRead = readFF(ff_bin, data_type)
 
-    image_list = []
 
-    for nframe in range(start_frame, end_frame+1):
+def runTiled(band_function, nrows, workers=None):
+    """ Calls band_function(start, end) for every row band on a thread pool and returns the list of results.
+    NumPy releases the GIL in most array operations, so the bands are processed in parallel.
 
-        frame_img = buildFF(ffBinRead, nframe, videoFlag = True, no_background = no_background) #Get individual frames
+    band_function: function which processes rows start:end
+    nrows: number of image rows
+    workers: number of threads (tile_workers by default)
+    """
 
-        # Calibrate individual frame
-        frame_img = process_array(frame_img, Flat_frame, Flat_frame_scalar, dark_frame)
+    if workers is None:
+        workers = tile_workers
+
+    row_bands = getRowBands(nrows, workers)
+
+    if (workers < 2) or (len(row_bands) < 2):
+        return [band_function(start, end) for start, end in row_bands]
+
+    if workers not in tile_pools:
+        tile_pools[workers] = ThreadPool(workers)
+
+    return tile_pools[workers].map(lambda band: band_function(*band), row_bands)
+
+
+
+def process_array_tiled(img_array, Flat_frame = None, Flat_frame_scalar = None, dark_frame = None, deinterlace = False, 
+    field = 0, workers = None):
+    """ Same as process_array, but the image is processed in row bands on multiple threads. The output is identical.
+
+    workers: number of threads (tile_workers by default)
+    """
+
+    dark_int16, flat_gain = getCalibrationArrays(dark_frame, Flat_frame, Flat_frame_scalar)
+
+    # Both a field and deinterlacing would need a deeper overlap, this is not used in the viewer
+    if (field != 0) and (deinterlace is True):
+        return _process_array(img_array, dark_int16, flat_gain, deinterlace, field)
+
+    nrows = img_array.shape[0]
+    processed_array = np.empty(img_array.shape, dtype=np.uint8)
+
+    def processBand(start, end):
+        """ Calibrates and deinterlaces rows start:end. """
+
+        # The odd field of the last band row is taken from the next row, so one extra row is calibrated
+        halo_end = min(end + 1, nrows)
+
+        # The even field keeps the rows of the same parity as the last image row, the band has to end on one
+        if (nrows - end) % 2 == 0:
+            even_end = end
+        else:
+            even_end = halo_end
+
+        band_slice = slice(start, halo_end)
+
+        band_array = _process_array(img_array[band_slice], 
+            dark_int16[band_slice] if dark_int16 is not None else None, 
+            flat_gain[band_slice] if flat_gain is not None else None)
+
+        if field == 1:
+            band_array = deinterlace_array_odd(band_array)
+
+        elif field == 2:
+            band_array = deinterlace_array_even(band_array[:even_end - start])
+
+        elif deinterlace is True:
+            # Calibrated bands are 8-bit, so lighten blending is the maximum of each pixel
+            band_array = np.maximum(deinterlace_array_odd(band_array)[:end - start], 
+                deinterlace_array_even(band_array[:even_end - start])[:end - start])
+
+        processed_array[start:end] = band_array[:end - start]
+
+    runTiled(processBand, nrows, workers)
+
+    return processed_array
+
+
+
+def process_array(img_array, Flat_frame = None, Flat_frame_scalar = None, dark_frame = None, deinterlace = False, field = 0, 
+    bad_pixels = None):
+    """ Processes given array with given frames. Used in CMN_binViewer. Bad pixels (bad_pixel_struct) are filled 
+        before the calibration, see fill_bad_pixels.
+    """
+
+    if bad_pixels is not None:
+        img_array = fill_bad_pixels(img_array, bad_pixels)
+
+    if useTiles(img_array) and (img_array.ndim == 2):
+        return process_array_tiled(img_array, Flat_frame, Flat_frame_scalar, dark_frame, deinterlace, field)
+
+    dark_int16, flat_gain = getCalibrationArrays(dark_frame, Flat_frame, Flat_frame_scalar)
+
+    return _process_array(img_array, dark_int16, flat_gain, deinterlace, field)
+
+
+
+def getCalibrationArrays(dark_frame = None, Flat_frame = None, Flat_frame_scalar = None):
+    """ Returns the dark frame as int16 and the flat gain (Flat_frame_scalar/Flat_frame in float32, zeroes in the 
+        flat replaced by 1) used by calibrate_array, or None for the frames which are not given. Frames loaded with 
+        getCalibrationFrame already have them, for other frames they are computed once and kept until different 
+        frames are given. The given frames are not modified.
+    """
+
+    dark_int16 = None
+    flat_gain = None
+
+    with calibration_cache_lock:
+        cached_frames = list(calibration_cache.values())
+
+    if dark_frame is not None:
+
+        for calibration in cached_frames:
+            if calibration.dark_frame is dark_frame:
+                dark_int16 = calibration.dark_int16
+                break
+
+        else:
+            if calibration_arrays.get('dark_frame') is not dark_frame:
+                calibration_arrays['dark_frame'] = dark_frame
+                calibration_arrays['dark_int16'] = np.asarray(dark_frame).astype(np.int16)
+
+            dark_int16 = calibration_arrays['dark_int16']
+
+    if Flat_frame is not None:
+
+        for calibration in cached_frames:
+            if (calibration.Flat_frame is Flat_frame) and (calibration.Flat_frame_scalar == Flat_frame_scalar):
+                flat_gain = calibration.flat_gain
+                break
+
+        else:
+            if (calibration_arrays.get('Flat_frame') is not Flat_frame) or \
+                (calibration_arrays.get('Flat_frame_scalar') != Flat_frame_scalar):
+
+                calibration_arrays['Flat_frame'] = Flat_frame
+                calibration_arrays['Flat_frame_scalar'] = Flat_frame_scalar
+                calibration_arrays['flat_gain'] = Flat_frame_scalar/np.where(Flat_frame == 0, 1, 
+                    Flat_frame).astype(np.float32)
+
+            flat_gain = calibration_arrays['flat_gain']
+
+    return dark_int16, flat_gain
+
+
+
+def getScratchBuffer(shape, dtype=np.float32):
+    """ Returns a scratch array of the given shape and type. The array is preallocated once per thread and reused 
+        by every following call, so its content is only valid until the next call from the same thread.
+    """
+
+    if not hasattr(scratch_buffers, 'buffers'):
+        scratch_buffers.buffers = {}
+
+    buffer_key = (tuple(shape), np.dtype(dtype).str)
+
+    if buffer_key not in scratch_buffers.buffers:
+
+        # Keep only a few image sizes around
+        if len(scratch_buffers.buffers) >= 4:
+            scratch_buffers.buffers.clear()
+
+        scratch_buffers.buffers[buffer_key] = np.empty(shape, dtype=dtype)
+
+    return scratch_buffers.buffers[buffer_key]
+
+
+
+def calibrate_array(img_array, dark_int16 = None, flat_gain = None, out = None):
+    """ Dark and flat field correction of an image: (img_array - dark)*flat_gain, clipped to 0-255 and converted 
+        to uint8. Computed in float32, in one pass with the numba kernel, otherwise in a preallocated scratch 
+        buffer. The inputs are never modified.
+
+    img_array: 2D image or a stack of images of shape (N, nrows, ncols)
+    dark_int16: dark frame as int16 (None for no dark correction)
+    flat_gain: flat gain array from getCalibrationArrays (None for no flat correction)
+    out: optional uint8 output array of the same shape as img_array
+    """
+
+    if out is None:
+        out = np.empty(img_array.shape, dtype=np.uint8)
+
+    # Stacks are calibrated frame by frame, so the scratch buffer is not larger than one image
+    if img_array.ndim == 3:
+        for i in range(len(img_array)):
+            calibrate_array(img_array[i], dark_int16, flat_gain, out[i])
+
+        return out
+
+    if use_numba:
+        return numba_kernels.calibrate(img_array, dark_int16, flat_gain, out)
+
+    scratch = getScratchBuffer(img_array.shape)
+
+    if dark_int16 is not None:
+        np.subtract(img_array, dark_int16, out=scratch, dtype=np.float32, casting='unsafe')
+    else:
+        np.copyto(scratch, img_array, casting='unsafe')
+
+    if flat_gain is not None:
+        np.multiply(scratch, flat_gain, out=scratch)
+
+    np.clip(scratch, 0, 255, out=scratch)
+    np.copyto(out, scratch, casting='unsafe')
+
+    return out
+
+
+
+def _process_array(img_array, dark_int16 = None, flat_gain = None, deinterlace = False, field = 0):
+    """ Single threaded process_array, with calibration arrays from getCalibrationArrays.
+    """
+
+    if (dark_int16 is not None) or (flat_gain is not None):
+        img_array = calibrate_array(img_array, dark_int16, flat_gain)
+
+    else:
+        img_array = img_array.astype(np.uint8)
+
+    if field == 1:  #Odd field
+        img_array = deinterlace_array_odd(img_array)
+    elif field == 2:  #Even field
+        img_array = deinterlace_array_even(img_array)
+
+    if deinterlace is True:
+        img_array = deinterlace_blend(img_array)
+
+
+    return img_array
+
+
+def get_processed_frames(ff_bin, save_path = '.', data_type=1, Flat_frame=None, Flat_frame_scalar=None, dark_frame=None, start_frame=0, end_frame=255, logsort_export=False, no_background=False, bad_pixels=None, background=None):
+    """ Makes calibrated BMPs of a particular detection. Used for fireball processing.
+
+    ff_bin: *.bin file (or Skypatrol BMP) name and path
+    save_path: path where to save processed frames
+    data_type: 1 for CAMS (default), 2 for Skypatrol, 3 RMS
+    Flat_frame: flat frame array (load flat frame or make it)
+    Flat_frame_scalar: flat frame median value (load flat frame or make it)
+    dark_frame: dark frame array
+    start_frame: first frame to be taken
+    end_frame: last frame to be taken
+    logsort_export: images will be exported as 24 bit BMPs instead of 8 bit if True
+    no_background: images will be exported without background if True
+    bad_pixels: bad_pixel_struct with the pixels to fill (default None)
+    background: background image used instead of avepixel, e.g. a rolling background (default None)
+    """
+
+    # Make stack of frames on Skypatrol data
+    if data_type == 2:
+        array = readFF(ff_bin, data_type).maxpixel
+        nrows = len(array)
+        ncols = len(array[0])
+        skypatrol_stacked_image = np.zeros(shape=(nrows, ncols), dtype=np.uint8)
+
+    # Read FF bin
+    ffBinRead = replace_background(readFF(ff_bin, data_type), background)
+
+    image_list = []
+
+    ff_bin_name = ff_bin.split(os.sep)[-1]
+
+    # Build all calibrated fields at once
+    fields = buildFieldSequence(ffBinRead, start_frame, end_frame, Flat_frame, Flat_frame_scalar, dark_frame,
+        no_background=no_background, bad_pixels=bad_pixels)
+
+    # Skypatrol data type has a reverse order of fields
+    first_suffix, second_suffix = getFieldSuffixes(data_type)
+
+    for i, nframe in enumerate(range(start_frame, end_frame+1)):
 
-        ff_bin_name = ff_bin.split(os.sep)[-1]
         #if logsort_export:
         #    img_name_prefix = str(nframe).zfill(4)
         #else:
@@ -756,31 +1510,18 @@ def get_processed_frames(ff_bin, save_path = '.', data_type=1, Flat_frame=None,
 
         img_path_prefix = os.path.join(save_path, img_name_prefix)
 
-        # CAMS data type
-        if (data_type == 1) or (data_type == 3):
-            odd_frame_img = deinterlace_array_odd(frame_img)
-            saveImage(odd_frame_img, img_path_prefix+"_0dd.bmp", print_name = False, bmp_24bit = logsort_export)
-            image_list.append(img_name_prefix+"_0dd.bmp")
+        odd_frame_img = fields[2*i]
+        saveImage(odd_frame_img, img_path_prefix+first_suffix+".bmp", print_name = False, bmp_24bit = logsort_export)
+        image_list.append(img_name_prefix+first_suffix+".bmp")
 
-            even_frame_img = deinterlace_array_even(frame_img)
-            saveImage(even_frame_img, img_path_prefix+"_Even.bmp", print_name = False, bmp_24bit = logsort_export)
-            image_list.append(img_name_prefix+"_Even.bmp")
-
-        else:
-            #Skypatrol data type (reverse order or frames)
-
-            odd_frame_img = deinterlace_array_odd(frame_img)
-            saveImage(odd_frame_img, img_path_prefix+"_Even.bmp", print_name = False, bmp_24bit = logsort_export)
-            image_list.append(img_name_prefix+"_Even.bmp")
+        even_frame_img = fields[2*i + 1]
+        saveImage(even_frame_img, img_path_prefix+second_suffix+".bmp", print_name = False, bmp_24bit = logsort_export)
+        image_list.append(img_name_prefix+second_suffix+".bmp")
 
+        if data_type == 2:
             skypatrol_stacked_image = blend_lighten(skypatrol_stacked_image, odd_frame_img)
-
-            even_frame_img = deinterlace_array_even(frame_img)
-            saveImage(even_frame_img, img_path_prefix+"_Odd.bmp", print_name = False, bmp_24bit = logsort_export)
-            image_list.append(img_name_prefix+"_Odd.bmp")
-
-            skypatrol_stacked_image = np.subtract(skypatrol_stacked_image, even_frame_img)
-            skypatrol_stacked_image = np.clip(skypatrol_stacked_image, 0, 255)
+            skypatrol_stacked_image = np.clip(np.subtract(skypatrol_stacked_image, even_frame_img, dtype=np.int16), 
+                0, 255).astype(np.uint8)
 
     # Make stack of frames on Skypatrol data
     if data_type == 2:
@@ -790,7 +1531,7 @@ def get_processed_frames(ff_bin, save_path = '.', data_type=1, Flat_frame=None,
 
             
 
-def get_detection_only(ff_content, start_frame = 0, end_frame = 255, Flat_frame = None, Flat_frame_scalar = None, dark_frame = None, deinterlace = False):
+def get_detection_only(ff_content, start_frame = 0, end_frame = 255, Flat_frame = None, Flat_frame_scalar = None, dark_frame = None, deinterlace = False, bad_pixels = None):
     """ Return an array which contains only the detection frames, lighten blended.
 
     ff_content: ff file structure
@@ -799,6 +1540,7 @@ def get_detection_only(ff_content, start_frame = 0, end_frame = 255, Flat_frame
     Flat_frame: flat frame array (load flat frame or make it) (default None)
     Flat_frame_scalar: flat frame median value (load flat frame or make it) (defualt None)
     dark_frame: dark frame (default None)
+    bad_pixels: bad_pixel_struct with the pixels to fill (default None)
     """
     
     for nframe in range(start_frame, end_frame+1):
@@ -808,7 +1550,7 @@ def get_detection_only(ff_content, start_frame = 0, end_frame = 255, Flat_frame
         frame_img = frame_img * ff_content.adjustment_scalar
         frame_img = np.clip(frame_img, 0, 255)
 
-    frame_img = process_array(frame_img, Flat_frame, Flat_frame_scalar, dark_frame, deinterlace)
+    frame_img = process_array(frame_img, Flat_frame, Flat_frame_scalar, dark_frame, deinterlace, bad_pixels=bad_pixels)
         
     return frame_img
 
@@ -835,45 +1577,443 @@ def blend_average(*args):
 
 
 
-@np.vectorize
-def blend_median(*args):
-    """ Blends images by taking the median of each pixel.
+def median_stack(img_stack):
+    """ Blends a stack of images of shape (N, nrows, ncols) by taking the exact median of each pixel, the same as 
+        np.median(img_stack, axis=0). For an odd number of images the median has the type of the images, for an 
+        even number it is the mean of the two middle values, in float64.
     """
-    sort = sorted(args)
-    sort_len = len(sort)
 
-    if sort_len == 1:
-        return sort[0]
+    img_num = len(img_stack)
 
-    elif sort_len == 2:
-        return (sort[0] + sort[1])/2
+    if img_num == 1:
+        return np.copy(img_stack[0])
 
-    middle = int(sort_len/2)
-    
-    return sort[middle]
+    elif img_num == 2:
+        return (img_stack[0].astype(np.float64) + img_stack[1])/2
+
+    if use_numba:
+        out = np.empty(img_stack.shape[1:], dtype=(img_stack.dtype if img_num%2 else np.float64))
+
+        # Counting pixel levels is faster than sorting for big 8-bit stacks
+        if (img_stack.dtype == np.uint8) and (img_num > 32):
+            return numba_kernels.median_stack_uint8(img_stack, out)
+
+        return numba_kernels.median_stack(img_stack, out)
+
+    middle = img_num//2
+
+    if img_num%2:
+        return np.partition(img_stack, middle, axis=0)[middle]
+
+    img_stack = np.partition(img_stack, (middle - 1, middle), axis=0)
+
+    return (img_stack[middle - 1].astype(np.float64) + img_stack[middle])/2
+
+
+
+def read_stack_frame(file_path, dark_frame=None, data_type=1):
+    """ Returns the avepixel of the given FF file minus the dark frame, as an uint8 array. Used by stack_frames.
+    """
+
+    avepixel = readFF(file_path, datatype=data_type).avepixel
+
+    if dark_frame is None:
+        return np.asarray(avepixel, dtype=np.uint8)
+
+    return np.clip(avepixel.astype(np.int16) - dark_frame, 0, 255).astype(np.uint8)
+
+
+
+def stack_frames(file_list, mode='median', dark_frame=None, data_type=1, workers=None, memory_limit=None):
+    """ Stacks the avepixel images of the given FF files (minus the dark frame) into one image, by taking the exact
+        median (the same as median_stack), the mean or the minimum of each pixel. Files are read in parallel into
+        an uint8 stack, which is kept in a temporary file if it is larger than the memory limit, and the stack
+        is reduced in row tiles, so the memory use does not depend on the number of files.
+
+    file_list: list of FF file paths
+    mode: 'median', 'mean' or 'min'
+    dark_frame: dark frame subtracted from every image (None to skip)
+    data_type: 1 CAMS, 2 skypatrol, 3 RMS
+    workers: number of reading threads (tile_workers by default)
+    memory_limit: memory used for the stack and its row tiles in bytes (stack_memory_limit by default)
+    """
+
+    if mode not in ('median', 'mean', 'min'):
+        raise ValueError("Unknown stacking mode: " + str(mode))
+
+    if workers is None:
+        workers = tile_workers
+
+    if memory_limit is None:
+        memory_limit = stack_memory_limit
+
+    if dark_frame is not None:
+        dark_frame = np.asarray(dark_frame).astype(np.int16)
+
+    first_frame = read_stack_frame(file_list[0], dark_frame, data_type)
+    nrows, ncols = first_frame.shape
+    img_num = len(file_list)
+
+    # Keep big stacks on the disk
+    stack_file = None
+    if img_num*nrows*ncols > memory_limit:
+        stack_file = tempfile.TemporaryFile()
+        img_stack = np.memmap(stack_file, dtype=np.uint8, mode='w+', shape=(img_num, nrows, ncols))
+
+    else:
+        img_stack = np.empty((img_num, nrows, ncols), dtype=np.uint8)
+
+    img_stack[0] = first_frame
+
+    def readFrame(i):
+        img_stack[i] = read_stack_frame(file_list[i], dark_frame, data_type)
+
+    if (workers > 1) and (img_num > 2):
+        if workers not in tile_pools:
+            tile_pools[workers] = ThreadPool(workers)
+
+        tile_pools[workers].map(readFrame, range(1, img_num))
+
+    else:
+        for i in range(1, img_num):
+            readFrame(i)
+
+    # Rows per tile, a tile is copied a few times while it is reduced
+    tile_rows = int(max(1, min(nrows, memory_limit/(4*img_num*ncols))))
+
+    # The median of an even number of images is the mean of the two middle values
+    if (mode == 'median') and (img_num%2 == 0):
+        stacked_frame = np.empty((nrows, ncols), dtype=np.float64)
+    elif mode == 'mean':
+        stacked_frame = np.empty((nrows, ncols), dtype=np.float64)
+    else:
+        stacked_frame = np.empty((nrows, ncols), dtype=np.uint8)
+
+    for start in range(0, nrows, tile_rows):
+
+        tile = np.array(img_stack[:, start:start + tile_rows])
+
+        if mode == 'median':
+            stacked_frame[start:start + tile_rows] = median_stack(tile)
+
+        elif mode == 'mean':
+            stacked_frame[start:start + tile_rows] = np.mean(tile, axis=0)
+
+        else:
+            stacked_frame[start:start + tile_rows] = np.min(tile, axis=0)
+
+    if stack_file is not None:
+        del img_stack
+        stack_file.close()
+
+    return stacked_frame
+
+
+
+class welford_struct:
+    """ Running per-pixel statistics (Welford's algorithm) of a stream of images, see welford_update.
+    """
+    def __init__(self, shape):
+
+        # Number of accumulated values of each pixel
+        self.count = np.zeros(shape, dtype=np.int32)
+
+        # Running mean and sum of squared differences from the mean
+        self.mean = np.zeros(shape, dtype=np.float64)
+        self.m2 = np.zeros(shape, dtype=np.float64)
+
+
+    def std(self):
+        """ Returns the standard deviation of each pixel (0 if there are less than 2 values). """
+
+        return np.sqrt(self.m2/np.maximum(self.count - 1, 1))
+
+
+
+def welford_update(stats, img_array, mask=None):
+    """ Adds an image to the running statistics in welford_struct.
+
+    stats: welford_struct
+    img_array: image of the same shape
+    mask: boolean array of the pixels which are added (None to add all pixels)
+    """
+
+    img_array = np.asarray(img_array, dtype=np.float64)
+
+    if mask is None:
+        stats.count += 1
+        delta = img_array - stats.mean
+        stats.mean += delta/stats.count
+        stats.m2 += delta*(img_array - stats.mean)
+
+    else:
+        stats.count += mask
+        delta = np.where(mask, img_array - stats.mean, 0)
+        stats.mean += delta/np.maximum(stats.count, 1)
+        stats.m2 += delta*(img_array - stats.mean)
+
+
+
+def iterate_stack_frames(file_list, dark_frame=None, data_type=1, workers=None):
+    """ Yields the avepixel images of the given FF files minus the dark frame (see read_stack_frame) in the order 
+        of file_list, reading a few files ahead on the tile thread pool.
+    """
+
+    if dark_frame is not None:
+        dark_frame = np.asarray(dark_frame).astype(np.int16)
+
+    return iterate_files(lambda file_path: read_stack_frame(file_path, dark_frame, data_type), file_list, workers)
+
+
+
+def iterate_files(read_function, file_list, workers=None):
+    """ Yields read_function(file_path) for every file in file_list, in order, reading a few files ahead on the 
+        tile thread pool.
+    """
+
+    if workers is None:
+        workers = tile_workers
+
+    if workers < 2:
+        for file_path in file_list:
+            yield read_function(file_path)
+
+        return
+
+    if workers not in tile_pools:
+        tile_pools[workers] = ThreadPool(workers)
+
+    # Read in chunks, so only a few files are in memory at once
+    for start in range(0, len(file_list), 2*workers):
+        for result in tile_pools[workers].map(read_function, file_list[start:start + 2*workers]):
+            yield result
+
+
+
+def sigma_clipped_stack(file_list, dark_frame=None, data_type=1, sigma=3.0, iterations=2, workers=None):
+    """ Returns the sigma clipped mean and standard deviation (float32) of the avepixel images of the given FF files
+        and the number of values used for each pixel. The first pass computes the mean and standard deviation of
+        all images, every following pass computes them again from the values within sigma standard deviations of
+        the previous ones. Only the running statistics are kept in memory, so any number of files can be used.
+
+    file_list: list of FF file paths
+    dark_frame: dark frame subtracted from every image (None to skip)
+    data_type: 1 CAMS, 2 skypatrol, 3 RMS
+    sigma: clipping limit in standard deviations
+    iterations: number of clipping passes, 1 gives a two-pass clipped mean (stops sooner if the number of used
+        values does not change)
+    workers: number of reading threads (tile_workers by default)
+    """
+
+    stats = None
+
+    for img_array in iterate_stack_frames(file_list, dark_frame, data_type, workers):
+        if stats is None:
+            stats = welford_struct(img_array.shape)
+
+        welford_update(stats, img_array)
+
+    for _ in range(iterations):
+
+        mean, limit = stats.mean, sigma*stats.std()
+        clipped_stats = welford_struct(mean.shape)
+
+        for img_array in iterate_stack_frames(file_list, dark_frame, data_type, workers):
+            welford_update(clipped_stats, img_array, np.abs(img_array - mean) <= limit)
+
+        converged = np.array_equal(clipped_stats.count, stats.count)
+
+        # Keep the previous statistics for pixels with no values within the limits
+        empty = clipped_stats.count == 0
+        if np.any(empty):
+            clipped_stats.count[empty] = stats.count[empty]
+            clipped_stats.mean[empty] = stats.mean[empty]
+            clipped_stats.m2[empty] = stats.m2[empty]
+
+        stats = clipped_stats
+
+        if converged:
+            break
+
+    return stats.mean.astype(np.float32), stats.std().astype(np.float32), stats.count
+
+
+
+def localMedian(img_array, chunk_pixels=2**20):
+    """ Returns the median of the 3x3 neighbourhood (edges repeated) of every pixel. The image is processed in row 
+        bands, so only the 9 neighbours of chunk_pixels pixels are kept in memory at once.
+    """
+
+    padded = np.pad(img_array, 1, mode='edge')
+    nrows, ncols = img_array.shape
+
+    median_array = np.empty(img_array.shape, dtype=img_array.dtype)
+
+    band_rows = int(max(1, chunk_pixels//ncols))
+
+    for start in range(0, nrows, band_rows):
 
+        end = min(start + band_rows, nrows)
 
+        # The 9 neighbours of the band, in the type of the image
+        shifted = np.empty((9, end - start, ncols), dtype=img_array.dtype)
 
-def chop_flat_processes(img_num, step = 31):
-    """ Gives a tuple of ranges to chop the flat field arrays if there are more than 32 of them. For img_num = 70, it would return [(0, 32), (32, 64), (64, 70)]
+        for k in range(9):
+            i, j = divmod(k, 3)
+            shifted[k] = padded[start + i:end + i, j:j + ncols]
+
+        # The median of 9 values is the 5th smallest
+        median_array[start:end] = np.partition(shifted, 4, axis=0)[4]
+
+    return median_array
+
+
+
+def find_bad_pixels(file_list, data_type=1, sigma=6.0, min_level=10, workers=None):
+    """ Finds hot and dead pixels from the temporal mean of avepixel and stdpixel over the given FF files (e.g. of 
+        one or more nights), accumulated one file at a time. A pixel is hot if its mean avepixel or stdpixel is 
+        above the median of its neighbours by more than sigma robust standard deviations (and at least min_level),
+        and dead if its mean avepixel is that much below it, or if it does not change while its neighbours do.
+        Returns a bad_pixel_struct.
+
+    file_list: list of FF file paths
+    data_type: 1 CAMS, 2 skypatrol, 3 RMS
+    sigma: detection limit in robust standard deviations of the differences from the neighbours
+    min_level: minimum difference from the neighbours
+    workers: number of reading threads (tile_workers by default)
+    """
+
+    ave_stats = None
+    std_stats = None
+
+    def readStatistics(file_path):
+        """ Returns the avepixel and stdpixel of the FF file. """
+
+        ff = readFF(file_path, datatype=data_type)
+
+        return ff.avepixel, ff.stdpixel
+
+    for avepixel, stdpixel in iterate_files(readStatistics, file_list, workers):
+
+        if ave_stats is None:
+            ave_stats = welford_struct(avepixel.shape)
+            std_stats = welford_struct(avepixel.shape)
+
+        welford_update(ave_stats, avepixel)
+        welford_update(std_stats, stdpixel)
+
+    def excess(mean):
+        """ Returns the differences from the neighbours and their limit. """
+
+        diff = mean - localMedian(mean)
+        robust_std = 1.4826*np.median(np.abs(diff - np.median(diff)))
+
+        return diff, max(sigma*robust_std, min_level)
+
+    ave_diff, ave_limit = excess(ave_stats.mean)
+    std_diff, std_limit = excess(std_stats.mean)
+
+    hot = (ave_diff > ave_limit) | (std_diff > std_limit)
+    dead = ((ave_diff < -ave_limit) | ((std_stats.mean < 0.5) & (std_stats.mean - std_diff >= 2))) & ~hot
+
+    rows, cols = np.nonzero(hot | dead)
+
+    return bad_pixel_struct(ave_stats.mean.shape, rows, cols, hot[rows, cols])
+
+
+
+def save_bad_pixels(bad_pixels, file_path):
+    """ Saves the bad pixels into a compressed NPZ file with their coordinates.
+    """
+
+    np.savez_compressed(file_path, shape=np.array(bad_pixels.shape), rows=bad_pixels.rows.astype(np.uint16), 
+        cols=bad_pixels.cols.astype(np.uint16), hot=bad_pixels.hot)
+
+
+
+def load_bad_pixels(file_path):
+    """ Loads the bad pixels saved with save_bad_pixels. Each file is loaded only once, see getCalibrationFrame.
     """
-    ranges_list = []
-    old = 0
-    for i in range(step, img_num, step):
-        ranges_list.append((old, i))
-        old = i
-    ranges_list.append((old, img_num))
-    return ranges_list
 
+    return getCalibrationFrame(file_path, 'badpixels').bad_pixels
 
 
-def make_flat_frame(flat_dir, flat_save = 'flat.bmp', col_corrected = False, dark_frame = None, data_type=1):
+
+def getBadPixelNeighbours(bad_pixels):
+    """ Returns the rows, columns and validity of the 8 neighbours of each bad pixel as (K, 8) arrays. Neighbours
+        outside the image or bad themselves are not valid.
+    """
+
+    if bad_pixels.neighbours is None:
+
+        dy = np.array([-1, -1, -1, 0, 0, 1, 1, 1])
+        dx = np.array([-1, 0, 1, -1, 1, -1, 0, 1])
+
+        rows = bad_pixels.rows[:, np.newaxis] + dy
+        cols = bad_pixels.cols[:, np.newaxis] + dx
+
+        nrows, ncols = bad_pixels.shape
+        valid = (rows >= 0) & (rows < nrows) & (cols >= 0) & (cols < ncols)
+
+        rows = np.clip(rows, 0, nrows - 1)
+        cols = np.clip(cols, 0, ncols - 1)
+
+        bad_mask = np.zeros(bad_pixels.shape, dtype=bool)
+        bad_mask[bad_pixels.rows, bad_pixels.cols] = True
+        valid &= ~bad_mask[rows, cols]
+
+        bad_pixels.neighbours = (rows, cols, valid)
+
+    return bad_pixels.neighbours
+
+
+
+def fill_bad_pixels(img_array, bad_pixels):
+    """ Returns a copy of the image (or a stack of images) with every bad pixel replaced by the median of its good
+        neighbours. Pixels without good neighbours are not changed.
+
+    img_array: image of shape (nrows, ncols) or a stack of shape (N, nrows, ncols)
+    bad_pixels: bad_pixel_struct of the same image size
+    """
+
+    if tuple(img_array.shape[-2:]) != bad_pixels.shape:
+        raise ValueError("Bad pixel mask size {} does not match the image size {}".format(bad_pixels.shape, 
+            img_array.shape[-2:]))
+
+    img_array = np.array(img_array)
+
+    if len(bad_pixels.rows) == 0:
+        return img_array
+
+    rows, cols, valid = getBadPixelNeighbours(bad_pixels)
+
+    # Neighbour values of shape (..., K, 8), bad and outside neighbours are ignored
+    neighbour_values = np.where(valid, img_array[..., rows, cols], np.nan)
+
+    fillable = np.any(valid, axis=1)
+
+    with np.errstate(all='ignore'):
+        medians = np.nanmedian(neighbour_values[..., fillable, :], axis=-1)
+
+    if img_array.dtype.kind in 'ui':
+        medians = np.round(medians)
+
+    img_array[..., bad_pixels.rows[fillable], bad_pixels.cols[fillable]] = medians.astype(img_array.dtype)
+
+    return img_array
+
+
+
+def make_flat_frame(flat_dir, flat_save = 'flat.bmp', col_corrected = False, dark_frame = None, data_type=1, 
+    stack_mode = 'median'):
     """ Return a flat frame array and flat frame median value. Makes a flat frame by comparing given images and taking the minimum value on a given position of all images.
 
     flat_dir: directory where FF*.bin files are held
     flat_save: name of file to be saved, dave directory is flat_dir (default: flat.bmp)
     dark_frame: array which contains dark frame (None by default, then it is read from the folder, if it exists)
     data_type: 1 CAMS, 2 skypatrol, 3 RMS
+    stack_mode: 'median' (default), 'mean' or 'min', see stack_frames, or 'clipped' for the sigma clipped mean 
+        (see sigma_clipped_stack), which is also saved with full precision into a float32 FITS file
     Lines can be vertically averaged by col_corrected = True (default)"""
 
     # I assume CAMS creates FF.bin files, but RMS creates FF.fits ones
@@ -882,7 +2022,6 @@ def make_flat_frame(flat_dir, flat_save = 'flat.bmp', col_corrected = False, dar
         filetype = 'fits'
 
     flat_raw = [os.path.join(flat_dir, line) for line in os.listdir(flat_dir) if ('FF' in line) and (line.split('.')[-1] == filetype)]
-    flat_arrays = []
     try:
         first_raw = flat_raw[0]
     except:
@@ -902,37 +2041,15 @@ def make_flat_frame(flat_dir, flat_save = 'flat.bmp', col_corrected = False, dar
             dark_frame = load_dark(flat_dir + 'dark.bmp')
 
         except:
-            dark_frame = np.zeros(shape=(nrows, ncols), dtype=np.uint) 
+            dark_frame = np.zeros(shape=(nrows, ncols), dtype=np.uint8) 
 
     elif isinstance(dark_frame, bool):
-        dark_frame = np.zeros(shape=(nrows, ncols), dtype=np.uint) 
-
-    for line in flat_raw:
+        dark_frame = np.zeros(shape=(nrows, ncols), dtype=np.uint8) 
 
-        flat_temp = readFF(line, datatype=data_type).avepixel
-        flat_temp = np.subtract(flat_temp, dark_frame)
-        flat_temp = np.clip(flat_temp, 0, 255)
-
-        flat_arrays.append(flat_temp)
-
-    #Flat_frame = flat_arrays[0]
-
-    #for flat_array in flat_arrays:
-        #Flat_frame = blend_darken(Flat_frame, flat_array) #Darken flat
-        #Flat_frame = blend_average(Flat_frame, flat_array) #Average flat
-    
-    #Handle the problem when there are more than 32 images (numpy's vectorize function can't recieve more than 32 arguments)
-    if len(flat_arrays) > 32:
-        temp_arrays = []
-        for start, end in chop_flat_processes(len(flat_arrays)):
-            temp_arrays.append(blend_median(*flat_arrays[start:end]))
-
-        Flat_frame = blend_median(*temp_arrays)
-
-    elif len(flat_arrays) > 1024:
-        log.info('No more than 1024 images can be processed into a flat field!!!')
+    if stack_mode == 'clipped':
+        Flat_frame = sigma_clipped_stack(flat_raw, dark_frame, data_type)[0]
     else:
-        Flat_frame = blend_median(*flat_arrays) #Median
+        Flat_frame = stack_frames(flat_raw, stack_mode, dark_frame, data_type)
 
     Flat_frame_scalar = int(np.median(Flat_frame)) #Calculate the median value of Flat_frame image to correct the final image
 
@@ -943,6 +2060,13 @@ def make_flat_frame(flat_dir, flat_save = 'flat.bmp', col_corrected = False, dar
         flat_save = os.path.join(flat_dir, flat_save)
 
     saveImage(Flat_frame, flat_save, print_name = False)
+
+    if stack_mode == 'clipped':
+        pyfits.PrimaryHDU(Flat_frame.astype(np.float32)).writeto(os.path.splitext(flat_save)[0] + '.fits', 
+            overwrite=True)
+
+    # Forget the old frame with the same name, even if the file system does not update the modification time in time
+    forgetCalibrationFrame(flat_save)
     #log.info('Done!')
     return Flat_frame, Flat_frame_scalar
 
@@ -956,7 +2080,7 @@ def load_flat(flat_bmp = 'flat.bmp'):
     flat_img = flat_img.convert('L')
     flat_img.load()
 
-    flat_array = np.asarray(flat_img, dtype=np.uint)
+    flat_array = np.asarray(flat_img, dtype=np.uint8)
 
     Flat_frame_scalar = int(np.median(flat_array))
 
@@ -973,12 +2097,92 @@ def load_dark(dark_bmp = 'dark.bmp'):
     dark_img = dark_img.convert('L')
     dark_img.load()
 
-    dark_array = np.asarray(dark_img, dtype=np.uint)
+    dark_array = np.asarray(dark_img, dtype=np.uint8)
 
     return dark_array
 
 
 
+def getCalibrationFrame(file_path, frame_type):
+    """ Returns a calibration_struct with the dark or the flat frame from the given BMP file, or the bad pixels from
+        the given NPZ file. Each file is loaded only once, and loaded again only if its path, modification time or 
+        size changes.
+
+    file_path: path to the dark or flat BMP file, or to the bad pixel NPZ file
+    frame_type: 'dark', 'flat' or 'badpixels'
+    """
+
+    file_path = os.path.abspath(file_path)
+
+    # Raises an error if the file does not exist, the same as loading it would
+    file_stat = os.stat(file_path)
+
+    cache_key = (file_path, frame_type)
+
+    with calibration_cache_lock:
+        calibration = calibration_cache.get(cache_key)
+
+    if (calibration is not None) and (calibration.mtime == file_stat.st_mtime) and \
+            (calibration.size == file_stat.st_size):
+        return calibration
+
+    calibration = calibration_struct()
+    calibration.path = file_path
+    calibration.mtime = file_stat.st_mtime
+    calibration.size = file_stat.st_size
+    calibration.frame_type = frame_type
+
+    if frame_type == 'dark':
+        calibration.dark_frame = load_dark(file_path)
+        calibration.dark_int16 = calibration.dark_frame.astype(np.int16)
+
+    elif frame_type == 'badpixels':
+        with np.load(file_path) as bad_pixel_file:
+            calibration.bad_pixels = bad_pixel_struct(bad_pixel_file['shape'], bad_pixel_file['rows'], 
+                bad_pixel_file['cols'], bad_pixel_file['hot'])
+
+    else:
+        calibration.Flat_frame, calibration.Flat_frame_scalar = load_flat(file_path)
+        calibration.flat_gain = calibration.Flat_frame_scalar/np.where(calibration.Flat_frame == 0, 1, 
+            calibration.Flat_frame).astype(np.float32)
+
+    with calibration_cache_lock:
+        calibration_cache[cache_key] = calibration
+
+    return calibration
+
+
+
+def forgetCalibrationFrame(file_path):
+    """ Removes the frames loaded from the given file from the calibration cache, e.g. after the file is rewritten.
+    """
+
+    file_path = os.path.abspath(file_path)
+
+    with calibration_cache_lock:
+        for cache_key in [key for key in calibration_cache if key[0] == file_path]:
+            del calibration_cache[cache_key]
+
+
+
+def load_dark_cached(dark_bmp = 'dark.bmp'):
+    """ Same as load_dark, but the dark frame is loaded from the file only once, see getCalibrationFrame.
+    """
+
+    return getCalibrationFrame(dark_bmp, 'dark').dark_frame
+
+
+
+def load_flat_cached(flat_bmp = 'flat.bmp'):
+    """ Same as load_flat, but the flat frame is loaded from the file only once, see getCalibrationFrame.
+    """
+
+    calibration = getCalibrationFrame(flat_bmp, 'flat')
+
+    return calibration.Flat_frame, calibration.Flat_frame_scalar
+
+
+
 def get_FTPdetect_coordinates(FTPdetect_file_content, ff_bin, meteor_no = 1):
     """ Returns a list of FF*.bin coordinates of a specific bin file and a meteor on that image as a list of tuples e.g. [(15, 20), (16, 21), (17, 22)] and the rotation angle of the meteor.
     """
@@ -1047,65 +2251,10 @@ def markDetections(image_array, detections_array, edge_marker=True, edge_thickne
     edge_minimum: minimum edge width in pixels
     """
 
-    def minimumEdge(var_min, var_max, img_var_size, edge_minimum):
-        """ Check for minimum edge width. """
-        if var_min > var_max:
-            var_min, var_max = var_max, var_min
-
-        if abs(var_max - var_min) < edge_minimum:
-            var_diff = int((edge_minimum - abs(var_max - var_min)) /2)
-            var_max += var_diff
-
-            var_min -= var_diff
-
-        if var_max >= img_var_size:
-            var_max = img_var_size - 1
-
-        if var_min < 0:
-            var_min = 0
-
-        return var_min, var_max
-
-
-    redImage = np.copy(image_array)
-    greenImage = np.copy(image_array)
-    blueImage = np.copy(image_array)
-    
-    # Extract position of each point
-    frames, y, x = zip(*detections_array)
-
-    # Change each given point to green
-    redImage[x, y] = 0
-    greenImage[x, y] = 255
-    blueImage[x, y] = 0
-
-    if edge_marker:
-        # Mark point range on the edge of the image
-
-        img_x_size = len(image_array)
-        img_y_size = len(image_array[0])
-
-        # Find the range of edge pixels to draw
-        x_min, x_max = minimumEdge(min(x), max(x)+1, img_x_size, edge_minimum)
-        y_min, y_max = minimumEdge(min(y), max(y)+1, img_y_size, edge_minimum)
-
-        x_range = list(range(x_min, x_max))
-        y_range = list(range(y_min, y_max))
-
-        x_edge = []
-        y_edge = []
-
-        for border_px in range(0, edge_thickness):
-            x_edge += len(y_range) * [border_px] + x_range
-            y_edge += y_range + len(x_range) * [border_px]
-
-        redImage[x_edge, y_edge] = 255
-        greenImage[x_edge, y_edge] = 0
-        blueImage[x_edge, y_edge] = 0
-
-        
+    layer = overlay.rasterizeDetections(image_array.shape, detections_array, edge_marker, edge_thickness, 
+        edge_minimum)
 
-    return np.dstack((redImage, greenImage, blueImage))
+    return overlay.compositeOverlay(image_array, layer)
 
 
 
@@ -1116,16 +2265,15 @@ def find_crop_size(crop_array, size = 15):
     ncols = len(crop_array[0])
     first_coord = (0, 0)
     last_coord = (nrows, ncols)
-    first_found = False
 
-    for j in range(ncols):
-        for i in range(nrows):
-            if crop_array[i][j] == 255:
-                if first_found is False:
-                    first_coord = (i, j)
-                    first_found = True
-                    continue
-                last_coord = (i, j)
+    # Positions of 255 values, column by column
+    positions = np.argwhere(np.asarray(crop_array).T == 255)
+
+    if len(positions) > 0:
+        first_coord = (positions[0][1], positions[0][0])
+
+    if len(positions) > 1:
+        last_coord = (positions[-1][1], positions[-1][0])
 
     first_x = first_coord[1]
     first_y = first_coord[0]
@@ -1145,27 +2293,18 @@ def find_crop_size(crop_array, size = 15):
 
 def get_lightcurve(meteor_array):
     """ Calculates the sum of column level values of a given array. For croped meteor image this gives its lightcurve.
+        See module_photometry for the aperture photometry of detected meteors.
     """
-    ncols = len(meteor_array[0])
 
-    lightcurve = []
-    for i in range(ncols-1):
-        lightcurve.append(np.sum(meteor_array[:, i:i+1]))
-
-    return lightcurve
+    return list(np.sum(meteor_array[:, :-1], axis=0))
 
 
 def colorize_maxframe(ff_bin, minv = None, gamma = None, maxv = None):
     """ Colorizes the B/W maxframe into red/blue image. Odd frames are colored red, even frames are colored blue.
     """
 
-    ff_maxframe = ff_bin.maxpixel.astype(np.int16)
-    ff_avgframe = ff_bin.avepixel.astype(np.int16)
-
-
-    ff_maxframe_noavg = np.subtract(ff_maxframe, ff_avgframe)
-
-
+    # maxpixel is never below avepixel, so the difference fits into 8 bits and levels are adjusted with a lookup table
+    ff_maxframe_noavg = np.clip(np.subtract(ff_bin.maxpixel, ff_bin.avepixel, dtype=np.int16), 0, 255).astype(np.uint8)
 
     odd_frame = deinterlace_array_odd(ff_maxframe_noavg)
     even_frame = deinterlace_array_even(ff_maxframe_noavg)
@@ -1174,15 +2313,57 @@ def colorize_maxframe(ff_bin, minv = None, gamma = None, maxv = None):
     odd_frame = adjust_levels(odd_frame, minv, gamma, maxv)
     even_frame = adjust_levels(even_frame, minv, gamma, maxv)
 
-    colored_array = np.dstack((odd_frame, even_frame, even_frame)) #R G B
+    # R G B, the background is added to each channel in 16 bits and saturated
+    colored_array = np.empty(ff_bin.avepixel.shape + (3, ), dtype=np.uint8)
+    channel_sum = np.empty(ff_bin.avepixel.shape, dtype=np.uint16)
 
-    avg_rgb = np.dstack((ff_avgframe, ff_avgframe, ff_avgframe))
-    colored_array = np.clip(np.add(colored_array, avg_rgb), 0, 255).astype(np.uint8)
+    for channel, frame in enumerate((odd_frame, even_frame, even_frame)):
+        np.add(frame, ff_bin.avepixel, out=channel_sum, dtype=np.uint16)
+        np.minimum(channel_sum, 255, out=channel_sum)
+        colored_array[:, :, channel] = channel_sum
 
     return colored_array
 
 
 
+def colorize_timecode(ff_bin, start_frame=0, end_frame=255, minv=None, gamma=None, maxv=None, noise_floor=8):
+    """ Colors every maxpixel hit by the frame in which it peaked, so the direction and the speed of a meteor
+        can be seen on a single image. The hue goes from red (start_frame) to blue (end_frame), the brightness
+        is given by maxpixel - avepixel. Everything is computed in one vectorized pass.
+
+    ff_bin: FF structure
+    start_frame: frame colored red (default 0)
+    end_frame: frame colored blue (default 255)
+    minv, gamma, maxv: levels adjustment of the brightness (default None)
+    noise_floor: differences below this value are not colored (default 8)
+    """
+
+    ff_avgframe = ff_bin.avepixel.astype(np.int16)
+
+    # Brightness of each hit above the background
+    value = np.clip(ff_bin.maxpixel.astype(np.int16) - ff_avgframe, 0, 255).astype(np.uint8)
+    value = adjust_levels(value, minv, gamma, maxv).astype(np.float32)
+
+    # Only color hits above the noise floor and inside the frame range
+    maxframe = ff_bin.maxframe
+    value[(value < noise_floor) | (maxframe < start_frame) | (maxframe > end_frame)] = 0
+
+    # Hue from the frame of the maximum, in sixths of the color wheel (0 is red, 4 is blue)
+    hue = (maxframe.astype(np.float32) - start_frame)/max(end_frame - start_frame, 1)
+    hue = np.clip(hue, 0, 1)*4
+
+    # HSV to RGB with full saturation
+    channels = []
+    for n in (5, 3, 1):
+        k = (n + hue)%6
+        channels.append(value - value*np.clip(np.minimum(k, 4 - k), 0, 1))
+
+    colored_array = np.dstack(channels) + ff_avgframe[:, :, np.newaxis]
+
+    return np.clip(colored_array, 0, 255).astype(np.uint8)
+
+
+
 def adjust_levels(img_array, minv, gamma, maxv):
     """Adjusts levels on image with given parameters.
 
@@ -1194,21 +2375,53 @@ def adjust_levels(img_array, minv, gamma, maxv):
     if (minv is None) and (gamma is None) and (maxv is None):
         return img_array #Return the same array if parameters are None
 
+    # 8-bit images only have 256 possible values, so the levels are computed once per value and looked up
+    if img_array.dtype == np.uint8:
+        return tone_map(img_array, minv, gamma, maxv)
+
+    if useTiles(img_array):
+        adjusted_array = np.empty(img_array.shape, dtype=np.uint8)
+
+        def levelsBand(start, end):
+            adjusted_array[start:end] = _adjust_levels(img_array[start:end], minv, gamma, maxv)
+
+        runTiled(levelsBand, img_array.shape[0])
+
+        return adjusted_array
+
+    return _adjust_levels(img_array, minv, gamma, maxv)
+
+
+
+def _adjust_levels(img_array, minv, gamma, maxv):
+    """ Single threaded adjust_levels.
+    """
+
     minv= minv/255.0
     maxv= maxv/255.0
     _interval= maxv - minv
     _invgamma= 1.0/gamma
 
-    img_array = img_array.astype(float)
-    img_array = img_array / 255 #Reduce array to 0-1 values
+    # Computed in place in float32 (float64 inputs are kept in float64)
+    img_array = np.array(img_array, dtype=np.promote_types(img_array.dtype, np.float32))
+    img_array /= 255 #Reduce array to 0-1 values
 
-    img_array = ((img_array - minv)/_interval)**_invgamma #Calculate new levels
+    img_array -= minv #Calculate new levels
+    img_array /= _interval
 
-    img_array = img_array * 255
-    img_array = np.clip(img_array, 0, 255) #Convert back to 0-255 values
-    img_array = img_array.astype(np.uint8)
+    # Fractional powers of values below the minimum level are NaN, which ends up black, so they are set to 0 first
+    # to avoid the NaN warnings (integer powers are computed as they are)
+    if _invgamma != int(_invgamma):
+        np.maximum(img_array, 0, out=img_array)
 
-    return img_array
+    # The ** operator is used and not np.power, so the rounding is the same as in ((x - minv)/interval)**invgamma, 
+    # e.g. the power of 1 is exact
+    img_array **= _invgamma
+
+    img_array *= 255
+    np.clip(img_array, 0, 255, out=img_array) #Convert back to 0-255 values
+
+    return img_array.astype(np.uint8)
     
 
 
@@ -1220,14 +2433,229 @@ def rescaleIntensity(image, in_range):
     """
 
     imin, imax = in_range
-    omin, omax = (0.0, 1.0)
 
-    # Clip image values to the given range
+    # Clip image values to the given range, floating point images keep their type, others are rescaled in float32
     image = np.clip(image, imin, imax)
+    if image.dtype.kind != 'f':
+        image = image.astype(np.float32)
+
+    # Rescale intensities to 0-1
+    image -= imin
+    image /= float(imax - imin)
+
+    return image
+
+
+
+def getHistogram(img_array):
+    """ Returns the 256 bin histogram of an 8-bit image (grayscale or RGB).
+    """
+
+    return np.bincount(np.ascontiguousarray(img_array).reshape(-1), minlength=256)
+
+
+
+def histogramPercentile(histogram, percentile, values=None):
+    """ Returns the given percentile of the pixels in a 256 bin histogram, interpolated linearly as in np.percentile.
+
+    histogram: 256 bin histogram from getHistogram
+    percentile: percentile (0 - 100)
+    values: value of each pixel level (default: the level itself)
+    """
+
+    if values is None:
+        values = np.arange(256, dtype=np.float64)
+
+    cumulative = np.cumsum(histogram)
+    npixels = cumulative[-1]
+
+    index = percentile/100.0*(npixels - 1)
+    prev_index = int(np.floor(index))
+    next_index = min(prev_index + 1, npixels - 1)
+
+    # Pixel levels of the sorted pixels with the given indices
+    prev_level, next_level = np.searchsorted(cumulative, [prev_index, next_index], side='right')
+
+    return values[prev_level] + (values[next_level] - values[prev_level])*(index - prev_index)
+
+
+
+def getStretchLimits(img_array, low_percentile=0.1, high_percentile=99.8, histogram=None):
+    """ Returns the parameters of the arcsinh stretch of an 8-bit image as (peak, low, high), where peak is the 
+        largest pixel value and low and high are the given percentiles of arcsinh(img_array)/arcsinh(peak). The 
+        percentiles are interpolated linearly, as in np.percentile, but are computed from the image histogram.
+
+    histogram: histogram of the image, if already computed (see getHistogram)
+    """
+
+    if histogram is None:
+        histogram = getHistogram(img_array)
+
+    peak = int(np.flatnonzero(histogram)[-1])
+
+    # Normalized arcsinh value of each pixel level
+    levels = np.arcsinh(np.arange(256, dtype=np.float64))/np.arcsinh(max(peak, 1))
+
+    return peak, histogramPercentile(histogram, low_percentile, levels), \
+        histogramPercentile(histogram, high_percentile, levels)
+
+
+
+def getAutoLevels(histogram, low_percentile=0.1, high_percentile=99.8, background=0.25, gamma_range=(0.1, 10)):
+    """ Returns (minv, gamma, maxv) levels which stretch the image between the given percentiles, with the gamma 
+        chosen to bring the median (the sky background) to the given brightness.
+
+    histogram: 256 bin image histogram from getHistogram
+    low_percentile: percentile which is mapped to black
+    high_percentile: percentile which is mapped to white
+    background: brightness of the median after the adjustment (0 - 1)
+    gamma_range: limits of the returned gamma
+    """
+
+    minv = int(np.floor(histogramPercentile(histogram, low_percentile)))
+    maxv = int(np.ceil(histogramPercentile(histogram, high_percentile)))
+
+    if maxv <= minv:
+        maxv = min(minv + 1, 255)
+        minv = maxv - 1
+
+    median = (histogramPercentile(histogram, 50) - minv)/float(maxv - minv)
+
+    # adjust_levels maps the median to median**(1/gamma)
+    if 0 < median < 1:
+        gamma = np.log(median)/np.log(background)
+    else:
+        gamma = 1.0
+
+    gamma = float(np.clip(gamma, *gamma_range))
+
+    return minv, gamma, maxv
+
+
+
+def getToneLUT(minv=None, gamma=None, maxv=None, stretch=None, invert=False):
+    """ Returns a 256 element uint8 lookup table which maps 8-bit pixel values through the arcsinh stretch, 
+        levels and gamma, and inversion, in that order. Lookup tables are cached per parameter set.
+
+    minv, gamma, maxv: levels adjustment, the same as in adjust_levels (None to skip)
+    stretch: (peak, low, high) arcsinh stretch parameters from getStretchLimits (None to skip)
+    invert: invert the output if True
+    """
+
+    lut_key = (minv, gamma, maxv, stretch, invert)
+
+    if lut_key in tone_lut_cache:
+        return tone_lut_cache[lut_key]
+
+    lut = np.arange(256, dtype=np.uint8)
+
+    if stretch is not None:
+        peak, low, high = stretch
+
+        # Apply arcsinh, normalize values to 1 and rescale image levels with the given range
+        limg = np.arcsinh(lut.astype(np.float64))/np.arcsinh(max(peak, 1))
+
+        if high > low:
+            lut = (rescaleIntensity(limg, in_range=(low, high))*255).astype(np.uint8)
+        else:
+            lut = np.where(limg > low, 255, 0).astype(np.uint8)
+
+    # Computed in float64, so the table gives exactly the same levels as adjust_levels on other images
+    if (minv is not None) or (gamma is not None) or (maxv is not None):
+        lut = _adjust_levels(lut.astype(np.float64), minv, gamma, maxv)
+
+    if invert:
+        lut = 255 - lut
+
+    # Keep the cache small, levels change with every slider move
+    if len(tone_lut_cache) >= 256:
+        tone_lut_cache.clear()
+
+    tone_lut_cache[lut_key] = lut
+
+    return lut
+
+
+
+def tone_map(img_array, minv=None, gamma=None, maxv=None, stretch=False, invert=False, low_percentile=0.1, 
+    high_percentile=99.8, histogram=None):
+    """ Applies the arcsinh stretch (Enhance stars), levels and inversion to an 8-bit image with a single lookup 
+        table. Used in CMN_binViewer.
+
+    img_array: uint8 image array (grayscale or RGB)
+    minv, gamma, maxv: levels adjustment, the same as in adjust_levels (None to skip)
+    stretch: apply the arcsinh stretch between the given percentiles if True
+    invert: invert the image if True
+    histogram: histogram of the image, if already computed (see getHistogram)
+    """
+
+    stretch_limits = None
+    if stretch:
+        stretch_limits = getStretchLimits(img_array, low_percentile, high_percentile, histogram)
+
+    lut = getToneLUT(minv, gamma, maxv, stretch_limits, invert)
+
+    mapped_array = np.empty(img_array.shape, dtype=np.uint8)
+
+    def lutBand(start, end):
+
+        if use_numba:
+            img_flat = np.ascontiguousarray(img_array[start:end]).reshape(-1)
+            mapped_array[start:end] = numba_kernels.apply_lut(img_flat, lut, 
+                np.empty_like(img_flat)).reshape(mapped_array[start:end].shape)
+
+        else:
+            np.take(lut, img_array[start:end], out=mapped_array[start:end])
+
+    runTiled(lutBand, img_array.shape[0], tile_workers if useTiles(img_array) else 1)
+
+    return mapped_array
+
+
+
+def enhance_stars(img_array, low_percentile=0.1, high_percentile=99.8):
+    """ Enhances faint stars by stretching the image with arcsinh, then rescales it between the given 
+        percentiles. Used in CMN_binViewer. Large images are processed in row bands on multiple threads.
+
+    img_array: input image array
+    low_percentile: percentile which is mapped to black
+    high_percentile: percentile which is mapped to white
+    """
+
+    if img_array.dtype == np.uint8:
+        return tone_map(img_array, stretch=True, low_percentile=low_percentile, high_percentile=high_percentile)
+
+    nrows = img_array.shape[0]
+    workers = tile_workers if useTiles(img_array) else 1
+
+    # Apply arcsinh on an image (the output type depends on the input, e.g. float16 for 8-bit images)
+    limg = np.empty(img_array.shape, dtype=np.arcsinh(img_array[:1]).dtype)
+
+    def arcsinhBand(start, end):
+        limg[start:end] = np.arcsinh(img_array[start:end])
+        return limg[start:end].max()
+
+    limg_max = max(runTiled(arcsinhBand, nrows, workers))
+
+    # Normalize values to 1
+    def normalizeBand(start, end):
+        limg[start:end] = limg[start:end]/limg_max
+
+    runTiled(normalizeBand, nrows, workers)
+
+    # Find low and high intensity percentiles
+    low = np.percentile(limg, low_percentile)
+    high = np.percentile(limg, high_percentile)
+
+    # Rescale image levels with the given range
+    enhanced_array = np.empty(img_array.shape, dtype=np.uint8)
+
+    def rescaleBand(start, end):
+        enhanced_array[start:end] = (rescaleIntensity(limg[start:end], in_range=(low, high))*255).astype(np.uint8)
+
+    runTiled(rescaleBand, nrows, workers)
 
-    # Rescale intensities
-    image = (image - imin) / float(imax - imin)
-    return image * (omax - omin) + omin
+    return enhanced_array
 
 
 
@@ -1297,18 +2725,19 @@ def cropDetectionSegments(ffBinRead, segmentList, cropSize = 64):
             y_right = nrows + 1
             
 
-        imageArray = buildFF(ffBinRead, int(frame), videoFlag = True)
+        # Only reconstruct the frame inside the crop window
+        imageArray = buildFFWindow(ffBinRead, int(frame), y_left, y_right, x_left, x_right)
 
         # If croped area is in the corner, fill corner with zeroes
         if fillZeoresFlag:
 
             cropedArray = np.zeros(shape =(cropSize*2, cropSize*2))
-            tempCrop = imageArray[y_left:y_right, x_left:x_right]
+            tempCrop = imageArray
 
             cropedArray[y_diff:y_end, x_diff:x_end] = tempCrop
         
         else:
-            cropedArray = imageArray[y_left:y_right, x_left:x_right]
+            cropedArray = imageArray
 
         if frame % 1 == 0:
             # Deinterlace odd
@@ -0,0 +1,177 @@
+# coding=utf-8
+# Copyright 2014 Denis Vida, denis.vida@gmail.com
+
+# The module_backgroundModel is free software; you can redistribute
+# it and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, version 2.
+
+# The module_backgroundModel is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with the module_backgroundModel ; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+"""Rolling background of a night: the median (or mean) of avepixel over the FF files around the current one.
+
+The avepixel images of the window are kept in a ring buffer, one slot per file. When the window moves by one
+file (e.g. when going to the next image, or in a batch over the night), only the file which enters the window is
+read and it takes the slot of the file which leaves it, the running sum for the mean is updated in the same way.
+Unlike the avepixel of a single file, the rolling background also contains the stars, hot pixels and slow clouds
+of the neighbouring files, so subtracting it leaves mostly the moving objects.
+
+Usage:
+    model = RollingBackground(file_list, half_window=5)
+    background = model.getBackground(file_list[10])
+"""
+
+import os
+import logging
+import threading
+
+import numpy as np
+
+from FF_bin_suite import readFF, median_stack
+
+
+log = logging.getLogger("CMN_binViewer")
+
+
+
+class RollingBackground:
+    """ Ring buffer of the avepixel images of the FF files around the current one.
+    """
+    def __init__(self, file_list, half_window=5, mode='median', data_type=1):
+        """
+        file_list: FF files of the night, sorted by time
+        half_window: number of files before and after the current one in the window
+        mode: 'median' or 'mean'
+        data_type: 1 CAMS, 2 skypatrol, 3 RMS
+        """
+
+        if mode not in ('median', 'mean'):
+            raise ValueError("Unknown background mode: " + str(mode))
+
+        self.file_list = list(file_list)
+        self.half_window = half_window
+        self.mode = mode
+        self.data_type = data_type
+
+        # File name -> index in the file list
+        self.file_index = dict((os.path.basename(file_path), i) for i, file_path in enumerate(self.file_list))
+
+        # Ring buffer slots, file i is kept in the slot i % size, slot_files has the file index in each slot
+        self.size = 2*half_window + 1
+        self.ring = None
+        self.slot_files = [None]*self.size
+
+        # Running sum of the valid slots, for the mean
+        self.ring_sum = None
+
+        # Number of files read, and the background of the last requested file
+        self.reads = 0
+        self.last_index = None
+        self.last_background = None
+
+        # The model is used by the render worker and by exports on the main thread
+        self.lock = threading.RLock()
+
+
+    def window(self, index):
+        """ Returns the indices of the files in the window around the given file, cut at the ends of the night.
+        """
+
+        return range(max(0, index - self.half_window), min(len(self.file_list), index + self.half_window + 1))
+
+
+    def _setSlot(self, slot, index, avepixel):
+        """ Puts avepixel of the file with the given index into the slot (None empties it) and updates the sum.
+        """
+
+        if self.slot_files[slot] is not None:
+            self.ring_sum -= self.ring[slot]
+
+        self.slot_files[slot] = None
+
+        if avepixel is not None:
+            self.ring[slot] = avepixel
+            self.ring_sum += avepixel
+            self.slot_files[slot] = index
+
+
+    def update(self, index):
+        """ Moves the window to the given file. Only the files which are not in the ring buffer yet are read.
+        """
+
+        window = self.window(index)
+
+        for slot in range(self.size):
+
+            # Forget the files outside the window, e.g. at the start of the night
+            if (self.slot_files[slot] is not None) and (self.slot_files[slot] not in window):
+                self._setSlot(slot, None, None)
+
+        for i in window:
+
+            slot = i%self.size
+
+            if self.slot_files[slot] == i:
+                continue
+
+            try:
+                avepixel = readFF(self.file_list[i], datatype=self.data_type).avepixel
+
+            except (IOError, OSError, ValueError) as error:
+                log.info('unable to read {:s}: {}'.format(self.file_list[i], error))
+                continue
+
+            self.reads += 1
+
+            if self.ring is None:
+                self.ring = np.zeros((self.size, ) + avepixel.shape, dtype=np.uint8)
+                self.ring_sum = np.zeros(avepixel.shape, dtype=np.uint32)
+
+            # Files of a different resolution are skipped
+            if avepixel.shape != self.ring.shape[1:]:
+                continue
+
+            self._setSlot(slot, i, avepixel)
+
+
+    def getBackground(self, file_path):
+        """ Returns the rolling background (uint8) for the given FF file of the night.
+        """
+
+        index = self.file_index[os.path.basename(file_path)]
+
+        with self.lock:
+            return self._getBackground(index, file_path)
+
+
+    def _getBackground(self, index, file_path):
+        """ Returns the rolling background for the file with the given index, see getBackground.
+        """
+
+        if index == self.last_index:
+            return self.last_background
+
+        self.update(index)
+
+        slots = [slot for slot in range(self.size) if self.slot_files[slot] is not None]
+
+        if not slots:
+            raise ValueError("No readable FF files around " + file_path)
+
+        if self.mode == 'mean':
+            background = self.ring_sum/float(len(slots))
+
+        else:
+            background = median_stack(self.ring[slots])
+
+        # The mean, and the median of an even number of files, are rounded
+        self.last_index = index
+        self.last_background = np.round(background).astype(np.uint8)
+
+        return self.last_background
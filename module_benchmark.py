@@ -0,0 +1,435 @@
+# coding=utf-8
+# Copyright 2014 Denis Vida, denis.vida@gmail.com
+
+# The module_benchmark is free software; you can redistribute
+# it and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, version 2.
+
+# The module_benchmark is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with the module_benchmark ; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+"""Benchmarks of the image processing functions in FF_bin_suite on synthetic images.
+
+Usage:
+    python module_benchmark.py [benchmark name ...]
+
+Without arguments, all benchmarks are run.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import shutil
+import tempfile
+import timeit
+import multiprocessing
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import numpy as np
+
+import FF_bin_suite
+
+
+
+def timeFunction(func, repeats=5):
+    """ Returns the best run time of the given function in milliseconds.
+    """
+
+    return 1000*min(timeit.repeat(func, number=1, repeat=repeats))
+
+
+
+def makeTestFF(nrows=576, ncols=720, seed=0):
+    """ Makes a synthetic FF structure with a random background and a meteor-like streak.
+    """
+
+    rnd = np.random.RandomState(seed)
+
+    ff = FF_bin_suite.ff_struct()
+    ff.nrows = nrows
+    ff.ncols = ncols
+    ff.nframes = 256
+
+    ff.avepixel = rnd.randint(10, 40, (nrows, ncols)).astype(np.uint8)
+    ff.stdpixel = rnd.randint(1, 10, (nrows, ncols)).astype(np.uint8)
+    ff.maxpixel = (ff.avepixel + rnd.randint(0, 20, (nrows, ncols))).astype(np.uint8)
+    ff.maxframe = rnd.randint(0, 256, (nrows, ncols)).astype(np.uint8)
+
+    # Diagonal streak from frame 100 to 150
+    for i, frame in enumerate(range(100, 150)):
+        y = int(nrows*(0.2 + 0.6*i/50.0))
+        x = int(ncols*(0.2 + 0.6*i/50.0))
+        ff.maxpixel[y:y + 3, x:x + 3] = 250
+        ff.maxframe[y:y + 3, x:x + 3] = frame
+
+    ff.adjustment_scalar = np.mean(ff.maxpixel)/np.mean(ff.avepixel)
+
+    return ff
+
+
+
+def benchmarkTiledRendering(nrows=2160, ncols=3840, repeats=3):
+    """ Times one viewer render (calibration, deinterlace, levels, arcsinh) of a 4K image with different numbers
+        of tile workers.
+    """
+
+    ff = makeTestFF(nrows, ncols)
+
+    dark_frame = np.random.RandomState(1).randint(0, 10, (nrows, ncols)).astype(np.uint8)
+    Flat_frame = np.random.RandomState(2).randint(100, 140, (nrows, ncols)).astype(np.uint8)
+    Flat_frame_scalar = int(np.median(Flat_frame))
+
+    steps = [
+        ('calibration', lambda: FF_bin_suite.process_array(ff.maxpixel, Flat_frame, Flat_frame_scalar, dark_frame)),
+        ('deinterlace', lambda: FF_bin_suite.process_array(ff.maxpixel, deinterlace=True)),
+        ('levels', lambda: FF_bin_suite.adjust_levels(ff.maxpixel, 10, 1.5, 200)),
+        ('arcsinh', lambda: FF_bin_suite.enhance_stars(ff.maxpixel))
+        ]
+
+    old_workers = FF_bin_suite.tile_workers
+
+    print('Tiled rendering, {:d}x{:d} image, {:d} CPU cores'.format(ncols, nrows, multiprocessing.cpu_count()))
+    print('workers ' + ''.join(['{:>13s}'.format(name) for name, _ in steps]) + '{:>13s}'.format('total'))
+
+    workers_list = sorted(set([1, 2, 4, multiprocessing.cpu_count()]))
+
+    for workers in workers_list:
+
+        FF_bin_suite.tile_workers = workers
+
+        times = [timeFunction(func, repeats) for _, func in steps]
+
+        print('{:7d} '.format(workers) + ''.join(['{:10.1f} ms'.format(t) for t in times + [sum(times)]]))
+
+    FF_bin_suite.tile_workers = old_workers
+
+
+
+def _rowLoopDeinterlaceOdd(ff_image):
+    """ The former row by row deinterlace_array_odd, kept as a reference for benchmarkDeinterlace.
+    """
+
+    truth_gen = FF_bin_suite.truth_generator()
+    deinterlaced_image = np.copy(ff_image)
+    old_row = ff_image[0]
+    for row_num in range(len(ff_image)):
+        if next(truth_gen) is True:
+            deinterlaced_image[row_num] = np.copy(ff_image[row_num])
+            old_row = ff_image[row_num]
+        else:
+            deinterlaced_image[row_num] = np.copy(old_row)
+
+    deinterlaced_image = np.delete(deinterlaced_image, (0), axis=0)
+
+    return np.vstack([deinterlaced_image, np.zeros(len(deinterlaced_image[0]), dtype=np.uint8)])
+
+
+
+def _rowLoopDeinterlaceEven(ff_image):
+    """ The former row by row deinterlace_array_even, kept as a reference for benchmarkDeinterlace.
+    """
+
+    truth_gen = FF_bin_suite.truth_generator()
+    deinterlaced_image = np.copy(ff_image)
+    old_row = ff_image[-1]
+    for row_num in reversed(range(len(ff_image))):
+        if next(truth_gen) is True:
+            deinterlaced_image[row_num] = np.copy(ff_image[row_num])
+            old_row = ff_image[row_num]
+        else:
+            deinterlaced_image[row_num] = np.copy(old_row)
+
+    return deinterlaced_image
+
+
+
+def benchmarkDeinterlace(repeats=5):
+    """ Compares the former row by row deinterlacing with the vectorized one (NumPy only), with and without an 
+        output buffer.
+    """
+
+    old_numba = FF_bin_suite.use_numba
+    FF_bin_suite.use_numba = False
+
+    print('Deinterlacing (NumPy)')
+    print('{:>11s}{:>13s}{:>13s}{:>13s}{:>13s}'.format('image', 'row loop', 'vectorized', 'with out=', 'blend'))
+
+    for nrows, ncols in [(480, 640), (576, 720), (1080, 1920), (2160, 3840)]:
+
+        image = makeTestFF(nrows, ncols).maxpixel
+        out = np.empty_like(image)
+
+        assert np.array_equal(_rowLoopDeinterlaceOdd(image), FF_bin_suite.deinterlace_array_odd(image))
+        assert np.array_equal(_rowLoopDeinterlaceEven(image), FF_bin_suite.deinterlace_array_even(image))
+
+        times = [
+            timeFunction(lambda: (_rowLoopDeinterlaceOdd(image), _rowLoopDeinterlaceEven(image)), repeats),
+            timeFunction(lambda: (FF_bin_suite.deinterlace_array_odd(image), 
+                FF_bin_suite.deinterlace_array_even(image)), repeats),
+            timeFunction(lambda: (FF_bin_suite.deinterlace_array_odd(image, out=out), 
+                FF_bin_suite.deinterlace_array_even(image, out=out)), repeats),
+            timeFunction(lambda: FF_bin_suite.deinterlace_blend(image, out=out), repeats)
+            ]
+
+        print('{:>11s}'.format('{:d}x{:d}'.format(ncols, nrows)) + ''.join(['{:10.2f} ms'.format(t) for t in times]))
+
+    FF_bin_suite.use_numba = old_numba
+
+
+
+def _float64ProcessArray(img_array, Flat_frame=None, Flat_frame_scalar=None, dark_frame=None, deinterlace=False, 
+    field=0):
+    """ The former float64 calibration of process_array, kept as a reference for benchmarkCalibration.
+    """
+
+    if dark_frame is not None:
+        img_array = np.subtract(img_array, dark_frame)
+
+    if Flat_frame is not None:
+        img_array = img_array.astype(float)
+
+        Flat_frame[Flat_frame == 0] = 1
+        img_array = img_array / Flat_frame.astype(float)
+        img_array = np.multiply(img_array, Flat_frame_scalar)
+
+    if (dark_frame is not None) or (Flat_frame is not None):
+        img_array = np.clip(img_array, 0, 255)
+
+    img_array = img_array.astype(np.uint8)
+
+    if field == 1:
+        img_array = FF_bin_suite.deinterlace_array_odd(img_array)
+    elif field == 2:
+        img_array = FF_bin_suite.deinterlace_array_even(img_array)
+
+    if deinterlace is True:
+        img_array = FF_bin_suite.deinterlace_blend(img_array)
+
+    return img_array
+
+
+
+def benchmarkCalibration(nrows=576, ncols=720, repeats=10):
+    """ Times every viewer filter path which goes through process_array, with dark and flat correction, using the
+        former float64 calibration and the fused float32 one (NumPy and numba, if available).
+    """
+
+    ff = makeTestFF(nrows, ncols)
+
+    dark_frame = np.random.RandomState(1).randint(0, 10, (nrows, ncols)).astype(np.uint8)
+    Flat_frame = np.random.RandomState(2).randint(100, 140, (nrows, ncols)).astype(np.uint8)
+    Flat_frame_scalar = int(np.median(Flat_frame))
+
+    frame = FF_bin_suite.buildFF(ff, 120, videoFlag=True)
+    frame_stack = FF_bin_suite.buildFFStack(ff, 100, 131)
+
+    paths = [
+        ('maxpixel', ff.maxpixel, {}),
+        ('maxpixel deint.', ff.maxpixel, {'deinterlace': True}),
+        ('avepixel', ff.avepixel, {}),
+        ('odd field', ff.maxpixel, {'field': 1}),
+        ('even field', ff.maxpixel, {'field': 2}),
+        ('frame', frame, {}),
+        ('32 frame stack', frame_stack, {})
+        ]
+
+    old_tiles = FF_bin_suite.tile_workers
+    old_numba = FF_bin_suite.use_numba
+
+    FF_bin_suite.tile_workers = 1
+
+    implementations = [('float64', _float64ProcessArray, False), ('float32', FF_bin_suite.process_array, False)]
+    if FF_bin_suite.numba_kernels.numba_available:
+        implementations.append(('numba', FF_bin_suite.process_array, True))
+
+    print('Calibration (dark and flat), {:d}x{:d} image'.format(ncols, nrows))
+    print('{:>16s}'.format('filter') + ''.join(['{:>13s}'.format(name) for name, _, _ in implementations]))
+
+    for name, img_array, kwargs in paths:
+
+        times = []
+
+        for _, func, numba_flag in implementations:
+
+            FF_bin_suite.use_numba = numba_flag
+
+            times.append(timeFunction(lambda: func(img_array, Flat_frame, Flat_frame_scalar, dark_frame, **kwargs), 
+                repeats))
+
+        print('{:>16s}'.format(name) + ''.join(['{:10.2f} ms'.format(t) for t in times]))
+
+    FF_bin_suite.tile_workers = old_tiles
+    FF_bin_suite.use_numba = old_numba
+
+
+
+def writeTestFF(file_path, ff):
+    """ Writes an FF structure into a file in the old CAMS FF*.bin format. """
+
+    with open(file_path, 'wb') as f:
+        np.array([ff.nrows], dtype=np.int32).tofile(f)
+        np.array([ff.ncols, 8, 0, 0], dtype=np.uint32).tofile(f)
+
+        for img_array in [ff.maxpixel, ff.maxframe, ff.avepixel, ff.stdpixel]:
+            img_array.astype(np.uint8).tofile(f)
+
+
+
+def benchmarkStacking(nrows=576, ncols=720, img_num=200):
+    """ Times the exact median, mean and min stacking of FF files, with the stack kept in memory and in a temporary
+        file.
+    """
+
+    ff_dir = tempfile.mkdtemp()
+
+    try:
+        file_list = []
+        for i in range(img_num):
+            file_list.append(os.path.join(ff_dir, 'FF000_{:04d}.bin'.format(i)))
+            writeTestFF(file_list[-1], makeTestFF(nrows, ncols, seed=i))
+
+        print('Stacking {:d} FF files, {:d}x{:d}'.format(img_num, ncols, nrows))
+        print('{:>10s}{:>13s}{:>13s}'.format('mode', 'in memory', 'temp. file'))
+
+        for mode in ['median', 'mean', 'min']:
+
+            times = [timeFunction(lambda: FF_bin_suite.stack_frames(file_list, mode, memory_limit=memory_limit), 1)
+                for memory_limit in [img_num*nrows*ncols, img_num*nrows*ncols//10]]
+
+            print('{:>10s}'.format(mode) + ''.join(['{:10.0f} ms'.format(t) for t in times]))
+
+    finally:
+        shutil.rmtree(ff_dir)
+
+
+
+def peakMemory(func):
+    """ Returns the peak memory in MB allocated while running the given function (NumPy arrays included), or NaN
+        if tracemalloc is not available.
+    """
+
+    if tracemalloc is None:
+        return float('nan')
+
+    tracemalloc.start()
+
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+
+    finally:
+        tracemalloc.stop()
+
+    return peak/1024.0**2
+
+
+
+def _float64VideoFrames(ff, start_frame, end_frame):
+    """ The former float64 brightening of buildFFStack, kept as a reference for benchmarkDtypes.
+    """
+
+    frames = np.arange(start_frame, end_frame + 1)
+    frame_mask = ff.maxframe[np.newaxis, :, :] == frames[:, np.newaxis, np.newaxis]
+
+    img_stack = np.where(frame_mask, ff.maxpixel, ff.avepixel).astype(ff.avepixel.dtype)
+    img_stack = img_stack * ff.adjustment_scalar*1.2 + 10
+
+    return np.clip(img_stack, 0, 255)
+
+
+
+def _float64AdjustLevels(img_array, minv, gamma, maxv):
+    """ The former float64 levels adjustment, kept as a reference for benchmarkDtypes.
+    """
+
+    img_array = img_array.astype(float)/255
+
+    img_array = ((img_array - minv/255.0)/(maxv/255.0 - minv/255.0))**(1.0/gamma)
+
+    return np.clip(img_array*255, 0, 255).astype(np.uint8)
+
+
+
+def _int16ColorizeMaxframe(ff, minv, gamma, maxv):
+    """ The former int16 colorize_maxframe with float64 levels, kept as a reference for benchmarkDtypes.
+    """
+
+    ff_maxframe_noavg = ff.maxpixel.astype(np.int16) - ff.avepixel.astype(np.int16)
+
+    odd_frame = _float64AdjustLevels(FF_bin_suite.deinterlace_array_odd(ff_maxframe_noavg), minv, gamma, maxv)
+    even_frame = _float64AdjustLevels(FF_bin_suite.deinterlace_array_even(ff_maxframe_noavg), minv, gamma, maxv)
+
+    avg_rgb = np.dstack([ff.avepixel.astype(np.int16)]*3)
+
+    return np.clip(np.dstack((odd_frame, even_frame, even_frame)) + avg_rgb, 0, 255).astype(np.uint8)
+
+
+
+def benchmarkDtypes(nrows=1080, ncols=1920, repeats=3):
+    """ Compares the run time and the peak memory of the former float64/int16 image paths with the uint8/float32
+        ones (see the data type policy in FF_bin_suite).
+    """
+
+    ff = makeTestFF(nrows, ncols)
+    ff.adjustment_scalar = 2.5
+
+    levels = (10, 1.5, 200)
+    frame_diff = np.subtract(ff.maxpixel, ff.avepixel, dtype=np.int16)
+
+    old_tiles = FF_bin_suite.tile_workers
+    FF_bin_suite.tile_workers = 1
+
+    paths = [
+        ('video frames', lambda: _float64VideoFrames(ff, 100, 131), lambda: FF_bin_suite.buildFFStack(ff, 100, 131)),
+        ('colorized', lambda: _int16ColorizeMaxframe(ff, *levels), lambda: FF_bin_suite.colorize_maxframe(ff, *levels)),
+        ('int16 levels', lambda: _float64AdjustLevels(frame_diff, *levels), 
+            lambda: FF_bin_suite.adjust_levels(frame_diff, *levels)),
+        ('lighten', lambda: (ff.maxpixel.astype(np.int16) - np.minimum(ff.maxpixel.astype(np.int16) - ff.avepixel, 
+            0)).astype(np.uint8), lambda: FF_bin_suite.blend_lighten(ff.maxpixel, ff.avepixel))
+        ]
+
+    print('Data types, {:d}x{:d} image'.format(ncols, nrows))
+    print('{:>14s}{:>13s}{:>13s}{:>13s}{:>13s}'.format('path', 'former', 'former peak', 'current', 'current peak'))
+
+    for name, former, current in paths:
+
+        # Levels below minv give NaN in the former path
+        with np.errstate(invalid='ignore'):
+            results = [timeFunction(former, repeats), peakMemory(former), timeFunction(current, repeats), 
+                peakMemory(current)]
+
+        print('{:>14s}'.format(name) + ''.join(['{:10.1f} ms{:10.1f} MB'.format(*results[i:i + 2]) 
+            for i in (0, 2)]))
+
+    FF_bin_suite.tile_workers = old_tiles
+
+
+
+benchmarks = {
+    'tiled': benchmarkTiledRendering,
+    'deinterlace': benchmarkDeinterlace,
+    'calibration': benchmarkCalibration,
+    'stacking': benchmarkStacking,
+    'dtypes': benchmarkDtypes
+    }
+
+
+
+if __name__ == '__main__':
+
+    names = sys.argv[1:] if len(sys.argv) > 1 else sorted(benchmarks.keys())
+
+    for name in names:
+        benchmarks[name]()
+        print()
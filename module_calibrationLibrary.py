@@ -0,0 +1,349 @@
+# coding=utf-8
+# Copyright 2014 Denis Vida, denis.vida@gmail.com
+
+# The module_calibrationLibrary is free software; you can redistribute
+# it and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, version 2.
+
+# The module_calibrationLibrary is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with the module_calibrationLibrary ; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+"""A per-station library of master dark and flat frames and bad pixel masks, shared by all nights.
+
+Masters are built from a directory of FF files and stored as BMP files in the library directory, one subdirectory
+per station. Bad pixel masks (hot and dead pixels, see find_bad_pixels) are built from one or more nights and
+stored as NPZ files with the coordinates of the bad pixels. They are indexed by station, frame type, night,
+resolution and data type in a JSON index file, so they are reused across sessions. For a given night, findMaster
+returns the compatible master (same station, resolution and data type) made on the nearest night.
+
+FF files carry no exposure time, so the resolution and the data type are used as the compatibility keys.
+"""
+
+import os
+import re
+import sys
+import json
+import logging
+import datetime
+import threading
+
+from FF_bin_suite import readFF, stack_frames, saveImage, load_dark, forgetCalibrationFrame, find_bad_pixels, \
+    save_bad_pixels
+
+
+log = logging.getLogger("CMN_binViewer")
+
+
+# Default library directory, next to the log directory
+if sys.platform == 'win32':
+    calibration_library_dir = os.path.join(os.getenv('APPDATA', '.'), 'CMN_binViewer_calibration')
+else:
+    calibration_library_dir = os.path.expanduser(os.path.join("~", ".CMN_binViewer_calibration"))
+
+# Name of the index file in the library directory
+index_file_name = 'calibration_index.json'
+
+
+
+def parseFFName(file_name):
+    """ Returns the station code and the time of the given FF file name as (station, datetime), or (None, None) if
+        the name cannot be parsed. Both CAMS (FF453_20160419_184117_248_0020992.bin) and RMS
+        (FF_HR0001_20200101_201530_123_0012345.fits) names are supported.
+    """
+
+    match = re.match(r'FF_?([A-Za-z0-9]+)_(\d{8})_(\d{6})', os.path.basename(file_name))
+
+    if match is None:
+        return None, None
+
+    try:
+        return match.group(1), datetime.datetime.strptime(match.group(2) + match.group(3), '%Y%m%d%H%M%S')
+
+    except ValueError:
+        return None, None
+
+
+
+def getNight(file_time):
+    """ Returns the night of the given time as a YYYYMMDD string, nights are counted from noon to noon, so the
+        whole night belongs to the evening date.
+    """
+
+    return (file_time - datetime.timedelta(hours=12)).strftime('%Y%m%d')
+
+
+
+class master_struct:
+    """ Library entry of a master frame.
+    """
+    def __init__(self, **kwargs):
+
+        # Station code, 'dark', 'flat' or 'badpixels', night (YYYYMMDD) and data type (1 CAMS, 2 Skypatrol, 3 RMS)
+        self.station = ''
+        self.frame_type = ''
+        self.night = ''
+        self.data_type = 1
+
+        # Resolution
+        self.nrows = 0
+        self.ncols = 0
+
+        # Number of FF files used, stacking mode and the path of the BMP (NPZ for bad pixels) file, relative to the 
+        # library directory
+        self.n_files = 0
+        self.stack_mode = 'median'
+        self.path = ''
+
+        self.__dict__.update(kwargs)
+
+
+
+class library_job:
+    """ Master frame being built in the background, see CalibrationLibrary.buildInBackground.
+    """
+    def __init__(self):
+
+        self.thread = None
+
+        # Built master_struct, or the exception which stopped the build
+        self.master = None
+        self.error = None
+
+
+    def isRunning(self):
+        return (self.thread is not None) and self.thread.is_alive()
+
+
+
+class CalibrationLibrary:
+    """ Index of master darks, flats and bad pixel masks in the library directory.
+    """
+    def __init__(self, library_dir=None):
+
+        if library_dir is None:
+            library_dir = calibration_library_dir
+
+        self.library_dir = library_dir
+        self.masters = []
+
+        # Masters can be added from background threads
+        self.lock = threading.RLock()
+
+        self.load()
+
+
+    def indexPath(self):
+        return os.path.join(self.library_dir, index_file_name)
+
+
+    def load(self):
+        """ Loads the library index, if it exists.
+        """
+
+        self.masters = []
+
+        if not os.path.isfile(self.indexPath()):
+            return
+
+        try:
+            with open(self.indexPath()) as f:
+                self.masters = [master_struct(**entry) for entry in json.load(f)]
+
+        except (IOError, ValueError) as error:
+            log.info('unable to read the calibration library index: {}'.format(error))
+
+
+    def save(self):
+        """ Writes the library index.
+        """
+
+        with self.lock:
+
+            if not os.path.isdir(self.library_dir):
+                os.makedirs(self.library_dir)
+
+            temp_path = self.indexPath() + '.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump([master.__dict__ for master in self.masters], f, indent=1, sort_keys=True)
+
+            # Replace the index only when it is fully written
+            if os.path.isfile(self.indexPath()):
+                os.remove(self.indexPath())
+            os.rename(temp_path, self.indexPath())
+
+
+    def masterPath(self, master):
+        """ Returns the full path of the BMP or NPZ file of the master.
+        """
+
+        return os.path.join(self.library_dir, master.path)
+
+
+    def addMaster(self, frame_type, ff_dir, data_type=1, station=None, night=None, stack_mode='median',
+        dark_path=None):
+        """ Builds a master frame or a bad pixel mask from the FF files in the given directory, stores it into the 
+            library and returns its master_struct. An existing master of the same station, type, night and 
+            resolution is replaced.
+
+        frame_type: 'dark', 'flat' or 'badpixels'
+        ff_dir: directory with FF files, or a list of directories (e.g. several nights for bad pixels)
+        data_type: 1 CAMS, 2 skypatrol, 3 RMS
+        station, night: station code and night (YYYYMMDD), by default read from the name of the first FF file
+        stack_mode: 'median', 'mean' or 'min', see stack_frames (not used for bad pixels)
+        dark_path: dark frame subtracted from flats, by default the nearest dark from the library (if any)
+        """
+
+        filetype = 'fits' if data_type == 3 else 'bin'
+
+        ff_dirs = list(ff_dir) if isinstance(ff_dir, (list, tuple)) else [ff_dir]
+
+        file_list = sorted([os.path.join(dir_path, file_name) for dir_path in ff_dirs 
+            for file_name in os.listdir(dir_path) if ('FF' in file_name) and (file_name.split('.')[-1] == filetype)], 
+            key=os.path.basename)
+
+        if not file_list:
+            raise ValueError("No FF files in " + ", ".join(ff_dirs))
+
+        file_station, file_time = parseFFName(file_list[0])
+
+        if station is None:
+            station = file_station
+
+        if night is None:
+            night = getNight(file_time) if file_time is not None else datetime.datetime.now().strftime('%Y%m%d')
+
+        if station is None:
+            raise ValueError("Cannot read the station code from " + file_list[0])
+
+        ff = readFF(file_list[0], datatype=data_type)
+        nrows, ncols = ff.avepixel.shape
+
+        dark_frame = None
+        if frame_type == 'flat':
+
+            if dark_path is None:
+                dark_path = self.findMaster('dark', station, night, (nrows, ncols), data_type)
+
+            if dark_path is not None:
+                dark_frame = load_dark(dark_path)
+
+        if frame_type == 'badpixels':
+            stack_mode = ''
+
+        master = master_struct(station=station, frame_type=frame_type, night=night, data_type=data_type,
+            nrows=nrows, ncols=ncols, n_files=len(file_list), stack_mode=stack_mode,
+            path=os.path.join(station, '{:s}_{:s}_{:d}x{:d}.{:s}'.format(frame_type, night, ncols, nrows, 
+                'npz' if frame_type == 'badpixels' else 'bmp')))
+
+        master_path = self.masterPath(master)
+        if not os.path.isdir(os.path.dirname(master_path)):
+            os.makedirs(os.path.dirname(master_path))
+
+        if frame_type == 'badpixels':
+            bad_pixels = find_bad_pixels(file_list, data_type)
+            save_bad_pixels(bad_pixels, master_path)
+
+            log.info('{:d} hot and {:d} dead pixels found'.format(int(bad_pixels.hot.sum()), 
+                int((~bad_pixels.hot).sum())))
+
+        else:
+            master_frame = stack_frames(file_list, stack_mode, dark_frame, data_type)
+            saveImage(master_frame, master_path, print_name=False)
+
+        # Forget the previous master with the same name
+        forgetCalibrationFrame(master_path)
+
+        with self.lock:
+            self.masters = [old for old in self.masters if old.path != master.path] + [master]
+            self.save()
+
+        log.info('{:s} master for station {:s}, night {:s} added to the calibration library'.format(frame_type,
+            station, night))
+
+        return master
+
+
+    def buildInBackground(self, *args, **kwargs):
+        """ Runs addMaster (with the same arguments) on a background thread and returns its library_job.
+        """
+
+        job = library_job()
+
+        def build():
+            try:
+                job.master = self.addMaster(*args, **kwargs)
+
+            except Exception as error:
+                log.info('calibration library build failed: {}'.format(error))
+                job.error = error
+
+        job.thread = threading.Thread(target=build)
+        job.thread.daemon = True
+        job.thread.start()
+
+        return job
+
+
+    def findMaster(self, frame_type, station, night, shape=None, data_type=None, max_days=None):
+        """ Returns the path of the master of the given type and station made on the night nearest to the given
+            one, or None if there is no such master. On equal distance, the earlier master is used.
+
+        frame_type: 'dark', 'flat' or 'badpixels'
+        station: station code
+        night: night as YYYYMMDD or a datetime
+        shape: (nrows, ncols) of the images, None to accept any resolution
+        data_type: data type, None to accept any
+        max_days: maximum distance in days, None for no limit
+        """
+
+        if isinstance(night, datetime.datetime):
+            night = getNight(night)
+
+        night_date = datetime.datetime.strptime(night, '%Y%m%d')
+
+        candidates = []
+
+        with self.lock:
+            for master in self.masters:
+
+                if (master.frame_type != frame_type) or (str(master.station) != str(station)):
+                    continue
+
+                if (shape is not None) and ((master.nrows, master.ncols) != tuple(shape)):
+                    continue
+
+                if (data_type is not None) and (master.data_type != data_type):
+                    continue
+
+                if not os.path.isfile(self.masterPath(master)):
+                    continue
+
+                days = (datetime.datetime.strptime(master.night, '%Y%m%d') - night_date).days
+
+                if (max_days is not None) and (abs(days) > max_days):
+                    continue
+
+                candidates.append((abs(days), days, self.masterPath(master)))
+
+        if not candidates:
+            return None
+
+        return min(candidates)[2]
+
+
+    def findMasterForFile(self, frame_type, ff_path, shape=None, data_type=None, max_days=None):
+        """ Returns the path of the nearest master for the night of the given FF file (see findMaster), or None.
+        """
+
+        station, file_time = parseFFName(ff_path)
+
+        if station is None:
+            return None
+
+        return self.findMaster(frame_type, station, file_time, shape, data_type, max_days)
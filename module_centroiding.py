@@ -0,0 +1,352 @@
+# coding=utf-8
+# Copyright 2014 Denis Vida, denis.vida@gmail.com
+
+# The module_centroiding is free software; you can redistribute
+# it and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, version 2.
+
+# The module_centroiding is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with the module_centroiding ; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+"""Sub-pixel refinement of the meteor positions in an FTPdetectinfo file, measured on the FF files.
+
+Every detection (frame, x, y) is moved to the intensity weighted centroid of maxpixel - avepixel in a small window
+around it, using only the pixels which peaked in the frame of the detection (maxframe == frame), i.e. the meteor
+as buildFF reconstructs it for that frame. If a meteor was detected on half-frames (e.g. 105.0 and 105.5), every
+detection is measured only on the rows of its field (see FF_bin_suite.fieldRowMask). The windows of all detections of a meteor are gathered at once with NumPy indexing, and the FF files of a night are
+measured in parallel.
+
+Only the x and y columns are rewritten. The RA, Dec, azimuth and altitude columns are kept, unless recomputing
+them from a sky map of the night is asked for (see module_skyMaps, which is only an approximation of the plate
+solution). All other lines and columns of the FTPdetectinfo file are kept as they are. The residuals (refined -
+original position) of every detection are written to a CSV file.
+
+Usage:
+    python module_centroiding.py night_dir [-f FTPdetectinfo] [-o refined.txt] [-w window_radius] [-p processes]
+        [-d data_type] [-s]
+"""
+
+from __future__ import print_function
+
+import os
+import re
+import csv
+import argparse
+import logging
+import multiprocessing
+
+import numpy as np
+
+from FF_bin_suite import readFF, fieldRowMask
+from module_calibrationLibrary import parseFFName
+from module_skyMaps import findPlatepar, getSkyMap, skyCoordinates, datetimeToJD
+
+
+log = logging.getLogger("CMN_binViewer")
+
+
+# Columns of the residuals CSV file
+residual_columns = ['ff_name', 'meteor_no', 'frame', 'x', 'y', 'x_refined', 'y_refined', 'dx', 'dy', 'weight']
+
+# Separator between the meteors of an FTPdetectinfo file
+meteor_separator = '-----'
+
+
+
+def readFTPdetectBlocks(lines):
+    """ Returns the meteors of the given FTPdetectinfo lines as a list of (ff_name, meteor_no, fps, line_indices),
+        where line_indices are the indices of the detection lines of the meteor.
+    """
+
+    blocks = []
+
+    if (not lines) or (int(lines[0].split('=')[1]) == 0):
+        return blocks
+
+    # Meteor blocks are separated by dashed lines: FF name, CAL name, meteor header and detections
+    block = []
+    for i in range(12, len(lines) + 1):
+
+        if (i == len(lines)) or lines[i].startswith(meteor_separator):
+
+            if len(block) >= 3:
+                ff_name = lines[block[0]].strip()
+                header = lines[block[2]].split()
+
+                blocks.append((ff_name, int(float(header[1])), float(header[3]), 
+                    [j for j in block[3:] if lines[j].strip()]))
+
+            block = []
+            continue
+
+        block.append(i)
+
+    return blocks
+
+
+
+def centroidDetections(ff, coordinates, window_radius=3, fields=None, data_type=1):
+    """ Returns the intensity weighted centroids of the given detections as (x, y, weight) arrays. Detections
+        without any meteor pixels in their window keep their position and get zero weight.
+
+    ff: FF structure
+    coordinates: (N, 3) array of detections (frame, x, y)
+    window_radius: half size of the square window around each detection, in pixels
+    fields: True if the detections are on half-frames, then only the rows of the field of each detection are
+        used; if None, half-frames are assumed if any of the frame numbers is fractional (default None)
+    data_type: 1 for CAMS, 2 for Skypatrol, 3 for RMS, gives the rows of the fields
+    """
+
+    coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 3)
+
+    frames = np.floor(coordinates[:, 0]).astype(np.int64)
+    rows_center = np.round(coordinates[:, 2]).astype(np.int64)
+    cols_center = np.round(coordinates[:, 1]).astype(np.int64)
+
+    dy, dx = np.mgrid[-window_radius:window_radius + 1, -window_radius:window_radius + 1]
+    dy, dx = dy.ravel(), dx.ravel()
+
+    # (N detections, M window pixels) indices, the window is cut at the image edges
+    rows = rows_center[:, np.newaxis] + dy
+    cols = cols_center[:, np.newaxis] + dx
+
+    nrows, ncols = ff.maxpixel.shape
+    inside = (rows >= 0) & (rows < nrows) & (cols >= 0) & (cols < ncols)
+
+    rows = np.clip(rows, 0, nrows - 1)
+    cols = np.clip(cols, 0, ncols - 1)
+
+    # Background subtracted intensity of the pixels which belong to the frame of the detection
+    # Only the rows of the field of half-frame detections
+    hits = inside & (ff.maxframe[rows, cols] == frames[:, np.newaxis]) & fieldRowMask(rows, coordinates[:, 0], 
+        data_type, fields)
+    weights = np.where(hits, ff.maxpixel[rows, cols].astype(np.float64) - ff.avepixel[rows, cols], 0)
+    weights = np.maximum(weights, 0)
+
+    weight = np.sum(weights, axis=1)
+    measured = weight > 0
+
+    x = np.array(coordinates[:, 1])
+    y = np.array(coordinates[:, 2])
+
+    x[measured] = np.sum(weights*cols, axis=1)[measured]/weight[measured]
+    y[measured] = np.sum(weights*rows, axis=1)[measured]/weight[measured]
+
+    return x, y, weight
+
+
+
+def replaceColumns(line, values):
+    """ Returns the FTPdetectinfo line with the given columns replaced, keeping the spacing of the line and the
+        width and the number of decimals of the replaced values.
+
+    line: line of the file
+    values: dictionary of column index: new value
+    """
+
+    # Columns and the whitespace between them
+    parts = re.split(r'(\s+)', line)
+    offset = 2 if parts[0] == '' else 0
+
+    for column, value in values.items():
+
+        token = parts[offset + 2*column]
+        decimals = len(token.split('.')[1]) if '.' in token else 0
+
+        if token.startswith('0') and (len(token.split('.')[0]) > 1):
+            parts[offset + 2*column] = '{:0{}.{}f}'.format(value, len(token), decimals)
+        else:
+            parts[offset + 2*column] = '{:.{}f}'.format(value, decimals)
+
+    return ''.join(parts)
+
+
+
+def _ffCentroids(task):
+    """ Measures all meteors detected on one FF file. Returns a list of (line_index, x, y, residual row), used by
+        refineFTPdetectLines.
+    """
+
+    ff_path, meteors, window_radius, data_type = task
+
+    try:
+        ff = readFF(ff_path, datatype=data_type)
+
+    except (IOError, OSError, ValueError) as error:
+        log.info('unable to read {:s}: {}'.format(ff_path, error))
+        return []
+
+    results = []
+    for meteor_no, line_indices, coordinates in meteors:
+
+        x, y, weight = centroidDetections(ff, coordinates, window_radius, data_type=data_type)
+
+        for i, line_index in enumerate(line_indices):
+            frame, x_old, y_old = coordinates[i]
+
+            results.append((line_index, x[i], y[i], [os.path.basename(ff_path), meteor_no, frame, x_old, y_old,
+                round(x[i], 2), round(y[i], 2), round(x[i] - x_old, 2), round(y[i] - y_old, 2), int(weight[i])]))
+
+    return results
+
+
+
+def skyColumns(lines, line_indices, x, y, jd, sky_map):
+    """ Returns the given lines with the RA, Dec, azimuth and altitude columns (3 to 6) of the detections at (x, y)
+        at the Julian dates jd read from the sky map. Lines with fewer columns are kept.
+    """
+
+    ra, dec, azim, elev = skyCoordinates(sky_map, x, y, jd)
+
+    lines = list(lines)
+    for i, line_index in enumerate(line_indices):
+
+        if len(lines[line_index].split()) >= 7:
+            lines[line_index] = replaceColumns(lines[line_index], {3: ra[i], 4: dec[i], 5: azim[i], 6: elev[i]})
+
+    return lines
+
+
+
+def refineFTPdetectLines(lines, ff_dir, window_radius=3, processes=None, data_type=1, sky_map=None):
+    """ Refines the positions of all detections in the given FTPdetectinfo lines. Returns the refined lines and
+        the residual CSV rows (see residual_columns). Detections on missing FF files are left as they are.
+
+    lines: lines of the FTPdetectinfo file
+    ff_dir: directory with the FF files
+    window_radius: half size of the centroiding window, in pixels
+    processes: number of worker processes (default: number of CPU cores)
+    data_type: 1 for CAMS, 2 for Skypatrol, 3 for RMS FITS files
+    sky_map: sky_map_struct of the night, the sky coordinates are computed again if given, otherwise they are
+        kept (default None)
+    """
+
+    # Group meteors by FF file, so every file is read only once
+    ff_meteors = {}
+    fps = {}
+    for ff_name, meteor_no, meteor_fps, line_indices in readFTPdetectBlocks(lines):
+
+        if not line_indices:
+            continue
+
+        fps.update((i, meteor_fps) for i in line_indices)
+
+        coordinates = np.array([[float(value) for value in lines[i].split()[:3]] for i in line_indices])
+        ff_meteors.setdefault(ff_name, []).append((meteor_no, line_indices, coordinates))
+
+    tasks = [(os.path.join(ff_dir, ff_name), ff_meteors[ff_name], window_radius, data_type)
+        for ff_name in sorted(ff_meteors)]
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    if (processes > 1) and (len(tasks) > 1):
+        pool = multiprocessing.Pool(min(processes, len(tasks)))
+
+        try:
+            results = pool.map(_ffCentroids, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+    else:
+        results = [_ffCentroids(task) for task in tasks]
+
+    refined_lines = list(lines)
+    residual_rows = []
+    sky_points = []
+
+    for ff_results in results:
+        for line_index, x, y, residual_row in ff_results:
+            refined_lines[line_index] = replaceColumns(lines[line_index], {1: x, 2: y})
+            residual_rows.append(residual_row)
+
+            # Time of the detection, from the FF file name and the frame
+            ff_time = parseFFName(residual_row[0])[1]
+
+            if ff_time is not None:
+                sky_points.append((line_index, x, y, datetimeToJD(ff_time) + residual_row[2]/fps[line_index]/86400.0))
+
+    # Sky coordinates of all detections at once
+    if (sky_map is not None) and sky_points:
+        line_indices, x, y, jd = [np.array(values) for values in zip(*sky_points)]
+        refined_lines = skyColumns(refined_lines, line_indices, x, y, jd, sky_map)
+
+    return refined_lines, residual_rows
+
+
+
+def writeResidualsCSV(rows, csv_path):
+    """ Writes residual rows from refineFTPdetectLines into a CSV file.
+    """
+
+    with open(csv_path, 'w') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(residual_columns)
+        writer.writerows(rows)
+
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser(description="Refines the meteor positions in an FTPdetectinfo file with "
+        "intensity weighted centroids.")
+    arg_parser.add_argument('night_dir', help="directory with FF files and the FTPdetectinfo file")
+    arg_parser.add_argument('-f', '--ftpdetectinfo', help="FTPdetectinfo file, if not the one in night_dir")
+    arg_parser.add_argument('-o', '--output', help="refined FTPdetectinfo file (default: the input file with a "
+        "_refined suffix), the residuals are written next to it as a CSV file")
+    arg_parser.add_argument('-w', '--window', type=int, default=3, help="centroiding window radius in pixels "
+        "(default 3)")
+    arg_parser.add_argument('-p', '--processes', type=int, help="number of processes (default: all CPU cores)")
+    arg_parser.add_argument('-d', '--datatype', type=int, default=1,
+        help="1 for CAMS, 2 for Skypatrol, 3 for RMS FITS files (default 1)")
+    arg_parser.add_argument('-s', '--sky', action='store_true', help="recompute the RA, Dec, azimuth and altitude "
+        "columns from the platepar in night_dir (approximate, see module_skyMaps), by default they are kept")
+
+    args = arg_parser.parse_args()
+
+    ftpdetect_path = args.ftpdetectinfo
+
+    if ftpdetect_path is None:
+        ftpdetect_files = sorted([file_name for file_name in os.listdir(args.night_dir) if
+            ("FTPdetectinfo_" in file_name) and (".txt" in file_name) and ("_original" not in file_name) and
+            ("_refined" not in file_name)])
+
+        if not ftpdetect_files:
+            print("FTPdetectinfo file in " + args.night_dir + " not found!")
+            raise SystemExit(1)
+
+        ftpdetect_path = os.path.join(args.night_dir, ftpdetect_files[0])
+
+    with open(ftpdetect_path) as f:
+        ftpdetect_lines = f.readlines()
+
+    # Sky coordinates are computed again from the platepar of the night only if asked for
+    sky_map = None
+
+    if args.sky:
+        platepar_path = findPlatepar(args.night_dir)
+
+        if platepar_path is None:
+            print("Platepar file in " + args.night_dir + " not found!")
+            raise SystemExit(1)
+
+        sky_map = getSkyMap(platepar_path)
+
+    refined_lines, residual_rows = refineFTPdetectLines(ftpdetect_lines, args.night_dir, args.window,
+        args.processes, args.datatype, sky_map)
+
+    output_path = args.output if args.output else os.path.splitext(ftpdetect_path)[0] + '_refined.txt'
+
+    with open(output_path, 'w') as f:
+        f.writelines(refined_lines)
+
+    writeResidualsCSV(residual_rows, os.path.splitext(output_path)[0] + '_residuals.csv')
+
+    print('{:d} detections refined, written to {:s}'.format(len(residual_rows), output_path))
@@ -0,0 +1,228 @@
+# coding=utf-8
+# Copyright 2014 Denis Vida, denis.vida@gmail.com
+
+# The module_numbaKernels is free software; you can redistribute
+# it and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, version 2.
+
+# The module_numbaKernels is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with the module_numbaKernels ; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+"""Optional JIT-compiled (numba) kernels for the pixel-level hot loops of FF_bin_suite.
+
+numba is not a hard dependency. If it cannot be imported, numba_available is False and FF_bin_suite keeps
+using its pure NumPy code. Every kernel produces exactly the same values as the NumPy path it replaces, this is
+checked on random data by tests/test_numba_kernels.py:
+
+    python -m pytest tests
+"""
+
+
+import numpy as np
+
+try:
+    import numba
+    numba_available = True
+
+except ImportError:
+    numba_available = False
+
+
+
+if numba_available:
+
+    @numba.njit(cache=True, nogil=True)
+    def build_frame(maxpixel, maxframe, background, kframe, scalar, bright, out, y0=0, x0=0):
+        """ Reconstructs the kframe (or a window of it starting at (y0, x0)) into the out array.
+
+        maxpixel, maxframe, background: full size FF arrays
+        kframe: frame number
+        scalar: adjustment scalar used for video brightening
+        bright: if True, the video brightening from buildFF is applied
+        out: output array, its shape defines the window size (may be the background itself)
+        """
+
+        nrows, ncols = out.shape
+
+        for i in range(nrows):
+            for j in range(ncols):
+
+                if maxframe[y0 + i, x0 + j] == kframe:
+                    v = maxpixel[y0 + i, x0 + j]
+                else:
+                    v = background[y0 + i, x0 + j]
+
+                if bright:
+                    out[i, j] = min(max(v*scalar*1.2 + 10, 0.0), 255.0)
+                else:
+                    out[i, j] = v
+
+        return out
+
+
+
+    @numba.njit(cache=True, nogil=True)
+    def deinterlace_odd(img, out):
+        """ Same as FF_bin_suite.deinterlace_array_odd for 2D images, out may be img itself. """
+
+        nrows, ncols = img.shape
+
+        for i in range(nrows - 1):
+
+            # Odd rows are replaced by the next even one
+            src = i + (i % 2)
+
+            for j in range(ncols):
+                out[i, j] = img[src, j]
+
+        for j in range(ncols):
+            out[nrows - 1, j] = 0
+
+        return out
+
+
+
+    @numba.njit(cache=True, nogil=True)
+    def deinterlace_even(img, out):
+        """ Same as FF_bin_suite.deinterlace_array_even for 2D images, out may be img itself. """
+
+        nrows, ncols = img.shape
+
+        # The last row is always kept
+        parity = (nrows - 1) % 2
+
+        for i in range(nrows):
+
+            if i % 2 == parity:
+                src = i
+            else:
+                src = i + 1
+
+            for j in range(ncols):
+                out[i, j] = img[src, j]
+
+        return out
+
+
+
+    @numba.njit(cache=True, nogil=True)
+    def calibrate(img, dark_int16, flat_gain, out):
+        """ Same as FF_bin_suite.calibrate_array for 2D images: (img - dark)*flat_gain in float32, clipped to 
+        0-255, into an uint8 out array. dark_int16 and flat_gain may be None.
+        """
+
+        nrows, ncols = img.shape
+
+        for i in range(nrows):
+            for j in range(ncols):
+
+                v = np.float32(img[i, j])
+
+                if dark_int16 is not None:
+                    v = v - np.float32(dark_int16[i, j])
+
+                if flat_gain is not None:
+                    v = v*flat_gain[i, j]
+
+                if v < 0:
+                    v = np.float32(0)
+                elif v > 255:
+                    v = np.float32(255)
+
+                out[i, j] = np.uint8(v)
+
+        return out
+
+
+
+    @numba.njit(cache=True, nogil=True)
+    def apply_lut(img, lut, out):
+        """ Maps a flattened array of 8-bit values through a 256 element lookup table. """
+
+        for i in range(img.size):
+            out[i] = lut[img[i]]
+
+        return out
+
+
+
+    @numba.njit(cache=True, nogil=True, parallel=True)
+    def median_stack(img_stack, out):
+        """ Same as FF_bin_suite.median_stack for (N, nrows, ncols) stacks with N > 2, rows are processed in parallel.
+        For even N, out must be a float64 array.
+        """
+
+        n, nrows, ncols = img_stack.shape
+        middle = n//2
+        even = n%2 == 0
+
+        for i in numba.prange(nrows):
+
+            pixel_values = np.empty(n, dtype=img_stack.dtype)
+
+            for j in range(ncols):
+
+                # Insertion sort, faster than a general sort for the short per-pixel arrays
+                for k in range(n):
+                    v = img_stack[k, i, j]
+
+                    m = k
+                    while (m > 0) and (pixel_values[m - 1] > v):
+                        pixel_values[m] = pixel_values[m - 1]
+                        m -= 1
+
+                    pixel_values[m] = v
+
+                if even:
+                    out[i, j] = (np.float64(pixel_values[middle - 1]) + np.float64(pixel_values[middle]))/2
+                else:
+                    out[i, j] = pixel_values[middle]
+
+        return out
+
+
+
+    @numba.njit(cache=True, nogil=True, parallel=True)
+    def median_stack_uint8(img_stack, out):
+        """ Same as median_stack for uint8 stacks, the middle values are found by counting the pixel levels, which
+        is faster than sorting for big stacks.
+        """
+
+        n, nrows, ncols = img_stack.shape
+        middle = n//2
+        even = n%2 == 0
+
+        for i in numba.prange(nrows):
+
+            counts = np.empty(256, dtype=np.int32)
+
+            for j in range(ncols):
+
+                counts[:] = 0
+                for k in range(n):
+                    counts[img_stack[k, i, j]] += 1
+
+                # Find the levels of the middle sorted values (middle - 1 and middle for even N)
+                total = 0
+                lower = -1
+                for level in range(256):
+                    total += counts[level]
+
+                    if even and (lower < 0) and (total > middle - 1):
+                        lower = level
+
+                    if total > middle:
+                        if even:
+                            out[i, j] = (lower + level)/2.0
+                        else:
+                            out[i, j] = level
+                        break
+
+        return out
+
@@ -0,0 +1,270 @@
+# coding=utf-8
+# Copyright 2014 Denis Vida, denis.vida@gmail.com
+
+# The module_overlay is free software; you can redistribute
+# it and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, version 2.
+
+# The module_overlay is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with the module_overlay ; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+"""Sparse overlay layers with detection markers and meteor guidelines, drawn over images at display time.
+
+A layer is rasterized only once per file and meteor (see getOverlay) and holds only the marked pixels, so
+compositing it costs one copy of the image, no matter how often the image below it is rendered again.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+
+
+# Rasterized layers, by the key given to getOverlay
+overlay_cache = OrderedDict()
+
+# Maximum number of cached layers
+overlay_cache_size = 16
+
+
+
+class overlay_layer:
+    """ Sparse RGB overlay, pixels are painted in order, so later pixels cover the earlier ones.
+    """
+    def __init__(self, shape):
+
+        # Shape (rows, columns) of the image the layer is drawn on
+        self.shape = tuple(shape[:2])
+
+        # Row and column indices of the marked pixels, and their RGB colors
+        self.rows = np.zeros(0, dtype=np.intp)
+        self.cols = np.zeros(0, dtype=np.intp)
+        self.colors = np.zeros((0, 3), dtype=np.uint8)
+
+
+    def paint(self, rows, cols, color):
+        """ Adds pixels of the given RGB color to the layer. Pixels outside the image are skipped.
+        """
+
+        rows, cols = np.broadcast_arrays(np.asarray(rows, dtype=np.intp), np.asarray(cols, dtype=np.intp))
+        rows, cols = rows.ravel(), cols.ravel()
+
+        inside = (rows >= 0) & (rows < self.shape[0]) & (cols >= 0) & (cols < self.shape[1])
+        rows, cols = rows[inside], cols[inside]
+
+        self.rows = np.concatenate((self.rows, rows))
+        self.cols = np.concatenate((self.cols, cols))
+        self.colors = np.concatenate((self.colors, np.tile(np.array(color, dtype=np.uint8), (len(rows), 1))))
+
+
+    def isGray(self):
+        """ Returns True if all colors of the layer are shades of gray.
+        """
+
+        return bool(np.all(self.colors == self.colors[:, :1]))
+
+
+
+def compositeOverlay(image_array, layer):
+    """ Returns a copy of the image with the overlay painted over it. Grayscale images are converted to RGB, unless
+        the layer is gray too.
+
+    image_array: 8-bit grayscale or RGB image
+    layer: overlay_layer of the same size
+    """
+
+    if image_array.shape[:2] != layer.shape:
+        raise ValueError("Overlay size {} does not match the image size {}".format(layer.shape, image_array.shape[:2]))
+
+    if image_array.ndim == 2:
+
+        if layer.isGray():
+            composited = np.array(image_array)
+            composited[layer.rows, layer.cols] = layer.colors[:, 0]
+
+            return composited
+
+        composited = np.dstack((image_array, image_array, image_array))
+
+    else:
+        composited = np.array(image_array)
+
+    composited[layer.rows, layer.cols] = layer.colors
+
+    return composited
+
+
+
+def mergeOverlays(layers):
+    """ Returns a layer with the pixels of all given layers (None entries are skipped), later layers cover the
+        earlier ones. Returns None if there are no layers.
+    """
+
+    layers = [layer for layer in layers if layer is not None]
+
+    if not layers:
+        return None
+
+    if len(layers) == 1:
+        return layers[0]
+
+    merged = overlay_layer(layers[0].shape)
+    merged.rows = np.concatenate([layer.rows for layer in layers])
+    merged.cols = np.concatenate([layer.cols for layer in layers])
+    merged.colors = np.concatenate([layer.colors for layer in layers])
+
+    return merged
+
+
+
+def getOverlay(key, build_function, *args, **kwargs):
+    """ Returns the cached layer for the given key (e.g. image path, meteor number and image size), or builds it with
+        build_function(*args, **kwargs).
+    """
+
+    if key in overlay_cache:
+        overlay_cache[key] = overlay_cache.pop(key)
+
+    else:
+        overlay_cache[key] = build_function(*args, **kwargs)
+
+        while len(overlay_cache) > overlay_cache_size:
+            overlay_cache.popitem(last=False)
+
+    return overlay_cache[key]
+
+
+
+def minimumEdge(var_min, var_max, img_var_size, edge_minimum):
+    """ Extends the range to the minimum edge width and clips it to the image size. """
+
+    if var_min > var_max:
+        var_min, var_max = var_max, var_min
+
+    if abs(var_max - var_min) < edge_minimum:
+        var_diff = int((edge_minimum - abs(var_max - var_min)) /2)
+        var_max += var_diff
+
+        var_min -= var_diff
+
+    if var_max >= img_var_size:
+        var_max = img_var_size - 1
+
+    if var_min < 0:
+        var_min = 0
+
+    return var_min, var_max
+
+
+
+def rasterizeDetections(shape, detections_array, edge_marker=True, edge_thickness=2, edge_minimum=36):
+    """ Returns a layer with the detection points in green and, optionally, red markers of their range on the top and
+        the left edge of the image.
+
+    shape: image shape
+    detections_array: list of detections (frame, x, y)
+    edge_marker: marks the detection on the edge of an image if True with red
+    edge_thickness: edge marker thickness in pixels
+    edge_minimum: minimum edge width in pixels
+    """
+
+    layer = overlay_layer(shape)
+
+    _, x, y = zip(*detections_array)
+
+    # Detection points
+    layer.paint(y, x, (0, 255, 0))
+
+    if edge_marker:
+
+        # Find the range of edge pixels to draw
+        row_min, row_max = minimumEdge(min(y), max(y) + 1, layer.shape[0], edge_minimum)
+        col_min, col_max = minimumEdge(min(x), max(x) + 1, layer.shape[1], edge_minimum)
+
+        for border_px in range(edge_thickness):
+
+            # Left edge, then top edge
+            layer.paint(np.arange(row_min, row_max), border_px, (255, 0, 0))
+            layer.paint(border_px, np.arange(col_min, col_max), (255, 0, 0))
+
+    return layer
+
+
+
+def rasterizeMeteorPath(shape, rho, phi, path_width=20, color=(255, 255, 255)):
+    """ Returns a layer with two dotted guides parallel to the meteor, given by its Hough transform parameters.
+
+    shape: image shape
+    rho: HT parameter (distance from the center of the image)
+    phi: HT parameter (counter-clockwise positive from the +horizontal axis)
+    path_width: distance from the meteor to individual guide (pixels)
+    color: RGB color of the guides
+    """
+
+    layer = overlay_layer(shape)
+
+    y_size, x_size = layer.shape
+
+    phi = np.radians(phi + 90)
+
+    a = np.cos(phi)
+    b = np.sin(phi)
+
+    img_diag = int(np.sqrt(x_size**2 + y_size**2))
+
+    for width in [-path_width, path_width]:
+
+        rho_expanded = rho + width
+
+        # HT coordinate system starts in the middle of the image
+        x0 = a*rho_expanded + int(y_size/2)
+        y0 = b*rho_expanded + int(x_size/2)
+
+        x1 = int(x0 + img_diag*(-b))
+        y1 = int(y0 + img_diag*(a))
+        x2 = int(x0 - img_diag*(-b))
+        y2 = int(y0 - img_diag*(a))
+
+        length = int(np.hypot(x2 - x1, y2 - y1))
+
+        # Take only every 5th point of the line
+        rows = np.linspace(x1, x2, length).astype(int)[::5]
+        cols = np.linspace(y1, y2, length).astype(int)[::5]
+
+        layer.paint(rows, cols, color)
+
+    return layer
+
+
+
+def rasterizeSkyGrid(shape, ra_map, dec_map, decimation=1, step=10, color=(0, 160, 255)):
+    """ Returns a layer with the lines of constant RA and Dec every step degrees, drawn on the samples of the sky
+        map where the coordinate crosses a line.
+
+    shape: image shape
+    ra_map, dec_map: RA and Dec grids of the sky map, in degrees
+    decimation: sampling step of the grids, in pixels
+    step: distance between the lines, in degrees
+    color: RGB color of the lines
+    """
+
+    layer = overlay_layer(shape)
+
+    for coordinate_map in (ra_map, dec_map):
+
+        cell = np.floor(coordinate_map/float(step))
+
+        # Samples whose right or lower neighbour is on the other side of a line
+        crossing = np.zeros(cell.shape, dtype=bool)
+        crossing[:, :-1] |= cell[:, :-1] != cell[:, 1:]
+        crossing[:-1, :] |= cell[:-1, :] != cell[1:, :]
+
+        rows, cols = np.nonzero(crossing)
+        layer.paint(rows*decimation, cols*decimation, color)
+
+    return layer
@@ -0,0 +1,294 @@
+# coding=utf-8
+# Copyright 2014 Denis Vida, denis.vida@gmail.com
+
+# The module_photometry is free software; you can redistribute
+# it and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, version 2.
+
+# The module_photometry is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with the module_photometry ; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+"""Aperture photometry of the meteors in an FTPdetectinfo file, measured on the FF files they were detected on.
+
+For every detection (frame, x, y), the flux is the sum of maxpixel - avepixel over the pixels of a circular
+aperture which peaked in that frame (maxframe == frame), the same pixels buildFF puts on top of the background.
+Detections made on half-frames (e.g. 105.0 and 105.5) are measured only on the rows of their field (see
+FF_bin_suite.fieldRowMask), so the two fields of a frame do not share the same pixels. All detections of a meteor
+are measured at once with NumPy indexing, and the meteors of a night are measured in parallel, one FF file per
+task.
+
+Usage:
+    python module_photometry.py night_dir [-o lightcurves.csv] [-r aperture_radius] [-p processes] [-d data_type]
+"""
+
+from __future__ import print_function
+
+import os
+import csv
+import argparse
+import logging
+import multiprocessing
+
+import numpy as np
+
+from FF_bin_suite import readFF, fieldRowMask
+
+
+log = logging.getLogger("CMN_binViewer")
+
+
+# Columns of the lightcurve CSV file
+lightcurve_columns = ['ff_name', 'meteor_no', 'frame', 'x', 'y', 'flux', 'background', 'peak', 'saturated',
+    'aperture_pixels']
+
+
+
+class meteor_struct:
+    """ Detection of a single meteor from an FTPdetectinfo file.
+    """
+    def __init__(self):
+
+        self.ff_name = ''
+        self.meteor_no = 0
+        self.fps = 0
+
+        # Hough transform parameters of the meteor line
+        self.HT_rho = 0
+        self.HT_phi = 0
+
+        # Detections as an (N, 3) array of (frame, x, y)
+        self.coordinates = np.zeros((0, 3))
+
+
+
+def readFTPdetectMeteors(ftpdetect_path):
+    """ Returns a list of meteor_struct objects with all meteors from the given FTPdetectinfo file.
+    """
+
+    with open(ftpdetect_path) as f:
+        lines = f.readlines()
+
+    meteors = []
+
+    if (not lines) or (int(lines[0].split('=')[1]) == 0):
+        return meteors
+
+    # Meteor blocks are separated by dashed lines: FF name, CAL name, meteor header and detections
+    block = []
+    for line in lines[12:] + ['-----']:
+
+        if line.startswith('-----'):
+
+            if len(block) >= 3:
+
+                header = block[2].split()
+
+                meteor = meteor_struct()
+                meteor.ff_name = block[0].strip()
+                meteor.meteor_no = int(float(header[1]))
+                meteor.fps = float(header[3])
+                meteor.HT_rho = float(header[-2])
+                meteor.HT_phi = float(header[-1])
+
+                coordinates = [[float(value) for value in detection.split()[:3]] for detection in block[3:]
+                    if detection.strip()]
+
+                meteor.coordinates = np.array(coordinates, dtype=np.float64).reshape(-1, 3)
+
+                meteors.append(meteor)
+
+            block = []
+            continue
+
+        block.append(line)
+
+    return meteors
+
+
+
+def getApertureOffsets(aperture_radius):
+    """ Returns the (row, column) offsets of the pixels in a circular aperture of the given radius.
+    """
+
+    r = int(np.ceil(aperture_radius))
+    dy, dx = np.mgrid[-r:r + 1, -r:r + 1]
+
+    inside = dy**2 + dx**2 <= aperture_radius**2
+
+    return dy[inside], dx[inside]
+
+
+
+def meteorLightcurve(ff, coordinates, aperture_radius=5, saturation=255, data_type=1):
+    """ Measures the background subtracted flux of each detection of a meteor. Returns a dictionary of per
+        detection arrays: flux, background (mean avepixel in the aperture), peak (largest maxpixel value of the
+        meteor in the aperture), saturated (number of saturated meteor pixels) and aperture_pixels.
+
+    ff: FF structure
+    coordinates: (N, 3) array of detections (frame, x, y)
+    aperture_radius: aperture radius in pixels
+    saturation: pixel value at which the pixel is saturated
+    data_type: 1 for CAMS, 2 for Skypatrol, 3 for RMS, gives the rows of the fields of half-frame detections
+    """
+
+    coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 3)
+
+    frames = np.floor(coordinates[:, 0]).astype(np.int64)
+    rows_center = np.round(coordinates[:, 2]).astype(np.int64)
+    cols_center = np.round(coordinates[:, 1]).astype(np.int64)
+
+    dy, dx = getApertureOffsets(aperture_radius)
+
+    # (N detections, M aperture pixels) indices, the aperture is cut at the image edges
+    rows = rows_center[:, np.newaxis] + dy
+    cols = cols_center[:, np.newaxis] + dx
+
+    nrows, ncols = ff.maxpixel.shape
+    inside = (rows >= 0) & (rows < nrows) & (cols >= 0) & (cols < ncols)
+
+    rows = np.clip(rows, 0, nrows - 1)
+    cols = np.clip(cols, 0, ncols - 1)
+
+    maxpixel = ff.maxpixel[rows, cols].astype(np.int64)
+    avepixel = ff.avepixel[rows, cols].astype(np.int64)
+
+    # Pixels of the aperture which belong to the frame (or the field of half-frame detections) of the detection
+    hits = inside & (ff.maxframe[rows, cols] == frames[:, np.newaxis]) & fieldRowMask(rows, coordinates[:, 0], 
+        data_type)
+
+    aperture_pixels = np.count_nonzero(inside, axis=1)
+
+    lightcurve = {}
+    lightcurve['flux'] = np.sum(np.where(hits, maxpixel - avepixel, 0), axis=1)
+    lightcurve['background'] = np.sum(np.where(inside, avepixel, 0), axis=1)/np.maximum(aperture_pixels, 1).astype(
+        np.float64)
+    lightcurve['peak'] = np.max(np.where(hits, maxpixel, 0), axis=1)
+    lightcurve['saturated'] = np.count_nonzero(hits & (maxpixel >= saturation), axis=1)
+    lightcurve['aperture_pixels'] = aperture_pixels
+
+    return lightcurve
+
+
+
+def lightcurveRows(meteor, lightcurve):
+    """ Returns the CSV rows (lists of values in the lightcurve_columns order) of the measured meteor.
+    """
+
+    rows = []
+
+    for i, (frame, x, y) in enumerate(meteor.coordinates):
+        rows.append([meteor.ff_name, meteor.meteor_no, frame, x, y, int(lightcurve['flux'][i]),
+            round(float(lightcurve['background'][i]), 2), int(lightcurve['peak'][i]),
+            int(lightcurve['saturated'][i]), int(lightcurve['aperture_pixels'][i])])
+
+    return rows
+
+
+
+def _ffLightcurves(task):
+    """ Measures all meteors detected on one FF file. Returns a list of CSV rows, used by getNightLightcurves.
+    """
+
+    ff_path, meteors, aperture_radius, data_type = task
+
+    try:
+        ff = readFF(ff_path, datatype=data_type)
+
+    except (IOError, OSError, ValueError) as error:
+        log.info('unable to read {:s}: {}'.format(ff_path, error))
+        return []
+
+    rows = []
+    for meteor in meteors:
+        rows += lightcurveRows(meteor, meteorLightcurve(ff, meteor.coordinates, aperture_radius, 
+            data_type=data_type))
+
+    return rows
+
+
+
+def getNightLightcurves(night_dir, ftpdetect_path=None, aperture_radius=5, processes=None, data_type=1):
+    """ Measures the lightcurves of all meteors in the FTPdetectinfo file of the given night. Returns a list of
+        CSV rows (see lightcurve_columns).
+
+    night_dir: directory with FF files
+    ftpdetect_path: FTPdetectinfo file (default: the first one found in night_dir)
+    aperture_radius: aperture radius in pixels
+    processes: number of worker processes (default: number of CPU cores)
+    data_type: 1 for CAMS, 2 for Skypatrol, 3 for RMS FITS files
+    """
+
+    if ftpdetect_path is None:
+        ftpdetect_files = sorted([file_name for file_name in os.listdir(night_dir) if
+            ("FTPdetectinfo_" in file_name) and (".txt" in file_name) and ("_original" not in file_name)])
+
+        if not ftpdetect_files:
+            log.info("FTPdetectinfo file in " + night_dir + " not found!")
+            return []
+
+        ftpdetect_path = os.path.join(night_dir, ftpdetect_files[0])
+
+    # Group meteors by FF file, so every file is read only once
+    ff_meteors = {}
+    for meteor in readFTPdetectMeteors(ftpdetect_path):
+        ff_meteors.setdefault(meteor.ff_name, []).append(meteor)
+
+    tasks = [(os.path.join(night_dir, ff_name), ff_meteors[ff_name], aperture_radius, data_type)
+        for ff_name in sorted(ff_meteors)]
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    if (processes > 1) and (len(tasks) > 1):
+        pool = multiprocessing.Pool(min(processes, len(tasks)))
+
+        try:
+            results = pool.map(_ffLightcurves, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+    else:
+        results = [_ffLightcurves(task) for task in tasks]
+
+    return [row for ff_rows in results for row in ff_rows]
+
+
+
+def writeLightcurvesCSV(rows, csv_path):
+    """ Writes lightcurve rows from getNightLightcurves into a CSV file.
+    """
+
+    with open(csv_path, 'w') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(lightcurve_columns)
+        writer.writerows(rows)
+
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser(description="Measures lightcurves of all meteors in an FTPdetectinfo file.")
+    arg_parser.add_argument('night_dir', help="directory with FF files and the FTPdetectinfo file")
+    arg_parser.add_argument('-f', '--ftpdetectinfo', help="FTPdetectinfo file, if not the one in night_dir")
+    arg_parser.add_argument('-o', '--output', help="output CSV file (default: lightcurves.csv in night_dir)")
+    arg_parser.add_argument('-r', '--radius', type=float, default=5, help="aperture radius in pixels (default 5)")
+    arg_parser.add_argument('-p', '--processes', type=int, help="number of processes (default: all CPU cores)")
+    arg_parser.add_argument('-d', '--datatype', type=int, default=1,
+        help="1 for CAMS, 2 for Skypatrol, 3 for RMS FITS files (default 1)")
+
+    args = arg_parser.parse_args()
+
+    lightcurve_rows = getNightLightcurves(args.night_dir, args.ftpdetectinfo, args.radius, args.processes,
+        args.datatype)
+
+    csv_path = args.output if args.output else os.path.join(args.night_dir, 'lightcurves.csv')
+    writeLightcurvesCSV(lightcurve_rows, csv_path)
+
+    print('{:d} detections written to {:s}'.format(len(lightcurve_rows), csv_path))
@@ -0,0 +1,203 @@
+# coding=utf-8
+# Copyright 2014 Denis Vida, denis.vida@gmail.com
+
+# The module_renderPipeline is free software; you can redistribute
+# it and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, version 2.
+
+# The module_renderPipeline is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with the module_renderPipeline ; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+"""A small graph of memoized image products, used for rendering images in CMN_binViewer.
+
+Every node is a function of the products of its input nodes and of some render parameters (e.g. the image path,
+the dark frame or the deinterlace flag). A product is computed only when the parameters of the node or of any
+node upstream of it change, otherwise the memoized product is returned. Products are kept per image, for the
+last few images.
+
+Products are computed on the render worker (see module_renderWorker), while the main thread may clear the
+pipeline, so the bookkeeping of the products is guarded by a lock. Only one thread should compute products.
+
+Usage:
+    pipeline = RenderPipeline()
+    pipeline.addNode('ff', readFF, params=('img_path', ))
+    pipeline.addNode('maxpixel', lambda ff: ff.maxpixel, inputs=('ff', ))
+
+    img_array = pipeline.get('maxpixel', {'img_path': 'FF453_20160419_184117_248_0020992.bin'})
+"""
+
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+log = logging.getLogger("CMN_binViewer")
+
+
+
+class RenderNode:
+    """ A node of the render pipeline, with its timing statistics.
+    """
+    def __init__(self, name, function, inputs, params):
+
+        # Node name
+        self.name = name
+
+        # Function which computes the product, called as function(*input_products, *param_values)
+        self.function = function
+
+        # Names of input nodes and render parameters
+        self.inputs = tuple(inputs)
+        self.params = tuple(params)
+
+        # Number of computations and memoized returns
+        self.computed = 0
+        self.memoized = 0
+
+        # Duration of the last computation and the total computation time (seconds)
+        self.last_time = 0
+        self.total_time = 0
+
+
+
+class RenderPipeline:
+    """ A graph of render nodes with per-image memoization of their products.
+    """
+    def __init__(self, max_images=2, max_products=4):
+        """
+        max_images: number of images for which the products are kept
+        max_products: number of products kept per node and image (e.g. for different levels)
+        """
+
+        self.nodes = OrderedDict()
+
+        self.max_images = max_images
+        self.max_products = max_products
+
+        # Image key -> {node name: OrderedDict(product key -> product)}
+        self.products = OrderedDict()
+
+        self.lock = threading.RLock()
+
+
+    def addNode(self, name, function, inputs=(), params=()):
+        """ Registers a node. Input nodes have to be registered before the nodes which use them.
+
+        name: node name
+        function: function(*input_products, *param_values) which returns the product of the node
+        inputs: names of input nodes
+        params: names of render parameters the node depends on
+        """
+
+        for input_name in inputs:
+            if input_name not in self.nodes:
+                raise ValueError("Unknown input node '{:s}' of node '{:s}'".format(input_name, name))
+
+        self.nodes[name] = RenderNode(name, function, inputs, params)
+
+
+    def productKey(self, name, params):
+        """ Returns the key of the product of the given node, made of its parameters and the keys of its inputs.
+        """
+
+        node = self.nodes[name]
+
+        return (tuple(params[param] for param in node.params),
+            tuple(self.productKey(input_name, params) for input_name in node.inputs))
+
+
+    def get(self, name, params, image_key='img_path'):
+        """ Returns the product of the given node, computing only the nodes whose parameters have changed.
+
+        name: node name
+        params: dictionary of render parameters
+        image_key: name of the parameter which identifies the image the products are kept for
+        """
+
+        image = params[image_key]
+
+        with self.lock:
+
+            if image in self.products:
+                self.products[image] = self.products.pop(image)
+
+            else:
+                self.products[image] = {}
+
+                # Forget the products of the least recently used image
+                while len(self.products) > self.max_images:
+                    self.products.popitem(last=False)
+
+            image_products = self.products[image]
+
+        # Products are computed outside of the lock, so clearing never waits for a render
+        return self._evaluate(name, params, image_products)
+
+
+    def _evaluate(self, name, params, image_products):
+        """ Returns the memoized product of the node, or computes it and its inputs if needed.
+        """
+
+        node = self.nodes[name]
+        node_products = image_products.setdefault(name, OrderedDict())
+
+        product_key = self.productKey(name, params)
+
+        if product_key in node_products:
+            node.memoized += 1
+            return node_products[product_key]
+
+        input_products = [self._evaluate(input_name, params, image_products) for input_name in node.inputs]
+
+        t1 = time.time()
+        product = node.function(*(input_products + [params[param] for param in node.params]))
+        node.last_time = time.time() - t1
+
+        node.computed += 1
+        node.total_time += node.last_time
+
+        log.debug("Render node '{:s}' computed in {:.1f} ms".format(name, 1000*node.last_time))
+
+        # Products are shared between renders, so they must not be modified by the caller
+        if isinstance(product, np.ndarray):
+            product.setflags(write=False)
+
+        node_products[product_key] = product
+
+        while len(node_products) > self.max_products:
+            node_products.popitem(last=False)
+
+        return product
+
+
+    def clear(self):
+        """ Forgets all products.
+        """
+
+        with self.lock:
+            self.products = OrderedDict()
+
+
+    def timingReport(self):
+        """ Returns a text table with the timing statistics of each node.
+        """
+
+        lines = ['{:<22s}{:>10s}{:>10s}{:>12s}{:>12s}'.format('node', 'computed', 'memoized', 'last [ms]',
+            'mean [ms]')]
+
+        for node in self.nodes.values():
+            mean_time = node.total_time/node.computed if node.computed else 0
+
+            lines.append('{:<22s}{:>10d}{:>10d}{:>12.1f}{:>12.1f}'.format(node.name, node.computed, node.memoized,
+                1000*node.last_time, 1000*mean_time))
+
+        return '\n'.join(lines)
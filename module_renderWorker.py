@@ -0,0 +1,153 @@
+# coding=utf-8
+# Copyright 2014 Denis Vida, denis.vida@gmail.com
+
+# The module_renderWorker is free software; you can redistribute
+# it and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, version 2.
+
+# The module_renderWorker is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with the module_renderWorker ; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+"""A background thread which renders images for CMN_binViewer, so the Tk main thread is never blocked.
+
+Every request gets a generation number, and a new request supersedes all older ones: a request which has not
+started yet is dropped, a running one can check isStale() and give up early, and the result of a superseded
+request is thrown away. The main thread polls takeResult() (e.g. with Tk after()) and gets only the result of the
+newest request. Tk objects must not be used in the render functions, they run on the worker thread.
+
+Usage:
+    worker = RenderWorker()
+    generation = worker.submit(render_function, img_path, params)
+    ...
+    result = worker.takeResult()    # None until the newest request is done
+"""
+
+import threading
+import logging
+import traceback
+
+
+log = logging.getLogger("CMN_binViewer")
+
+
+
+class render_result:
+    """ Result of a render request.
+    """
+    def __init__(self, generation, value=None, error=None):
+
+        self.generation = generation
+
+        # Return value of the render function, or the exception it raised
+        self.value = value
+        self.error = error
+
+
+
+class RenderWorker:
+    """ Single worker thread which runs only the newest render request.
+    """
+    def __init__(self):
+
+        self.condition = threading.Condition()
+
+        # Generation of the newest request and of the request being run
+        self.generation = 0
+        self.running = None
+
+        # Pending request (generation, function, args) and the newest result
+        self.request = None
+        self.result = None
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def submit(self, function, *args):
+        """ Requests function(*args) to be run on the worker thread, all older requests are superseded. Returns
+            the generation of the request.
+        """
+
+        with self.condition:
+            self.generation += 1
+            self.request = (self.generation, function, args)
+            self.result = None
+
+            self.condition.notify()
+
+            return self.generation
+
+
+    def cancel(self):
+        """ Supersedes all requests without making a new one.
+        """
+
+        with self.condition:
+            self.generation += 1
+            self.request = None
+            self.result = None
+
+
+    def isStale(self):
+        """ Returns True if the request being run has been superseded, render functions can call it between
+            their steps to give up early.
+        """
+
+        with self.condition:
+            return self.running != self.generation
+
+
+    def isBusy(self):
+        """ Returns True if the newest request is pending or running.
+        """
+
+        with self.condition:
+            return (self.request is not None) or (self.running == self.generation)
+
+
+    def takeResult(self):
+        """ Returns the render_result of the newest request once it is done (only once), else None.
+        """
+
+        with self.condition:
+            result = self.result
+            self.result = None
+
+            return result
+
+
+    def _run(self):
+        """ Worker loop, runs the pending request and keeps its result if it has not been superseded meanwhile.
+        """
+
+        while True:
+
+            with self.condition:
+                while self.request is None:
+                    self.condition.wait()
+
+                generation, function, args = self.request
+                self.request = None
+                self.running = generation
+
+            result = render_result(generation)
+
+            try:
+                result.value = function(*args)
+
+            except Exception as error:
+                log.info('render failed: {}\n{}'.format(error, traceback.format_exc()))
+                result.error = error
+
+            with self.condition:
+                self.running = None
+
+                if generation == self.generation:
+                    self.result = result
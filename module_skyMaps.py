@@ -0,0 +1,309 @@
+# coding=utf-8
+# Copyright 2014 Denis Vida, denis.vida@gmail.com
+
+# The module_skyMaps is free software; you can redistribute
+# it and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, version 2.
+
+# The module_skyMaps is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with the module_skyMaps ; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+"""Pixel to sky lookup maps made from the RMS platepar (plate solution) of a night.
+
+The plate solution is evaluated only once, on every pixel or on every n-th pixel (decimation), into RA/Dec and
+azimuth/altitude grids, which are saved next to the platepar as an NPZ file and reused in later sessions. Sky
+coordinates of any pixel are then read from the grids (bilinear interpolation between the samples), e.g. for the
+cursor readout, the celestial grid overlay or the conversion of whole meteor tracks at once.
+
+The camera is fixed, so azimuth and altitude of a pixel do not change during the night, and RA only moves with
+the sidereal time. The grids are computed for the platepar time, and RA is moved to the given time on lookup.
+
+The plate solution is a gnomonic projection around the reference RA/Dec (RA_d, dec_d) with the scale F_scale
+(pixels per degree) and the position angle pos_angle_ref (angle between the image up direction and the north,
+counter-clockwise), with the 12 term poly3+radial distortion (x_poly, y_poly in pixels) of the platepar.
+Other distortion types are evaluated without the distortion. Precession and refraction are not applied, so RA/Dec
+are in the system of the platepar reference coordinates.
+"""
+
+import os
+import json
+import logging
+import datetime
+
+import numpy as np
+
+
+log = logging.getLogger("CMN_binViewer")
+
+
+# Sky maps by (platepar path, decimation)
+sky_map_cache = {}
+
+# Sidereal rotation in degrees per day
+sidereal_rate = 360.98564736629
+
+
+
+class sky_map_struct:
+    """ RA/Dec and azimuth/altitude of every decimation-th pixel of the image, in degrees (float32 grids). The
+        grids reach the last row and column of the image, see gridShape.
+    """
+    def __init__(self):
+
+        self.ra = None
+        self.dec = None
+        self.azim = None
+        self.elev = None
+
+        # Julian date for which RA is given, size of the full image and the sampling step in pixels
+        self.jd = 0.0
+        self.nrows = 0
+        self.ncols = 0
+        self.decimation = 1
+
+
+
+def datetimeToJD(time):
+    """ Returns the Julian date of the given (UTC) datetime.
+    """
+
+    return (time - datetime.datetime(2000, 1, 1, 12)).total_seconds()/86400.0 + 2451545.0
+
+
+
+def loadPlatepar(platepar_path):
+    """ Reads the RMS platepar (JSON) file and returns it as a dictionary.
+    """
+
+    with open(platepar_path) as f:
+        platepar = json.load(f)
+
+    for key in ('F_scale', 'RA_d', 'dec_d', 'JD', 'lat', 'lon', 'X_res', 'Y_res'):
+        if key not in platepar:
+            raise ValueError("{:s} is not a platepar file, {:s} is missing".format(platepar_path, key))
+
+    return platepar
+
+
+
+def findPlatepar(dir_path):
+    """ Returns the path of the platepar file in the given directory, or None if there is no such file.
+    """
+
+    for file_name in sorted(os.listdir(dir_path)):
+        if file_name.lower().startswith('platepar') and file_name.lower().endswith('.cal'):
+            return os.path.join(dir_path, file_name)
+
+    return None
+
+
+
+def xyToRaDec(platepar, x, y):
+    """ Evaluates the plate solution on the given image coordinates, returns (RA, Dec) in degrees at the platepar
+        time.
+    """
+
+    X = np.asarray(x, dtype=np.float64) - platepar['X_res']/2.0
+    Y = np.asarray(y, dtype=np.float64) - platepar['Y_res']/2.0
+
+    # Distortion correction
+    x_poly = platepar.get('x_poly_fwd', platepar.get('x_poly'))
+    y_poly = platepar.get('y_poly_fwd', platepar.get('y_poly'))
+
+    if (platepar.get('distortion_type', 'poly3+radial') == 'poly3+radial') and x_poly and y_poly and \
+            (len(x_poly) >= 12) and (len(y_poly) >= 12):
+
+        r = np.sqrt(X**2 + Y**2)
+        terms = [np.ones_like(X), X, Y, X**2, X*Y, Y**2, X**3, X**2*Y, X*Y**2, Y**3, X*r, Y*r]
+
+        X, Y = X + sum(c*term for c, term in zip(x_poly, terms)), Y + sum(c*term for c, term in zip(y_poly, terms))
+
+    # Image to the tangent plane (east to the left, north up when the position angle is 0)
+    pos_angle = np.radians(platepar.get('pos_angle_ref', 0.0))
+
+    u = -X/platepar['F_scale']
+    v = -Y/platepar['F_scale']
+
+    xi = np.radians(u*np.cos(pos_angle) - v*np.sin(pos_angle))
+    eta = np.radians(u*np.sin(pos_angle) + v*np.cos(pos_angle))
+
+    # Inverse gnomonic projection
+    ra0 = np.radians(platepar['RA_d'])
+    dec0 = np.radians(platepar['dec_d'])
+
+    rho = np.hypot(xi, eta)
+    c = np.arctan(rho)
+    rho = np.where(rho == 0, 1, rho)
+
+    dec = np.arcsin(np.cos(c)*np.sin(dec0) + eta*np.sin(c)*np.cos(dec0)/rho)
+    ra = ra0 + np.arctan2(xi*np.sin(c), rho*np.cos(dec0)*np.cos(c) - eta*np.sin(dec0)*np.sin(c))
+
+    return np.degrees(ra)%360, np.degrees(dec)
+
+
+
+def raDecToAltAz(ra, dec, jd, lat, lon):
+    """ Returns (azimuth, altitude) in degrees of the given RA/Dec (degrees) at the given time and place. The
+        azimuth is counted from the north through the east.
+    """
+
+    lst = np.radians((280.46061837 + sidereal_rate*(np.asarray(jd) - 2451545.0) + lon)%360)
+
+    ha = lst - np.radians(ra)
+    dec = np.radians(dec)
+    lat = np.radians(lat)
+
+    elev = np.arcsin(np.sin(dec)*np.sin(lat) + np.cos(dec)*np.cos(lat)*np.cos(ha))
+    azim = np.arctan2(-np.cos(dec)*np.sin(ha), np.sin(dec)*np.cos(lat) - np.cos(dec)*np.sin(lat)*np.cos(ha))
+
+    return np.degrees(azim)%360, np.degrees(elev)
+
+
+
+def gridShape(nrows, ncols, decimation=1):
+    """ Returns the shape of the sky map grids of the given image. The last samples are on or past the last row
+        and column, so the pixels at the image edges are interpolated and not clamped to the last sample.
+    """
+
+    return tuple(-(-(size - 1)//decimation) + 1 for size in (nrows, ncols))
+
+
+
+def makeSkyMap(platepar, decimation=1):
+    """ Evaluates the plate solution on every decimation-th pixel and returns the sky_map_struct.
+    """
+
+    sky_map = sky_map_struct()
+    sky_map.jd = float(platepar['JD'])
+    sky_map.nrows = int(platepar['Y_res'])
+    sky_map.ncols = int(platepar['X_res'])
+    sky_map.decimation = decimation
+
+    grid_rows, grid_cols = gridShape(sky_map.nrows, sky_map.ncols, decimation)
+
+    y, x = np.mgrid[0:grid_rows*decimation:decimation, 0:grid_cols*decimation:decimation]
+
+    ra, dec = xyToRaDec(platepar, x, y)
+    azim, elev = raDecToAltAz(ra, dec, sky_map.jd, platepar['lat'], platepar['lon'])
+
+    sky_map.ra = ra.astype(np.float32)
+    sky_map.dec = dec.astype(np.float32)
+    sky_map.azim = azim.astype(np.float32)
+    sky_map.elev = elev.astype(np.float32)
+
+    return sky_map
+
+
+
+def getSkyMap(platepar_path, decimation=1):
+    """ Returns the sky map of the given platepar. The map is read from the NPZ file next to the platepar if it is
+        newer than the platepar, otherwise it is computed and saved there.
+    """
+
+    key = (os.path.abspath(platepar_path), decimation)
+
+    if key in sky_map_cache:
+        return sky_map_cache[key]
+
+    map_path = os.path.splitext(platepar_path)[0] + '_skymap_{:d}.npz'.format(decimation)
+
+    sky_map = None
+
+    if os.path.isfile(map_path) and (os.path.getmtime(map_path) >= os.path.getmtime(platepar_path)):
+
+        with np.load(map_path) as data:
+            sky_map = sky_map_struct()
+
+            for name in ('ra', 'dec', 'azim', 'elev'):
+                setattr(sky_map, name, data[name])
+
+            sky_map.jd = float(data['jd'])
+            sky_map.nrows, sky_map.ncols, sky_map.decimation = [int(value) for value in data['size']]
+
+        # Maps saved without the samples at the image edges are made again
+        if sky_map.ra.shape != gridShape(sky_map.nrows, sky_map.ncols, sky_map.decimation):
+            sky_map = None
+
+    if sky_map is None:
+        sky_map = makeSkyMap(loadPlatepar(platepar_path), decimation)
+
+        try:
+            np.savez(map_path, ra=sky_map.ra, dec=sky_map.dec, azim=sky_map.azim, elev=sky_map.elev,
+                jd=sky_map.jd, size=np.array([sky_map.nrows, sky_map.ncols, sky_map.decimation]))
+
+        except (IOError, OSError) as error:
+            log.info('unable to save the sky map: {}'.format(error))
+
+    sky_map_cache[key] = sky_map
+
+    return sky_map
+
+
+
+def _interpolate(grid, gx, gy, wrap=False):
+    """ Bilinear interpolation of the grid on the given (fractional) grid coordinates. Angles which wrap around at
+        360 degrees are interpolated as offsets from the first sample.
+    """
+
+    nrows, ncols = grid.shape
+
+    gx = np.clip(gx, 0, ncols - 1)
+    gy = np.clip(gy, 0, nrows - 1)
+
+    col0 = np.minimum(np.floor(gx).astype(np.intp), max(ncols - 2, 0))
+    row0 = np.minimum(np.floor(gy).astype(np.intp), max(nrows - 2, 0))
+    col1 = np.minimum(col0 + 1, ncols - 1)
+    row1 = np.minimum(row0 + 1, nrows - 1)
+
+    fx = gx - col0
+    fy = gy - row0
+
+    v00 = grid[row0, col0].astype(np.float64)
+    corners = [grid[row0, col1], grid[row1, col0], grid[row1, col1]]
+
+    if wrap:
+        corners = [v00 + (corner - v00 + 180)%360 - 180 for corner in corners]
+
+    v01, v10, v11 = corners
+
+    value = v00*(1 - fx)*(1 - fy) + v01*fx*(1 - fy) + v10*(1 - fx)*fy + v11*fx*fy
+
+    return value%360 if wrap else value
+
+
+
+def skyCoordinates(sky_map, x, y, jd=None):
+    """ Returns (RA, Dec, azimuth, altitude) in degrees of the given image coordinates, read from the sky map.
+
+    sky_map: sky_map_struct
+    x, y: image coordinates, numbers or arrays
+    jd: Julian date (numbers or an array), RA is given for the platepar time if None
+    """
+
+    gx = np.asarray(x, dtype=np.float64)/sky_map.decimation
+    gy = np.asarray(y, dtype=np.float64)/sky_map.decimation
+
+    ra = _interpolate(sky_map.ra, gx, gy, wrap=True)
+
+    if jd is not None:
+        ra = (ra + sidereal_rate*(np.asarray(jd, dtype=np.float64) - sky_map.jd))%360
+
+    return ra, _interpolate(sky_map.dec, gx, gy), _interpolate(sky_map.azim, gx, gy, wrap=True), \
+        _interpolate(sky_map.elev, gx, gy)
+
+
+
+def getRaMap(sky_map, jd=None):
+    """ Returns the RA grid of the sky map at the given Julian date.
+    """
+
+    if jd is None:
+        return sky_map.ra
+
+    return ((sky_map.ra + sidereal_rate*(jd - sky_map.jd))%360).astype(np.float32)
@@ -0,0 +1,97 @@
+""" Hot and dead pixel detection and filling on synthetic FF files.
+"""
+
+import os
+
+import numpy as np
+
+import FF_bin_suite
+
+
+NROWS = 40
+NCOLS = 50
+
+HOT = [(10, 10), (20, 30)]
+DEAD = [(30, 15), (5, 40)]
+
+
+def write_ff(file_path, avepixel, stdpixel):
+    """ Writes a CAMS FF file with the given avepixel and stdpixel. """
+
+    with open(file_path, 'wb') as f:
+        np.array([-1], np.int32).tofile(f)
+        np.array([NROWS, NCOLS, 256, 0, 1, 1, 0, 25000], np.uint32).tofile(f)
+
+        for img_array in (avepixel, np.zeros_like(avepixel), avepixel, stdpixel):
+            img_array.astype(np.uint8).tofile(f)
+
+
+def make_night(dir_path, nfiles=8):
+    """ Writes FF files with noisy background and the HOT and DEAD pixels, returns their paths. """
+
+    rnd = np.random.RandomState(0)
+    file_list = []
+
+    for i in range(nfiles):
+        avepixel = 40 + rnd.randint(0, 5, (NROWS, NCOLS))
+        stdpixel = 5 + rnd.randint(0, 3, (NROWS, NCOLS))
+
+        # Hot in avepixel, and in stdpixel only
+        avepixel[HOT[0]] = 200
+        stdpixel[HOT[1]] = 80
+
+        # Dead, and stuck (never changes while the neighbours do)
+        avepixel[DEAD[0]] = 0
+        stdpixel[DEAD[1]] = 0
+
+        file_list.append(os.path.join(dir_path, 'FF451_20140819_0000{:02d}_000_0000000.bin'.format(i)))
+        write_ff(file_list[-1], avepixel, stdpixel)
+
+    return file_list
+
+
+def test_find_bad_pixels(tmpdir):
+
+    bad_pixels = FF_bin_suite.find_bad_pixels(make_night(str(tmpdir)), workers=1)
+
+    assert bad_pixels.shape == (NROWS, NCOLS)
+
+    found = dict(((row, col), hot) for row, col, hot in zip(bad_pixels.rows, bad_pixels.cols, bad_pixels.hot))
+
+    assert found == dict([(pixel, True) for pixel in HOT] + [(pixel, False) for pixel in DEAD])
+
+
+def test_fill_bad_pixels():
+
+    img_array = np.arange(NROWS*NCOLS).reshape(NROWS, NCOLS).astype(np.uint16)%251
+
+    # Two neighbouring bad pixels and one in the corner
+    bad_pixels = FF_bin_suite.bad_pixel_struct((NROWS, NCOLS), [10, 10, 0], [10, 11, 0], [True, False, True])
+
+    filled = FF_bin_suite.fill_bad_pixels(img_array, bad_pixels)
+
+    # The other bad pixel is not used as a neighbour
+    neighbours = [img_array[row, col] for row in (9, 10, 11) for col in (9, 10, 11) if (row, col) not in
+        [(10, 10), (10, 11)]]
+    assert filled[10, 10] == np.round(np.median(neighbours))
+
+    neighbours = [img_array[row, col] for row in (9, 10, 11) for col in (10, 11, 12) if (row, col) not in
+        [(10, 10), (10, 11)]]
+    assert filled[10, 11] == np.round(np.median(neighbours))
+
+    assert filled[0, 0] == np.round(np.median([img_array[0, 1], img_array[1, 0], img_array[1, 1]]))
+
+    # Other pixels and the input are not changed
+    mask = np.ones((NROWS, NCOLS), dtype=bool)
+    mask[bad_pixels.rows, bad_pixels.cols] = False
+
+    assert np.array_equal(filled[mask], img_array[mask])
+    assert filled.dtype == img_array.dtype
+    assert img_array[10, 10] == (10*NCOLS + 10)%251
+
+    # Stacks of images are filled in the same way
+    stack = np.array([img_array, img_array[::-1]])
+    filled_stack = FF_bin_suite.fill_bad_pixels(stack, bad_pixels)
+
+    assert np.array_equal(filled_stack[0], filled)
+    assert np.array_equal(filled_stack[1], FF_bin_suite.fill_bad_pixels(img_array[::-1], bad_pixels))
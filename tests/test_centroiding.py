@@ -0,0 +1,88 @@
+""" Centroids of meteors detected on half-frames of interlaced FF files.
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+import FF_bin_suite
+from module_centroiding import centroidDetections, refineFTPdetectLines
+
+
+def make_track_ff(detections, data_type=1, nrows=60, ncols=80):
+    """ Returns an FF structure with a Gaussian blob drawn only on the rows of the field of each (frame, x, y)
+        half-frame detection: N.0 on the even field and N.5 on the odd field.
+    """
+
+    ff = FF_bin_suite.ff_struct()
+    ff.nrows, ff.ncols = nrows, ncols
+    ff.avepixel = np.full((nrows, ncols), 20, dtype=np.uint8)
+    ff.maxpixel = ff.avepixel.copy()
+    ff.maxframe = np.zeros((nrows, ncols), dtype=np.uint8)
+
+    # Rows 0, 2, 4... hold the odd field on CAMS and RMS data, and the even field on Skypatrol data
+    odd_parity = 1 if data_type == 2 else 0
+
+    yy, xx = np.mgrid[0:nrows, 0:ncols]
+
+    for frame, x, y in detections:
+        parity = odd_parity if frame%1 else 1 - odd_parity
+
+        blob = 150*np.exp(-((xx - x)**2 + (yy - y)**2)/2.0)
+        mask = (blob > 3) & (yy%2 == parity)
+
+        ff.maxpixel[mask] = (20 + blob[mask]).astype(np.uint8)
+        ff.maxframe[mask] = int(frame)
+
+    return ff
+
+
+# Track moving 4 px per half-frame, both fields of a frame are close to each other
+track = [(105.0, 20.3, 20.4), (105.5, 24.6, 21.5), (106.0, 28.2, 22.6), (106.5, 32.7, 23.3)]
+
+
+@pytest.mark.parametrize('data_type', [1, 2, 3])
+def test_half_frame_centroids(data_type):
+
+    ff = make_track_ff(track, data_type)
+
+    coordinates = np.array([[frame, round(x), round(y)] for frame, x, y in track])
+    x, y, weight = centroidDetections(ff, coordinates, window_radius=3, data_type=data_type)
+
+    # Each detection is measured on its own field only, so the x positions are recovered
+    for i, (frame, x_true, y_true) in enumerate(track):
+        assert abs(x[i] - x_true) < 0.05
+        assert abs(y[i] - y_true) < 0.6
+        assert weight[i] > 0
+
+    # With the fields swapped, the pixels of the other field of the frame pull the centroids away
+    x_swapped = centroidDetections(ff, coordinates, window_radius=3, data_type=(2 if data_type != 2 else 1))[0]
+    assert np.max(np.abs(x_swapped - [x_true for frame, x_true, y_true in track])) > 0.5
+
+
+def test_refine_half_frame_lines(tmpdir):
+
+    ff = make_track_ff(track)
+    ff_name = 'FF451_20140819_000001_000_0397568.bin'
+
+    with open(os.path.join(str(tmpdir), ff_name), 'wb') as f:
+        np.array([-1], np.int32).tofile(f)
+        np.array([ff.nrows, ff.ncols, 256, 0, 1, 1, 0, 25000], np.uint32).tofile(f)
+
+        for img_array in (ff.maxpixel, ff.maxframe, ff.avepixel, ff.avepixel):
+            img_array.tofile(f)
+
+    lines = ['Meteor Count = 000001\n'] + ['\n']*10 + ['-'*55 + '\n', ff_name + '\n', 'CAL\n',
+        '0001 0001 0004 0025.00 000.0 000.0 000.0 000.0 0010.0 0020.0\n']
+    lines += ['{:06.4f} {:07.2f} {:07.2f} 000.00 000.00 000.00 000.00 0 0\n'.format(frame, round(x), round(y))
+        for frame, x, y in track]
+
+    refined_lines, residual_rows = refineFTPdetectLines(lines, str(tmpdir), processes=1)
+
+    assert refined_lines[:15] == lines[:15]
+
+    for line, (frame, x_true, y_true) in zip(refined_lines[15:], track):
+        assert abs(float(line.split()[1]) - x_true) < 0.05
+
+    assert len(set(row[5] for row in residual_rows)) == len(track)
@@ -0,0 +1,144 @@
+""" The numba kernels of module_numbaKernels must give exactly the same results as the NumPy code of FF_bin_suite
+they replace. Skipped if numba is not installed.
+"""
+
+import numpy as np
+import pytest
+
+pytest.importorskip('numba')
+
+import FF_bin_suite
+
+
+NROWS = 121
+NCOLS = 93
+
+
+def compare(func, *args, **kwargs):
+    """ Runs func with the NumPy and with the numba implementation and checks that the results are identical. """
+
+    results = []
+
+    for use_numba in (False, True):
+        FF_bin_suite.use_numba = use_numba
+
+        # Copies, as some kernels work in place
+        result = func(*[np.copy(arg) if isinstance(arg, np.ndarray) else arg for arg in args], **kwargs)
+
+        if not isinstance(result, list):
+            result = [result]
+
+        results.append([np.asarray(value) for value in result])
+
+    for numpy_result, numba_result in zip(*results):
+        assert numpy_result.shape == numba_result.shape
+        assert numpy_result.dtype == numba_result.dtype
+        assert np.array_equal(numpy_result, numba_result)
+
+
+@pytest.fixture(autouse=True)
+def restore_numba_flag():
+    use_numba = FF_bin_suite.use_numba
+    yield
+    FF_bin_suite.use_numba = use_numba
+
+
+def make_ff(seed, rows=NROWS, ncols=NCOLS):
+    """ Returns a random FF structure, dark backgrounds for odd seeds. """
+
+    rnd = np.random.RandomState(seed)
+
+    ff = FF_bin_suite.ff_struct()
+    ff.nrows, ff.ncols = rows, ncols
+    ff.avepixel = rnd.randint(0, 30 if seed%2 else 120, (rows, ncols)).astype(np.uint8)
+    ff.maxpixel = np.maximum(ff.avepixel, rnd.randint(0, 256, (rows, ncols))).astype(np.uint8)
+    ff.maxframe = rnd.randint(0, 256, (rows, ncols)).astype(np.uint8)
+    ff.adjustment_scalar = np.mean(ff.maxpixel)/np.mean(ff.avepixel)
+
+    return ff
+
+
+@pytest.mark.parametrize('seed', range(4))
+@pytest.mark.parametrize('video', [False, True])
+@pytest.mark.parametrize('no_background', [False, True])
+def test_build_frame(seed, video, no_background):
+
+    ff = make_ff(seed, rows=NROWS + seed%2)
+    kframe = np.random.RandomState(seed).randint(0, 236)
+
+    def build(avepixel):
+        ff.avepixel = avepixel
+        return [FF_bin_suite.buildFF(ff, kframe, videoFlag=video, no_background=no_background), ff.avepixel]
+
+    compare(build, ff.avepixel)
+    compare(FF_bin_suite.buildFFStack, ff, kframe, kframe + 20, video, no_background)
+
+
+@pytest.mark.parametrize('seed', range(4))
+@pytest.mark.parametrize('window', [np.s_[:, :], np.s_[3:-5, 7:-2], np.s_[4:, :]])
+def test_deinterlace(seed, window):
+
+    ff = make_ff(seed, rows=NROWS + seed%2)
+    frame = FF_bin_suite.buildFF(ff, 100, videoFlag=True)
+
+    for img in (ff.maxpixel[window], frame[window]):
+        compare(FF_bin_suite.deinterlace_array_odd, img)
+        compare(FF_bin_suite.deinterlace_array_even, img)
+
+
+@pytest.mark.parametrize('seed', range(4))
+@pytest.mark.parametrize('use_flat', [False, True])
+@pytest.mark.parametrize('use_dark', [False, True])
+def test_calibrate(seed, use_flat, use_dark):
+
+    rnd = np.random.RandomState(seed)
+    ff = make_ff(seed)
+
+    dark = rnd.randint(0, 20, (NROWS, NCOLS)).astype(np.uint) if use_dark else None
+    flat = rnd.randint(0, 160, (NROWS, NCOLS)).astype(np.uint) if use_flat else None
+    flat_scalar = int(np.median(flat)) if use_flat else None
+
+    compare(FF_bin_suite.process_array, ff.maxpixel, flat, flat_scalar, dark)
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_apply_lut(seed):
+
+    rnd = np.random.RandomState(seed)
+    ff = make_ff(seed)
+
+    minv = rnd.randint(0, 100)
+    maxv = rnd.randint(minv + 1, 256)
+
+    for img in (ff.maxpixel, ff.maxpixel[::2, 1:]):
+        for gamma in (rnd.uniform(0.3, 3.0), 1.0):
+            compare(FF_bin_suite.adjust_levels, img, minv, gamma, maxv)
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_crop_detection_segments(seed):
+
+    rnd = np.random.RandomState(seed)
+    ff = make_ff(seed)
+
+    kframe = rnd.randint(0, 256)
+    segments = [[(kframe, rnd.uniform(-10, NCOLS + 10), rnd.uniform(-10, NROWS + 10)) for _ in range(10)]]
+
+    compare(FF_bin_suite.cropDetectionSegments, ff, segments, 16)
+
+
+@pytest.mark.parametrize('n', [1, 2, 3, 4, 7])
+def test_median_stack(n):
+
+    rnd = np.random.RandomState(n)
+    img_stack = np.array([rnd.randint(0, 256, (NROWS, NCOLS)).astype(np.uint) for _ in range(n)])
+
+    compare(FF_bin_suite.median_stack, img_stack)
+
+
+@pytest.mark.parametrize('n', [3, 40, 41])
+def test_median_stack_uint8(n):
+
+    img_stack = np.random.RandomState(n).randint(0, 256, (n, NROWS, NCOLS)).astype(np.uint8)
+
+    compare(FF_bin_suite.median_stack, img_stack)
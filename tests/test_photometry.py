@@ -0,0 +1,65 @@
+""" Aperture photometry of meteors detected on half-frames of interlaced FF files.
+"""
+
+import numpy as np
+import pytest
+
+import FF_bin_suite
+from module_photometry import meteorLightcurve
+
+
+def make_interlaced_ff(field_blobs, nrows=40, ncols=60):
+    """ Returns an FF structure with a flat background and a square blob of the given brightness on the rows of a
+        single field for every (frame, field_parity, x, y, brightness) in field_blobs.
+    """
+
+    ff = FF_bin_suite.ff_struct()
+    ff.nrows, ff.ncols = nrows, ncols
+    ff.avepixel = np.full((nrows, ncols), 20, dtype=np.uint8)
+    ff.maxpixel = ff.avepixel.copy()
+    ff.maxframe = np.zeros((nrows, ncols), dtype=np.uint8)
+
+    rows = np.arange(nrows)[:, np.newaxis]
+    cols = np.arange(ncols)[np.newaxis, :]
+
+    for frame, parity, x, y, brightness in field_blobs:
+        blob = (np.abs(rows - y) <= 2) & (np.abs(cols - x) <= 2) & (rows%2 == parity)
+
+        ff.maxpixel[blob] = 20 + brightness
+        ff.maxframe[blob] = frame
+
+    return ff
+
+
+# Row parity of the N.0 (even) and the N.5 (odd) field, as makeGIF labels the fields
+@pytest.mark.parametrize('data_type, even_parity, odd_parity', [(1, 1, 0), (3, 1, 0), (2, 0, 1)])
+def test_half_frame_photometry(data_type, even_parity, odd_parity):
+
+    ff = make_interlaced_ff([(105, even_parity, 20, 15, 100), (105, odd_parity, 35, 15, 50)])
+
+    lightcurve = meteorLightcurve(ff, [[105.0, 20, 15], [105.5, 35, 15]], aperture_radius=5, data_type=data_type)
+
+    # The blobs cover 5 columns and 2 or 3 rows of their field
+    even_rows = len([row for row in range(13, 18) if row%2 == even_parity])
+    odd_rows = len([row for row in range(13, 18) if row%2 == odd_parity])
+
+    assert list(lightcurve['flux']) == [100*5*even_rows, 50*5*odd_rows]
+    assert list(lightcurve['peak']) == [120, 70]
+    assert list(lightcurve['saturated']) == [0, 0]
+
+
+def test_half_frames_do_not_share_pixels():
+
+    # Both fields of the frame on the same spot
+    ff = make_interlaced_ff([(105, 1, 20, 15, 100), (105, 0, 20, 15, 235)])
+
+    lightcurve = meteorLightcurve(ff, [[105.0, 20, 15], [105.5, 20, 15]], aperture_radius=5)
+
+    # Rows 13, 15 and 17 hold the even field, rows 14 and 16 the odd field
+    assert list(lightcurve['flux']) == [100*5*3, 235*5*2]
+    assert list(lightcurve['saturated']) == [0, 10]
+
+    # Whole frame detections use all rows
+    lightcurve = meteorLightcurve(ff, [[105, 20, 15]], aperture_radius=5)
+
+    assert list(lightcurve['flux']) == [100*5*3 + 235*5*2]
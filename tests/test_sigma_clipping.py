@@ -0,0 +1,122 @@
+""" Streaming sigma clipped stacking (Welford's running statistics) of FF files with outlier frames.
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+import FF_bin_suite
+
+
+NROWS = 30
+NCOLS = 40
+
+
+def write_ff(file_path, avepixel):
+    """ Writes a CAMS FF file with the given avepixel. """
+
+    with open(file_path, 'wb') as f:
+        np.array([-1], np.int32).tofile(f)
+        np.array([NROWS, NCOLS, 256, 0, 1, 1, 0, 25000], np.uint32).tofile(f)
+
+        for img_array in (avepixel, np.zeros_like(avepixel), avepixel, np.zeros_like(avepixel)):
+            img_array.astype(np.uint8).tofile(f)
+
+
+def reference_clipped_stack(img_stack, sigma, iterations):
+    """ Sigma clipping of the whole stack in memory, with the same passes as sigma_clipped_stack. """
+
+    img_stack = img_stack.astype(np.float64)
+
+    used = np.ones(img_stack.shape, dtype=bool)
+    count = used.sum(axis=0)
+    mean = img_stack.mean(axis=0)
+    std = img_stack.std(axis=0, ddof=1)
+
+    for _ in range(iterations):
+
+        clipped = np.abs(img_stack - mean) <= sigma*std
+        clipped_count = clipped.sum(axis=0)
+
+        # Pixels without values within the limits keep the previous statistics
+        empty = clipped_count == 0
+        clipped[:, empty] = used[:, empty]
+
+        converged = np.array_equal(clipped_count, count)
+
+        used = clipped
+        count = used.sum(axis=0)
+
+        values = np.ma.masked_array(img_stack, mask=~used)
+        mean = values.mean(axis=0).filled(0)
+        std = np.sqrt(((values - mean)**2).sum(axis=0).filled(0)/np.maximum(count - 1, 1))
+
+        if converged:
+            break
+
+    return mean, std, count
+
+
+@pytest.fixture
+def night(tmpdir):
+    """ FF files with a noisy background, one bright frame and one frame with a saturated streak. """
+
+    rnd = np.random.RandomState(1)
+
+    img_stack = np.clip(rnd.normal(50, 2, (22, NROWS, NCOLS)), 0, 255).astype(np.uint8)
+
+    img_stack[5] = 250
+    img_stack[12, 10:14, 5:35] = 255
+
+    file_list = []
+    for i, avepixel in enumerate(img_stack):
+        file_list.append(os.path.join(str(tmpdir), 'FF451_20140819_0000{:02d}_000_0000000.bin'.format(i)))
+        write_ff(file_list[-1], avepixel)
+
+    return file_list, img_stack
+
+
+@pytest.mark.parametrize('iterations', [1, 2, 5])
+def test_sigma_clipped_stack(night, iterations):
+
+    file_list, img_stack = night
+
+    mean, std, count = FF_bin_suite.sigma_clipped_stack(file_list, sigma=3.0, iterations=iterations, workers=2)
+    ref_mean, ref_std, ref_count = reference_clipped_stack(img_stack, 3.0, iterations)
+
+    assert np.array_equal(count, ref_count)
+    assert np.allclose(mean, ref_mean, rtol=1e-6, atol=1e-4)
+    assert np.allclose(std, ref_std, rtol=1e-5, atol=1e-4)
+
+    # The outlier frames are rejected everywhere, so the statistics are those of the background frames
+    clean = np.delete(img_stack, [5], axis=0).astype(np.float64)
+    clean[11, 10:14, 5:35] = np.nan
+
+    assert np.all(count <= 21)
+    assert np.all(count[10:14, 5:35] <= 20)
+    assert np.all(np.abs(mean - np.nanmean(clean, axis=0)) < 1.5)
+    assert np.all(std < 5)
+
+
+def test_welford_update():
+
+    rnd = np.random.RandomState(2)
+    img_stack = rnd.randint(0, 256, (15, NROWS, NCOLS)).astype(np.float64)
+    masks = rnd.rand(15, NROWS, NCOLS) > 0.3
+
+    stats = FF_bin_suite.welford_struct((NROWS, NCOLS))
+    masked_stats = FF_bin_suite.welford_struct((NROWS, NCOLS))
+
+    for img_array, mask in zip(img_stack, masks):
+        FF_bin_suite.welford_update(stats, img_array)
+        FF_bin_suite.welford_update(masked_stats, img_array, mask)
+
+    assert np.allclose(stats.mean, img_stack.mean(axis=0))
+    assert np.allclose(stats.std(), img_stack.std(axis=0, ddof=1))
+
+    values = np.ma.masked_array(img_stack, mask=~masks)
+
+    assert np.array_equal(masked_stats.count, masks.sum(axis=0))
+    assert np.allclose(masked_stats.mean, values.mean(axis=0).filled(0))
+    assert np.allclose(masked_stats.std(), np.sqrt(values.var(axis=0, ddof=1).filled(0)))
@@ -0,0 +1,127 @@
+""" Pixel to sky lookup maps: interpolation at the image edges, RA wrap-around and the NPZ cache.
+"""
+
+import os
+import json
+
+import numpy as np
+import pytest
+
+import module_skyMaps
+
+
+platepar = dict(F_scale=7.5, RA_d=350.0, dec_d=40.0, JD=2459000.5, lat=45.0, lon=16.0, X_res=640, Y_res=480,
+    pos_angle_ref=25.0)
+
+
+def angleDifference(a, b):
+    """ Returns the absolute difference of angles in degrees, across the 0/360 wrap. """
+
+    return np.abs((np.asarray(a) - b + 180)%360 - 180)
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    module_skyMaps.sky_map_cache.clear()
+
+
+@pytest.mark.parametrize('decimation', [1, 2, 3, 4, 7])
+def test_grid_edges(decimation):
+
+    sky_map = module_skyMaps.makeSkyMap(platepar, decimation)
+
+    # The grids reach the last row and column
+    assert sky_map.ra.shape == module_skyMaps.gridShape(480, 640, decimation)
+    assert (sky_map.ra.shape[0] - 1)*decimation >= 479
+    assert (sky_map.ra.shape[1] - 1)*decimation >= 639
+
+    # Pixels at the edges and the corners are interpolated, not clamped to the last sample inside the image
+    x = np.array([639, 639, 0, 638.5, 320.3, 639])
+    y = np.array([479, 0, 479, 478.2, 479, 240.7])
+
+    ra, dec, azim, elev = module_skyMaps.skyCoordinates(sky_map, x, y)
+    ra_true, dec_true = module_skyMaps.xyToRaDec(platepar, x, y)
+
+    assert np.all(angleDifference(ra, ra_true)*np.cos(np.radians(dec_true)) < 0.002)
+    assert np.all(np.abs(dec - dec_true) < 0.002)
+
+
+def test_interpolate_ra_wrap():
+
+    grid = np.array([[359.0, 1.0], [358.0, 2.0]], dtype=np.float32)
+
+    ra = module_skyMaps._interpolate(grid, np.array([0.5, 0.25, 0.5, 1.0]), np.array([0.0, 0.0, 0.5, 1.0]),
+        wrap=True)
+
+    assert np.all(angleDifference(ra, [0.0, 359.5, 0.0, 2.0]) < 1e-6)
+    assert np.all((ra >= 0) & (ra < 360))
+
+    # Without wrapping, the same grid is interpolated linearly
+    assert module_skyMaps._interpolate(grid, np.array([0.5]), np.array([0.0]))[0] == pytest.approx(180.0)
+
+
+def test_sky_map_ra_wrap():
+
+    # Field centred on RA 0, so the RA grid jumps from 360 to 0 inside the image
+    wrap_platepar = dict(platepar, RA_d=0.5)
+
+    sky_map = module_skyMaps.makeSkyMap(wrap_platepar, 4)
+    assert (sky_map.ra.max() > 350) and (sky_map.ra.min() < 10)
+
+    y, x = np.mgrid[1:480:13, 1:640:11]
+    x = x + 0.37
+    y = y + 0.61
+
+    ra = module_skyMaps.skyCoordinates(sky_map, x, y)[0]
+    ra_true = module_skyMaps.xyToRaDec(wrap_platepar, x, y)[0]
+
+    assert np.all(angleDifference(ra, ra_true) < 0.005)
+
+
+def test_npz_cache(tmpdir):
+
+    platepar_path = os.path.join(str(tmpdir), 'platepar_cmn2010.cal')
+    map_path = os.path.join(str(tmpdir), 'platepar_cmn2010_skymap_4.npz')
+
+    with open(platepar_path, 'w') as f:
+        json.dump(platepar, f)
+
+    os.utime(platepar_path, (1000000, 1000000))
+
+    sky_map = module_skyMaps.getSkyMap(platepar_path, 4)
+    assert os.path.isfile(map_path)
+
+    # The saved map is used while it is newer than the platepar
+    with np.load(map_path) as data:
+        saved = dict(data)
+
+    saved['ra'] = saved['ra'] + 1
+    np.savez(map_path, **saved)
+
+    module_skyMaps.sky_map_cache.clear()
+    assert np.allclose(module_skyMaps.getSkyMap(platepar_path, 4).ra, sky_map.ra + 1)
+
+    # A newer platepar makes the map again and saves it
+    with open(platepar_path, 'w') as f:
+        json.dump(dict(platepar, RA_d=10.0), f)
+
+    os.utime(map_path, (2000000, 2000000))
+    os.utime(platepar_path, (3000000, 3000000))
+
+    module_skyMaps.sky_map_cache.clear()
+    new_map = module_skyMaps.getSkyMap(platepar_path, 4)
+
+    assert np.allclose(new_map.ra, module_skyMaps.makeSkyMap(dict(platepar, RA_d=10.0), 4).ra)
+    assert os.path.getmtime(map_path) >= os.path.getmtime(platepar_path)
+
+    # Maps saved without the samples at the edges are made again
+    with np.load(map_path) as data:
+        saved = dict(data)
+
+    for name in ('ra', 'dec', 'azim', 'elev'):
+        saved[name] = saved[name][:-1, :-1]
+
+    np.savez(map_path, **saved)
+
+    module_skyMaps.sky_map_cache.clear()
+    assert module_skyMaps.getSkyMap(platepar_path, 4).ra.shape == module_skyMaps.gridShape(480, 640, 4)
@@ -0,0 +1,64 @@
+""" Exact median stacking of FF files in row tiles.
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+import FF_bin_suite
+
+
+NROWS = 37
+NCOLS = 29
+
+
+def write_ff(file_path, avepixel):
+    """ Writes a CAMS FF file with the given avepixel. """
+
+    with open(file_path, 'wb') as f:
+        np.array([-1], np.int32).tofile(f)
+        np.array([NROWS, NCOLS, 256, 0, 1, 1, 0, 25000], np.uint32).tofile(f)
+
+        for img_array in (avepixel, np.zeros_like(avepixel), avepixel, np.zeros_like(avepixel)):
+            img_array.astype(np.uint8).tofile(f)
+
+
+@pytest.mark.parametrize('use_numba', [False, True])
+@pytest.mark.parametrize('n', [1, 2, 3, 4, 5, 8, 33, 40, 41])
+def test_median_stack(n, use_numba):
+
+    if use_numba and not FF_bin_suite.numba_kernels.numba_available:
+        pytest.skip('numba is not installed')
+
+    numba_flag = FF_bin_suite.use_numba
+    FF_bin_suite.use_numba = use_numba
+
+    try:
+        img_stack = np.random.RandomState(n).randint(0, 256, (n, NROWS, NCOLS)).astype(np.uint8)
+        assert np.array_equal(FF_bin_suite.median_stack(img_stack), np.median(img_stack, axis=0))
+
+    finally:
+        FF_bin_suite.use_numba = numba_flag
+
+
+@pytest.mark.parametrize('n', [2, 3, 4, 7, 10])
+@pytest.mark.parametrize('memory_limit', [2**30, 5000])
+def test_stack_frames_median(tmpdir, n, memory_limit):
+
+    rnd = np.random.RandomState(n)
+    img_stack = rnd.randint(0, 256, (n, NROWS, NCOLS)).astype(np.uint8)
+
+    file_list = []
+    for i, avepixel in enumerate(img_stack):
+        file_list.append(os.path.join(str(tmpdir), 'FF451_20140819_0000{:02d}_000_0000000.bin'.format(i)))
+        write_ff(file_list[-1], avepixel)
+
+    # With the small memory limit the stack is kept in a file and reduced in tiles of a few rows, which do not 
+    # divide the image evenly
+    tile_rows = int(max(1, min(NROWS, memory_limit/(4*n*NCOLS))))
+    assert (memory_limit > 2**20) or (NROWS%tile_rows != 0)
+
+    stacked_frame = FF_bin_suite.stack_frames(file_list, 'median', workers=2, memory_limit=memory_limit)
+
+    assert np.array_equal(stacked_frame, np.median(img_stack, axis=0))
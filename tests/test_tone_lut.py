@@ -0,0 +1,50 @@
+""" The levels lookup table must give exactly the same values as the levels expression of adjust_levels.
+"""
+
+import warnings
+
+import numpy as np
+import pytest
+
+import FF_bin_suite
+
+
+def reference_levels(img_array, minv, gamma, maxv):
+    """ Levels adjustment computed directly in float64, as adjust_levels did before the lookup tables. """
+
+    minv = minv/255.0
+    maxv = maxv/255.0
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+
+        img_array = ((img_array.astype(float)/255 - minv)/(maxv - minv))**(1.0/gamma)*255
+
+    # Values below the minimum level are NaN with fractional powers, they are black
+    return np.clip(np.nan_to_num(img_array, nan=0), 0, 255).astype(np.uint8)
+
+
+@pytest.fixture(autouse=True)
+def clear_lut_cache():
+    FF_bin_suite.tone_lut_cache.clear()
+
+
+def test_identity_lut():
+
+    assert np.array_equal(FF_bin_suite.getToneLUT(0, 1.0, 255), np.arange(256))
+
+
+@pytest.mark.parametrize('minv', [0, 1, 17, 64, 120])
+@pytest.mark.parametrize('gamma', [0.1, 0.5, 0.7, 1.0, 1/2.2, 1.3, 2.0, 2.2, 10])
+@pytest.mark.parametrize('maxv', [130, 200, 254, 255])
+def test_levels_lut(minv, gamma, maxv):
+
+    levels = np.arange(256, dtype=np.uint8)
+    reference = reference_levels(levels, minv, gamma, maxv)
+
+    assert np.array_equal(FF_bin_suite.getToneLUT(minv, gamma, maxv), reference)
+
+    # uint8 images are mapped through the table, other images are computed directly
+    img = np.random.RandomState(minv).randint(0, 256, (37, 41)).astype(np.uint8)
+    assert np.array_equal(FF_bin_suite.adjust_levels(img, minv, gamma, maxv), reference[img])
+    assert np.array_equal(FF_bin_suite.adjust_levels(img.astype(np.float64), minv, gamma, maxv), reference[img])